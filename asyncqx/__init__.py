@@ -1,4 +1,5 @@
 # pylint: disable
 from .pubsub import AQXPubSub
-from .publisher import AQXPublisher
-from .subscriber import AQXSubscriber
+from .publisher import AQXPublisher, AQXAsyncPublisher, AQXPublisherPool
+from .subscriber import AQXSubscriber, AQXAsyncSubscriber
+from .transport import InMemoryBroker, InMemoryTransport
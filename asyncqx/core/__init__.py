@@ -1,2 +1,11 @@
 from .base import AQXBase, JSONSerializer
+from .async_base import AQXAsyncBase
+from .latency import PUBLISH_TIME_HEADER
+from .metrics import Histogram, InMemoryMetrics, MetricsSink
+from .rpc import RpcError
+from .serializers import (DEFAULT_REGISTRY, CompressedSerializer,
+                          FastJSONSerializer, MarshalSerializer,
+                          SerializerRegistry)
+from .sharding import by_correlation_id, by_header, jump_hash
+from .topology import Topology
 from .types import *
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import random
+from typing import Optional, Set
+
+import pika
+import pika.channel
+import pika.exceptions
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from asyncqx.core.metrics import MetricsSink
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AQXAsyncBase:
+    """The asyncio counterpart of AQXBase.
+
+    Owns a single pika AsyncioConnection and channel running on the event loop.
+    Pika's callback style operations are exposed as awaitables through `_rpc`,
+    and every awaitable still pending when the channel or connection closes is
+    failed with the close reason rather than left hanging.
+    """
+    RETRY_DELAY = 5  # seconds
+    RETRY_JITTER = (1, 3)  # seconds
+
+    def __init__(self, amqp_url: str = None, *, metrics: MetricsSink = None):
+        self._url = amqp_url
+        self.metrics = metrics
+
+        self._connection: Optional[AsyncioConnection] = None
+        self._channel: Optional[pika.channel.Channel] = None
+
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._closed: Optional[asyncio.Future] = None
+        self._pending_rpcs: Set[asyncio.Future] = set()
+
+    @property
+    def connection(self) -> Optional[AsyncioConnection]:
+        return self._connection
+
+    @property
+    def channel(self) -> Optional[pika.channel.Channel]:
+        return self._channel
+
+    @property
+    def is_ready(self) -> bool:
+        return bool(self._channel is not None and self._channel.is_open)
+
+    async def connect(self):
+        """Connects to the broker and opens a channel.
+
+        Delayed retries on AMQPConnectionErrors, like AQXBase.connect.
+        """
+        while True:
+            try:
+                await self._prepare_to_connect()
+                await self._connect()
+                return
+            except pika.exceptions.AMQPConnectionError as err:
+                if self.metrics is not None:
+                    self.metrics.increment('retry', tags={
+                        'operation': 'connect', 'error': type(err).__name__})
+                delay = self.RETRY_DELAY + random.uniform(*self.RETRY_JITTER)
+                LOGGER.warning('%s, retrying in %.1f seconds...', err, delay)
+                await asyncio.sleep(delay)
+
+    async def _connect(self):
+        LOGGER.info('creating asyncio connection')
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+
+        def on_open(connection):
+            if not opened.done():
+                opened.set_result(connection)
+
+        def on_open_error(connection, error):
+            if not isinstance(error, BaseException):
+                error = pika.exceptions.AMQPConnectionError(error)
+            if not opened.done():
+                opened.set_exception(error)
+
+        connection_parameters = pika.URLParameters(
+            self._url) if self._url else None
+        self._connection = AsyncioConnection(
+            connection_parameters,
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=loop)
+
+        await opened
+        await self._open_channel()
+
+    async def close(self):
+        connection = self._connection
+        if connection is None or connection.is_closed:
+            return
+
+        if self._closed is None or self._closed.done():
+            self._closed = asyncio.get_running_loop().create_future()
+        closed = self._closed
+
+        if not connection.is_closing:
+            LOGGER.info('closing connection')
+            connection.close()
+        await closed
+
+    async def _prepare_to_connect(self):
+        if self._connection and self._connection.is_open:
+            await self.close()
+
+    async def _open_channel(self):
+        LOGGER.info('opening channel')
+        opened = asyncio.get_running_loop().create_future()
+        self._pending_rpcs.add(opened)
+        self._connection.channel(on_open_callback=self._resolver(opened))
+        channel = await opened
+
+        channel.add_on_close_callback(self._on_channel_closed)
+        self._channel = channel
+
+        await self._on_channel_open(channel)
+
+    async def _on_channel_open(self, channel: pika.channel.Channel):
+        """Hook for subclasses to configure a freshly opened channel."""
+
+    async def _ensure_channel(self):
+        if self.is_ready:
+            return
+
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self.is_ready:
+                return
+
+            if self._connection is None or not self._connection.is_open:
+                if self._connection is not None and self.metrics is not None:
+                    self.metrics.increment('reconnect', tags={'client': type(self).__name__})
+                await self.connect()
+            else:
+                await self._open_channel()
+
+    def _rpc(self, method, *args, **kwargs) -> asyncio.Future:
+        """Invokes a pika channel method and returns a future resolved with
+        the method frame passed to its completion callback."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending_rpcs.add(future)
+        try:
+            method(*args, callback=self._resolver(future), **kwargs)
+        except Exception as err:
+            self._pending_rpcs.discard(future)
+            future.set_exception(err)
+        return future
+
+    def _resolver(self, future: asyncio.Future):
+        def resolve(result):
+            self._pending_rpcs.discard(future)
+            if not future.done():
+                future.set_result(result)
+
+        return resolve
+
+    def _fail_pending(self, reason: BaseException):
+        pending, self._pending_rpcs = self._pending_rpcs, set()
+        for future in pending:
+            if not future.done():
+                future.set_exception(reason)
+
+    def _on_channel_closed(self, channel: pika.channel.Channel,
+                           reason: BaseException):
+        LOGGER.info('channel %s closed: %s', channel, reason)
+        if channel is self._channel:
+            self._channel = None
+        self._fail_pending(reason)
+
+    def _on_connection_closed(self, connection: AsyncioConnection,
+                              reason: BaseException):
+        LOGGER.info('connection closed: %s', reason)
+        self._channel = None
+        self._fail_pending(reason)
+
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
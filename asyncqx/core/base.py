@@ -8,6 +8,10 @@ import pika.exceptions
 from pika.adapters import blocking_connection
 from retry import retry
 
+from asyncqx.core.metrics import MetricsSink, count_retries
+from asyncqx.core.topology import Topology
+from asyncqx.transport.base import PikaTransport, Transport
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -15,8 +19,12 @@ class AQXBase:
     RETRY_DELAY = 5  # seconds
     RETRY_JITTER = (1, 3)  # seconds
 
-    def __init__(self, amqp_url: str = None):
+    def __init__(self, amqp_url: str = None, *, transport: Transport = None,
+                 metrics: MetricsSink = None, topology: Topology = None):
         self._url = amqp_url
+        self._transport = transport or PikaTransport()
+        self.metrics = metrics
+        self.topology = topology or Topology()
 
         self._connection = None
         self._channel = None
@@ -32,15 +40,14 @@ class AQXBase:
         return self._channel  # type: ignore
 
     @retry(pika.exceptions.AMQPConnectionError, delay=RETRY_DELAY, jitter=RETRY_JITTER, logger=LOGGER)
+    @count_retries('connect', pika.exceptions.AMQPConnectionError)
     def connect(self):
         self._prepare_to_connect()
         self._connect()
 
     def _connect(self):
         LOGGER.info('creating blocking connection')
-        connection_parameters = pika.URLParameters(
-            self._url) if self._url else None
-        self._connection = pika.BlockingConnection(connection_parameters)
+        self._connection = self._transport.connect(self._url)
 
         self._open_channel()
 
@@ -69,6 +76,8 @@ class AQXBase:
         self._channel = self._connection.channel()
         LOGGER.info('setting channel to confirm delivery')
         self._channel.confirm_delivery()
+        # Replays the recorded topology when this is a new connection
+        self.topology.apply(self._channel)
 
     def _ensure_connection(self):
         LOGGER.debug('ensuring connection is ready')
@@ -76,10 +85,13 @@ class AQXBase:
             self.connect()
 
         if self._connection.is_closed:
+            if self.metrics is not None:
+                self.metrics.increment('reconnect', tags={'client': type(self).__name__})
             try:
                 self._connection.close()
-            finally:
-                self.connect()
+            except pika.exceptions.ConnectionWrongStateError:
+                pass
+            self.connect()
 
     def _ensure_channel(self):
         LOGGER.debug('ensuring channel is ready')
@@ -90,6 +102,8 @@ class AQXBase:
 
 
 class JSONSerializer:
+    content_type = 'application/json'
+    content_encoding = None
 
     def __init__(self, cls: Type[json.JSONEncoder] = None) -> None:
         if cls is None:
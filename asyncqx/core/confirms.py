@@ -0,0 +1,202 @@
+"""Tracking of publisher confirms for messages published without waiting."""
+import logging
+from typing import Dict, Generic, List, Optional, Set, Tuple, TypeVar
+
+import pika
+import pika.exceptions
+from pika import spec
+from pika.adapters.blocking_connection import BlockingChannel, ReturnedMessage
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class ConfirmTracker(Generic[T]):
+    """Maps publisher confirms on a channel back to the published messages.
+
+    Each tracked message gets the next delivery tag of the channel along with
+    a caller supplied value, such as a future or a result slot. Confirmations
+    resolve to `(delivery_tag, value, error)` triples where `error` is None
+    for acked messages, a NackError for nacked messages and an UnroutableError
+    for acked messages that were returned by the broker first.
+
+    A Basic.Return has no delivery tag, so it is mapped back to the earliest
+    unconfirmed mandatory message with the same message id or, for messages
+    without one, the same exchange, routing key and body. The broker returns
+    messages in publish order, ahead of their confirms.
+    """
+
+    def __init__(self):
+        self._delivery_tag = 0
+        self._unconfirmed: Dict[int, Tuple[T, ReturnedMessage]] = {}
+        self._mandatory: Set[int] = set()
+        self._returned: Dict[int, ReturnedMessage] = {}
+
+    def __len__(self) -> int:
+        return len(self._unconfirmed)
+
+    def track(self, value: T, exchange: str, routing_key: str,
+              properties: pika.BasicProperties, body: bytes,
+              mandatory: bool) -> int:
+        """Records a message about to be published and returns its delivery tag.
+
+        Must be called once per basic_publish, in publish order.
+        """
+        self._delivery_tag += 1
+        delivery_tag = self._delivery_tag
+
+        if mandatory:
+            self._mandatory.add(delivery_tag)
+
+        message = ReturnedMessage(
+            spec.Basic.Return(exchange=exchange, routing_key=routing_key),
+            properties, body)
+        self._unconfirmed[delivery_tag] = (value, message)
+        return delivery_tag
+
+    def discard(self, delivery_tag: int) -> None:
+        """Forgets a tracked message that failed to be published."""
+        self._unconfirmed.pop(delivery_tag, None)
+        self._mandatory.discard(delivery_tag)
+        if delivery_tag == self._delivery_tag:
+            self._delivery_tag -= 1
+
+    def reset(self) -> List[T]:
+        """Starts over for a new channel and returns the values still unconfirmed."""
+        unconfirmed = [value for value, _ in self._unconfirmed.values()]
+        self._delivery_tag = 0
+        self._unconfirmed = {}
+        self._mandatory = set()
+        self._returned = {}
+        return unconfirmed
+
+    def on_returned(self, channel, method: spec.Basic.Return,
+                    properties: pika.BasicProperties, body: bytes) -> None:
+        """Basic.Return callback for the channel."""
+        LOGGER.debug('message %s to exchange %s was unroutable: %s',
+                     method.routing_key, method.exchange, method.reply_text)
+
+        delivery_tag = self._returned_delivery_tag(method, properties, body)
+        if delivery_tag is not None:
+            self._returned[delivery_tag] = ReturnedMessage(
+                method, properties, body)
+
+    def _returned_delivery_tag(self, method: spec.Basic.Return,
+                               properties: pika.BasicProperties,
+                               body: bytes) -> Optional[int]:
+        message_id = properties.message_id
+        for delivery_tag, (_, message) in self._unconfirmed.items():
+            if delivery_tag not in self._mandatory or delivery_tag in self._returned:
+                continue
+            if message_id is not None:
+                if message.properties.message_id == message_id:
+                    return delivery_tag
+            elif (message.properties.message_id is None
+                  and message.method.exchange == method.exchange
+                  and message.method.routing_key == method.routing_key
+                  and message.body == body):
+                return delivery_tag
+        return None
+
+    def on_confirmation(self, frame) -> List[Tuple[int, T, Optional[Exception]]]:
+        """Resolves the messages covered by a Basic.Ack or Basic.Nack frame."""
+        method = frame.method
+        acked = isinstance(method, spec.Basic.Ack)
+
+        if method.multiple:
+            delivery_tags = []
+            for delivery_tag in self._unconfirmed:
+                if delivery_tag > method.delivery_tag:
+                    break
+                delivery_tags.append(delivery_tag)
+        else:
+            delivery_tags = [method.delivery_tag]
+
+        outcomes = []
+        for delivery_tag in delivery_tags:
+            entry = self._unconfirmed.pop(delivery_tag, None)
+            self._mandatory.discard(delivery_tag)
+            returned = self._returned.pop(delivery_tag, None)
+            if entry is None:
+                continue
+
+            value, message = entry
+            if not acked:
+                error = pika.exceptions.NackError([returned or message])
+            elif returned is not None:
+                error = pika.exceptions.UnroutableError([returned])
+            else:
+                error = None
+            outcomes.append((delivery_tag, value, error))
+
+        return outcomes
+
+
+class PipelinedConfirmChannel:
+    """Publishes on a BlockingChannel in confirm mode without waiting for
+    each confirm in turn.
+
+    BlockingChannel.confirm_delivery makes every basic_publish wait for its
+    own confirm. This puts the underlying channel in confirm mode directly,
+    so any number of messages can be published before waiting once for all
+    of their confirms.
+    """
+
+    def __init__(self, channel: BlockingChannel):
+        self._channel = channel
+        self._tracker: ConfirmTracker[None] = ConfirmTracker()
+        self._outcomes: Dict[int, Optional[Exception]] = {}
+
+        selected: List[object] = []
+        impl = channel._impl
+        impl.add_on_return_callback(self._tracker.on_returned)
+        impl.confirm_delivery(ack_nack_callback=self._on_confirmation,
+                              callback=selected.append)
+        channel._flush_output(lambda: bool(selected))
+
+    @property
+    def is_open(self) -> bool:
+        return self._channel.is_open
+
+    @property
+    def channel(self) -> BlockingChannel:
+        return self._channel
+
+    def publish(self, exchange: str, routing_key: str, body: bytes,
+                properties: pika.BasicProperties, mandatory: bool) -> int:
+        """Publishes a message and returns its delivery tag."""
+        delivery_tag = self._tracker.track(
+            None, exchange, routing_key, properties, body, mandatory)
+        try:
+            self._channel._impl.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=body,
+                properties=properties,
+                mandatory=mandatory)
+        except Exception:
+            self._tracker.discard(delivery_tag)
+            raise
+        return delivery_tag
+
+    def wait_for_confirms(self) -> Dict[int, Optional[Exception]]:
+        """Blocks until every published message is confirmed.
+
+        Returns:
+            Dict[int, Optional[Exception]]: The error, if any, per delivery tag.
+        """
+        self._channel._flush_output(lambda: len(self._tracker) == 0)
+        outcomes, self._outcomes = self._outcomes, {}
+        return outcomes
+
+    def close(self):
+        try:
+            if self._channel.is_open:
+                self._channel.close()
+        except Exception:
+            pass
+
+    def _on_confirmation(self, frame):
+        for delivery_tag, _, error in self._tracker.on_confirmation(frame):
+            self._outcomes[delivery_tag] = error
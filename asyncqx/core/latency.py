@@ -0,0 +1,76 @@
+"""Nanosecond publish timestamps for measuring end-to-end latency.
+
+The AMQP timestamp property only has one second resolution, so publishers
+created with `stamp_publish_time=True` also record `time.time_ns()` in a
+message header. Subscribers use it to measure how long messages wait in the
+broker and to skip messages older than a staleness budget. Ages are only as
+accurate as the clock synchronisation between publishing and consuming
+hosts.
+"""
+import logging
+import time
+from typing import Mapping, Optional
+
+from pika.spec import BasicProperties
+
+LOGGER = logging.getLogger(__name__)
+
+PUBLISH_TIME_HEADER = 'x-asyncqx-published-ns'
+
+STALE_DROP = 'drop'
+STALE_LOG = 'log'
+STALE_ACTIONS = (STALE_DROP, STALE_LOG)
+
+
+def check_stale_action(on_stale: str):
+    if on_stale not in STALE_ACTIONS:
+        raise ValueError(f'on_stale must be one of {STALE_ACTIONS}, not {on_stale!r}')
+
+
+def stamp_publish_time(headers: Optional[Mapping]) -> dict:
+    """Returns a copy of headers with the current time in nanoseconds."""
+    stamped = dict(headers) if headers else {}
+    stamped[PUBLISH_TIME_HEADER] = time.time_ns()
+    return stamped
+
+
+def message_age(props: BasicProperties) -> Optional[float]:
+    """Returns seconds since the message was published, or None if it was
+    not stamped with a publish time."""
+    headers = props.headers
+    if not headers:
+        return None
+
+    published = headers.get(PUBLISH_TIME_HEADER)
+    if published is None:
+        return None
+
+    return (time.time_ns() - published) / 1e9
+
+
+def is_stale(props: BasicProperties, queue_name: str, staleness_budget: Optional[float],
+             on_stale: str, metrics=None) -> bool:
+    """Records the publish to receive lag of a delivery and returns True if
+    it should be dropped for exceeding the staleness budget. Subscribers call
+    it once per delivery, before dispatching it to the bindings on its queue."""
+    if metrics is None and staleness_budget is None:
+        return False
+    age = message_age(props)
+    if age is None:
+        return False
+
+    event = props.type
+    if metrics is not None:
+        metrics.observe('receive.lag', age, tags={
+            'event': event, 'queue': queue_name or None})
+
+    if staleness_budget is None or age <= staleness_budget:
+        return False
+
+    if metrics is not None:
+        metrics.increment('stale', tags={
+            'event': event, 'queue': queue_name or None, 'action': on_stale})
+    LOGGER.warning(
+        'message type %s on queue %s is %.3fs old, over the %.3fs staleness budget (%s)',
+        event, queue_name, age, staleness_budget, on_stale)
+    return on_stale == STALE_DROP
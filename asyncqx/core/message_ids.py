@@ -0,0 +1,26 @@
+"""Unique ids for the messages publishers send.
+
+An id is a random 64 bit prefix, drawn once per process, followed by a
+counter, which is unique across processes like a uuid4 at a fraction of
+the cost per message. Forked children draw a prefix of their own.
+"""
+import itertools
+import os
+import uuid
+
+_prefix = uuid.uuid4().hex[:16]
+_counter = itertools.count()
+
+
+def next_message_id() -> str:
+    return f'{_prefix}{next(_counter):x}'
+
+
+def _reseed():
+    global _prefix, _counter
+    _prefix = uuid.uuid4().hex[:16]
+    _counter = itertools.count()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reseed)
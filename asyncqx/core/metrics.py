@@ -0,0 +1,188 @@
+"""Metrics sinks the publishers and subscribers report to.
+
+Clients take a `metrics` sink, None by default. Every instrumented path
+checks for a sink before reading the clock, so an uninstrumented client
+pays one attribute check per operation.
+
+Reported metrics, tagged with the event and exchange or queue where known:
+
+    counters:   emit, emit.error, consume, decode.error, callback.error,
+                stale, reconnect, retry, outbox.published, outbox.unroutable,
+                outbox.nack, rpc.error, pool.evicted, redelivery,
+                dead_letter, duplicate, flow.blocked, flow.buffered
+    histograms: emit.latency, confirm.latency, decode.latency,
+                callback.latency, receive.lag, handled.lag, rpc.latency,
+                pool.wait, flow.wait (seconds)
+"""
+import functools
+import threading
+from typing import Dict, Mapping, Optional, Protocol, Tuple, Type
+
+Tags = Optional[Mapping[str, object]]
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class MetricsSink(Protocol):
+
+    def increment(self, name: str, value: int = 1, tags: Tags = None): ...
+
+    def observe(self, name: str, seconds: float, tags: Tags = None): ...
+
+
+class Histogram:
+    """A log-linear latency histogram with bounded relative error.
+
+    Samples are bucketed by microsecond with SUB_BUCKETS buckets per power of
+    two, so a percentile is accurate to within 1 / SUB_BUCKETS of the true
+    value and recording a sample is a few integer operations.
+    """
+    SUB_BUCKETS = 16
+    _SHIFT = SUB_BUCKETS.bit_length() - 1
+
+    __slots__ = ('count', 'total', 'min', 'max', '_buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self._buckets: Dict[int, int] = {}
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+        index = self._index(max(0, int(seconds * 1e6)))
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        """Returns the value in seconds below which fraction of samples fall."""
+        if not self.count:
+            return 0.0
+
+        rank = max(1, round(fraction * self.count))
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(max(self._upper_bound(index) / 1e6, self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.50),
+            'p90': self.percentile(0.90),
+            'p99': self.percentile(0.99),
+        }
+
+    @classmethod
+    def _index(cls, micros: int) -> int:
+        if micros < cls.SUB_BUCKETS:
+            return micros
+        exponent = micros.bit_length() - cls._SHIFT - 1
+        return cls.SUB_BUCKETS * (exponent + 1) + (micros >> exponent) - cls.SUB_BUCKETS
+
+    @classmethod
+    def _upper_bound(cls, index: int) -> int:
+        if index < cls.SUB_BUCKETS:
+            return index
+        exponent, offset = divmod(index, cls.SUB_BUCKETS)
+        exponent -= 1
+        return ((cls.SUB_BUCKETS + offset + 1) << exponent) - 1
+
+
+class InMemoryMetrics:
+    """Keeps counters and latency histograms in process.
+
+    Thread-safe, so one sink can be shared by every client in a process.
+    Call `snapshot` to read the current values, e.g. from a health endpoint
+    or a periodic exporter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[MetricKey, int] = {}
+        self._histograms: Dict[MetricKey, Histogram] = {}
+
+    def increment(self, name: str, value: int = 1, tags: Tags = None):
+        key = _key(name, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, tags: Tags = None):
+        key = _key(name, tags)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.record(seconds)
+
+    def counter(self, name: str, tags: Tags = None) -> int:
+        with self._lock:
+            return self._counters.get(_key(name, tags), 0)
+
+    def histogram(self, name: str, tags: Tags = None) -> Optional[Histogram]:
+        with self._lock:
+            return self._histograms.get(_key(name, tags))
+
+    def snapshot(self) -> dict:
+        """Returns every counter and histogram summary keyed by
+        `name{tag=value,...}`."""
+        with self._lock:
+            return {
+                'counters': {_format(key): value
+                             for key, value in self._counters.items()},
+                'histograms': {_format(key): histogram.summary()
+                               for key, histogram in self._histograms.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+def _key(name: str, tags: Tags) -> MetricKey:
+    if not tags:
+        return name, ()
+    return name, tuple(sorted((key, str(value)) for key, value in tags.items()
+                              if value is not None))
+
+
+def _format(key: MetricKey) -> str:
+    name, tags = key
+    if not tags:
+        return name
+    return name + '{' + ','.join(f'{tag}={value}' for tag, value in tags) + '}'
+
+
+def count_retries(operation: str, *exceptions: Type[BaseException]):
+    """Counts failed attempts of a method retried by the `retry` decorator.
+
+    Apply below `@retry` so every failing attempt is seen. Increments the
+    `retry` counter of the instance's metrics sink, if it has one.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            except exceptions as err:
+                metrics = self.metrics
+                if metrics is not None:
+                    metrics.increment('retry', tags={
+                        'operation': operation, 'error': type(err).__name__})
+                raise
+
+        return wrapper
+
+    return decorator
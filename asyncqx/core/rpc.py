@@ -0,0 +1,107 @@
+"""Request / reply over RabbitMQ's direct reply-to pseudo-queue.
+
+A caller consumes from `amq.rabbitmq.reply-to` on its channel, without
+acks, and publishes requests on the same channel with `reply_to` set to the
+pseudo-queue and a fresh correlation id. The broker rewrites `reply_to` to
+a name routing straight back to that consumer, so replies need no queue to
+be declared. Replies carry the request's correlation id, which maps them
+back to the future the caller is waiting on.
+"""
+import uuid
+from typing import Dict, Generic, List, Optional, TypeVar
+
+import pika
+import pika.exceptions
+from pika.adapters.blocking_connection import ReturnedMessage
+
+from asyncqx.core.serializers import DEFAULT_REGISTRY, EncodedMessage, SerializerRegistry
+from asyncqx.core.types import Serializer
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+RPC_ERROR_HEADER = 'x-asyncqx-rpc-error'
+
+F = TypeVar('F')
+
+
+class RpcError(Exception):
+    """Raised by a call when the remote handler failed."""
+
+
+class ReplyRouter(Generic[F]):
+    """Maps replies arriving on the direct reply-to consumer of a channel to
+    the futures of their calls.
+
+    Works with concurrent and asyncio futures alike, which are resolved with
+    the `(props, body)` of their reply.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, F] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, future: F) -> str:
+        """Registers a future and returns the correlation id of its request."""
+        correlation_id = uuid.uuid4().hex
+        self._pending[correlation_id] = future
+        return correlation_id
+
+    def discard(self, correlation_id: str):
+        self._pending.pop(correlation_id, None)
+
+    def on_reply(self, channel, method, props: pika.BasicProperties, body: bytes):
+        """Consumer callback for the direct reply-to pseudo-queue."""
+        future = self._pending.pop(props.correlation_id, None)
+        if future is not None and not future.done():
+            future.set_result((props, body))
+
+    def on_returned(self, channel, method, props: pika.BasicProperties, body: bytes):
+        """Basic.Return callback, failing calls no queue was bound for."""
+        future = self._pending.pop(props.correlation_id, None)
+        if future is not None and not future.done():
+            future.set_exception(pika.exceptions.UnroutableError(
+                [ReturnedMessage(method, props, body)]))
+
+    def fail_all(self, reason: BaseException) -> List[F]:
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(reason)
+        return list(pending.values())
+
+
+def request_properties(props: pika.BasicProperties, correlation_id: str,
+                       timeout: Optional[float]) -> pika.BasicProperties:
+    """Addresses a request to the direct reply-to consumer. Requests expire
+    with their call, so a backlogged handler skips callers that gave up."""
+    props.correlation_id = correlation_id
+    props.reply_to = DIRECT_REPLY_TO
+    if timeout is not None:
+        props.expiration = str(max(1, int(timeout * 1000)))
+    return props
+
+
+def reply_properties(request: pika.BasicProperties, app_id: Optional[str],
+                     encoded: EncodedMessage = None,
+                     error: BaseException = None) -> pika.BasicProperties:
+    return pika.BasicProperties(
+        app_id=app_id,
+        type=request.type,
+        correlation_id=request.correlation_id,
+        content_type=encoded.content_type if encoded else None,
+        content_encoding=encoded.content_encoding if encoded else None,
+        headers={RPC_ERROR_HEADER: f'{type(error).__name__}: {error}'} if error else None)
+
+
+def decode_reply(props: pika.BasicProperties, body: bytes, serializer: Serializer,
+                 serializers: SerializerRegistry = DEFAULT_REGISTRY) -> object:
+    """Returns the payload of a reply.
+
+    Raises:
+        RpcError: The reply reports that the handler failed.
+    """
+    error = (props.headers or {}).get(RPC_ERROR_HEADER)
+    if error is not None:
+        raise RpcError(error.decode() if isinstance(error, bytes) else error)
+    return serializers.resolve(props, serializer).decode(body)
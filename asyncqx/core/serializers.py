@@ -0,0 +1,251 @@
+"""Serializers and the registry used to pick one per message."""
+import bz2
+import dataclasses
+import json
+import logging
+import lzma
+import marshal
+import operator
+import zlib
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from pika.spec import BasicProperties
+
+from asyncqx.core.base import JSONSerializer
+from asyncqx.core.types import Serializer
+
+LOGGER = logging.getLogger(__name__)
+
+
+class EncodedMessage(NamedTuple):
+    body: bytes
+    content_type: Optional[str]
+    content_encoding: Optional[str]
+
+
+def encode_message(serializer: Serializer, payload: object) -> EncodedMessage:
+    """Encodes a payload along with the content type and encoding to stamp
+    on the message.
+
+    Serializers may describe their output with `content_type` and
+    `content_encoding` attributes, or implement `encode_message` when the
+    encoding depends on the payload.
+    """
+    encode = getattr(serializer, 'encode_message', None)
+    if encode is not None:
+        return encode(payload)
+
+    return EncodedMessage(serializer.encode(payload),
+                          getattr(serializer, 'content_type', None),
+                          getattr(serializer, 'content_encoding', None))
+
+
+class SerializerRegistry:
+    """Maps message content types and encodings to serializers.
+
+    Lets a subscriber decode each message with the serializer matching its
+    properties, so publishers can move event types to another format without
+    every consumer switching at the same time.
+    """
+
+    def __init__(self):
+        self._serializers: Dict[Tuple[str, Optional[str]], Serializer] = {}
+
+    def register(self, serializer: Serializer,
+                 content_type: str = None,
+                 content_encoding: str = None) -> Serializer:
+        """Registers a serializer, by default under its own content type and encoding."""
+        content_type = content_type or getattr(serializer, 'content_type', None)
+        if content_type is None:
+            raise ValueError(f'no content type given for serializer {serializer}')
+
+        if content_encoding is None:
+            content_encoding = getattr(serializer, 'content_encoding', None)
+
+        self._serializers[(content_type, content_encoding)] = serializer
+        return serializer
+
+    def get(self, content_type: str,
+            content_encoding: str = None) -> Optional[Serializer]:
+        """Returns the serializer for a content type and encoding.
+
+        Compressed encodings of a registered content type are resolved to a
+        CompressedSerializer around the serializer for the plain content type.
+        """
+        serializer = self._serializers.get((content_type, content_encoding))
+        if serializer is not None or content_encoding not in COMPRESSION_CODECS:
+            return serializer
+
+        inner = self._serializers.get((content_type, None))
+        if inner is None:
+            return None
+
+        return self._serializers.setdefault(
+            (content_type, content_encoding),
+            CompressedSerializer(inner, codec=content_encoding))
+
+    def resolve(self, props: BasicProperties, fallback: Serializer) -> Serializer:
+        """Returns the serializer to decode a message with.
+
+        The fallback, normally the serializer given at bind time, is used when
+        it handles the message's content type and encoding, when it does not
+        declare a content type, when the message has no content type, or when
+        the content type is not registered.
+        """
+        content_type = props.content_type
+        if content_type is None:
+            return fallback
+
+        fallback_type = getattr(fallback, 'content_type', None)
+        if fallback_type is None:
+            return fallback
+
+        content_encoding = props.content_encoding
+        if (fallback_type == content_type and
+                getattr(fallback, 'content_encoding', None) == content_encoding):
+            return fallback
+
+        serializer = self.get(content_type, content_encoding)
+        if serializer is None and content_encoding is None and \
+                isinstance(fallback, CompressedSerializer):
+            # Messages below the compression threshold are sent uncompressed
+            return fallback.serializer
+
+        if serializer is None:
+            LOGGER.debug('no serializer registered for %s (%s)',
+                         content_type, content_encoding)
+            return fallback
+
+        return serializer
+
+
+class FastJSONSerializer:
+    """A JSON serializer with a reusable encoder and precompiled dataclass
+    encoders.
+
+    Produces compact JSON that any JSON consumer can read. Dataclass
+    instances are encoded with a field getter compiled once per class rather
+    than with `dataclasses.asdict`, which deep copies every value.
+    """
+    content_type = 'application/json'
+    content_encoding = None
+
+    def __init__(self, default: Callable[[object], object] = None):
+        self._fallback = default
+        self._dataclass_encoders: Dict[type, Callable[[object], dict]] = {}
+        self._encoder = json.JSONEncoder(
+            ensure_ascii=False,
+            separators=(',', ':'),
+            default=self._default)
+
+    def decode(self, data: bytes) -> object:
+        return json.loads(data)
+
+    def encode(self, data: object) -> bytes:
+        return self._encoder.encode(data).encode()
+
+    def _default(self, obj: object) -> object:
+        cls = type(obj)
+        encoder = self._dataclass_encoders.get(cls)
+        if encoder is None:
+            if not dataclasses.is_dataclass(cls):
+                if self._fallback is not None:
+                    return self._fallback(obj)
+                raise TypeError(
+                    f'Object of type {cls.__name__} is not JSON serializable')
+            encoder = self._dataclass_encoders[cls] = _compile_dataclass_encoder(cls)
+        return encoder(obj)
+
+
+def _compile_dataclass_encoder(cls: type) -> Callable[[object], dict]:
+    names = tuple(field.name for field in dataclasses.fields(cls))
+    if not names:
+        return lambda obj: {}
+    if len(names) == 1:
+        name = names[0]
+        return lambda obj: {name: getattr(obj, name)}
+
+    getter = operator.attrgetter(*names)
+    return lambda obj: dict(zip(names, getter(obj)))
+
+
+class MarshalSerializer:
+    """A compact binary serializer built on the stdlib `marshal` module.
+
+    Supports None, bools, numbers, strings, bytes and lists, tuples, sets and
+    dicts of those. Much faster to encode and decode than JSON, but only
+    suitable between trusted Python processes: marshal data is not portable
+    to other languages and is not safe to load from untrusted sources.
+
+    It is not in DEFAULT_REGISTRY, so subscribers only decode marshal
+    messages when bound with it or given a SerializerRegistry it is
+    registered in.
+    """
+    content_type = 'application/x-python-marshal'
+    content_encoding = None
+    VERSION = 4
+
+    def decode(self, data: bytes) -> object:
+        return marshal.loads(data)
+
+    def encode(self, data: object) -> bytes:
+        return marshal.dumps(data, self.VERSION)
+
+
+COMPRESSION_CODECS: Dict[str, Tuple[Callable[[bytes, int], bytes],
+                                     Callable[[bytes], bytes], int]] = {
+    # name: (compress(data, level), decompress(data), default level)
+    'zlib': (zlib.compress, zlib.decompress, 6),
+    'bz2': (bz2.compress, bz2.decompress, 9),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level),
+             lzma.decompress, 6),
+}
+
+
+class CompressedSerializer:
+    """Compresses the output of another serializer above a size threshold.
+
+    Messages at least `threshold` bytes long are compressed and stamped with
+    the codec name as their content encoding; smaller messages are sent as
+    the wrapped serializer produces them. Subscribers decompress based on the
+    content encoding of each message, see SerializerRegistry.get.
+    """
+
+    def __init__(self, serializer: Serializer,
+                 codec: str = 'zlib',
+                 threshold: int = 1024,
+                 level: int = None):
+        if codec not in COMPRESSION_CODECS:
+            raise ValueError(f'unknown compression codec {codec}')
+
+        self.serializer = serializer
+        self.threshold = threshold
+        self.content_encoding = codec
+
+        compress, self._decompress, default_level = COMPRESSION_CODECS[codec]
+        self.level = default_level if level is None else level
+        self._compress = compress
+
+    @property
+    def content_type(self) -> Optional[str]:
+        return getattr(self.serializer, 'content_type', None)
+
+    def decode(self, data: bytes) -> object:
+        return self.serializer.decode(self._decompress(data))
+
+    def encode(self, data: object) -> bytes:
+        """Encodes and always compresses the payload."""
+        return self._compress(self.serializer.encode(data), self.level)
+
+    def encode_message(self, payload: object) -> EncodedMessage:
+        encoded = encode_message(self.serializer, payload)
+        if len(encoded.body) < self.threshold:
+            return encoded
+
+        return EncodedMessage(self._compress(encoded.body, self.level),
+                              encoded.content_type,
+                              self.content_encoding)
+
+
+DEFAULT_REGISTRY = SerializerRegistry()
+DEFAULT_REGISTRY.register(JSONSerializer())
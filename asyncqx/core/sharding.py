@@ -0,0 +1,76 @@
+"""Partition keys and the consistent hashing that spreads one event stream
+over shard queues.
+
+A sharded event is published with a `.{shard}` suffix on its routing key
+and each shard has a queue of its own, `{queue}.{shard}`, bound to the
+suffixed key. Messages with the same partition key always go to the same
+shard, so they keep their order, while the shards are spread over broker
+queue processes and consumers.
+"""
+import zlib
+from typing import Callable, Iterable, Optional, Tuple, Union
+
+from pika.spec import BasicProperties
+
+PartitionKey = Callable[[BasicProperties], object]
+
+
+def by_correlation_id(props: BasicProperties) -> Optional[str]:
+    """Partitions messages by their correlation id."""
+    return props.correlation_id
+
+
+def by_header(name: str) -> PartitionKey:
+    """Returns a partition key function reading a message header."""
+    def partition_key(props: BasicProperties):
+        return (props.headers or {}).get(name)
+    return partition_key
+
+
+def resolve_partition_key(partition_key: Union[str, PartitionKey, None]) -> PartitionKey:
+    """Header names are read with by_header; None partitions by correlation id."""
+    if partition_key is None:
+        return by_correlation_id
+    if isinstance(partition_key, str):
+        return by_header(partition_key)
+    return partition_key
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Maps a 64 bit key to one of buckets with Lamping and Veach's jump
+    consistent hash. Growing from n to n + 1 buckets only moves 1 / (n + 1)
+    of the keys, all of them to the new bucket."""
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for(key, shards: int) -> int:
+    """Returns the shard of a partition key."""
+    if not isinstance(key, bytes):
+        key = str(key).encode()
+    return jump_hash(zlib.crc32(key), shards)
+
+
+def shard_routing_key(event: str, shard: int) -> str:
+    return f'{event}.{shard}'
+
+
+def shard_queue_name(queue_name: str, shard: int) -> str:
+    return f'{queue_name}.{shard}'
+
+
+def resolve_claim(shards: int, claim: Optional[Iterable[int]]) -> Tuple[int, ...]:
+    """Returns the shards to consume, every shard when claim is None."""
+    if shards < 1:
+        raise ValueError(f'shards must be at least 1, got {shards}')
+    if claim is None:
+        return tuple(range(shards))
+
+    claimed = tuple(sorted(set(claim)))
+    if not claimed or claimed[0] < 0 or claimed[-1] >= shards:
+        raise ValueError(f'claim must be shards in range({shards}), got {claimed}')
+    return claimed
@@ -0,0 +1,191 @@
+"""Records the exchanges, queues and bindings a client needs and declares
+them once per connection."""
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Set, Tuple, Union
+
+from pika.adapters.blocking_connection import BlockingChannel
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _arguments(arguments: Optional[dict]) -> Tuple:
+    return tuple(sorted(arguments.items())) if arguments else ()
+
+
+@dataclass(frozen=True)
+class ExchangeSpec:
+    name: str
+    exchange_type: str = 'topic'
+    durable: bool = True
+    auto_delete: bool = False
+    arguments: Tuple = ()
+
+    needs_reply = False
+
+    def declare(self, channel, topology: 'Topology'):
+        channel.exchange_declare(self.name,
+                                 exchange_type=self.exchange_type,
+                                 durable=self.durable,
+                                 auto_delete=self.auto_delete,
+                                 arguments=dict(self.arguments) or None)
+
+
+@dataclass(frozen=True)
+class QueueSpec:
+    """A queue to declare. Queues without a name are named by the broker
+    when declared and identified by their alias until then."""
+    name: str
+    durable: bool = True
+    exclusive: bool = False
+    auto_delete: bool = False
+    arguments: Tuple = ()
+    alias: str = ''
+
+    @property
+    def key(self) -> str:
+        return self.name or f'anonymous:{self.alias}'
+
+    @property
+    def needs_reply(self) -> bool:
+        return not self.name
+
+    def declare(self, channel, topology: 'Topology'):
+        declared = channel.queue_declare(self.name,
+                                         durable=self.durable,
+                                         exclusive=self.exclusive,
+                                         auto_delete=self.auto_delete,
+                                         arguments=dict(self.arguments) or None)
+        if not self.name:
+            topology._queue_names[self.key] = declared.method.queue
+
+
+@dataclass(frozen=True)
+class BindingSpec:
+    queue: QueueSpec
+    exchange: str
+    routing_key: str
+
+    needs_reply = False
+
+    def declare(self, channel, topology: 'Topology'):
+        channel.queue_bind(topology.queue_name(self.queue),
+                           self.exchange,
+                           routing_key=self.routing_key)
+
+
+Declaration = Union[ExchangeSpec, QueueSpec, BindingSpec]
+
+
+class Topology:
+    """Exchanges, queues and bindings declared once per connection.
+
+    Declarations are recorded as they are added and sent by `apply`, which
+    only declares what the channel's connection has not seen yet. A new
+    connection, e.g. after a reconnect, gets every recorded declaration
+    replayed, including exclusive queues that died with the old one.
+
+    On pika blocking channels every declaration but the last is sent without
+    waiting for its reply, and the last one acts as a barrier: if any of the
+    batch failed, the broker closes the channel and the barrier raises.
+    Only declarations that need the reply, such as server-named queues,
+    wait on their own.
+    """
+
+    def __init__(self):
+        self._declarations: Dict[Declaration, None] = {}
+        self._exchanges: Dict[str, ExchangeSpec] = {}
+
+        self._connection = None
+        self._declared: Set[Declaration] = set()
+        self._declared_exchanges: Set[str] = set()
+        self._queue_names: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._declarations)
+
+    def declare_exchange(self, name: str, exchange_type: str = 'topic',
+                         durable: bool = True, auto_delete: bool = False,
+                         arguments: dict = None) -> ExchangeSpec:
+        spec = ExchangeSpec(name, exchange_type, durable, auto_delete,
+                            _arguments(arguments))
+        self._exchanges[name] = spec
+        self._declarations[spec] = None
+        return spec
+
+    def declare_queue(self, name: str, durable: bool = True,
+                      exclusive: bool = False, auto_delete: bool = False,
+                      arguments: dict = None, alias: str = '') -> QueueSpec:
+        """Records a queue. Pass an alias to tell apart several server-named
+        queues."""
+        spec = QueueSpec(name, durable, exclusive, auto_delete,
+                         _arguments(arguments), '' if name else alias)
+        self._declarations[spec] = None
+        return spec
+
+    def bind(self, queue: QueueSpec, exchange: str, routing_key: str) -> BindingSpec:
+        spec = BindingSpec(queue, exchange, routing_key)
+        self._declarations[spec] = None
+        return spec
+
+    def queue_name(self, queue: QueueSpec) -> str:
+        """Returns the name of a declared queue, as named by the broker if
+        it was declared without one."""
+        if queue.name:
+            return queue.name
+        return self._queue_names[queue.key]
+
+    def ensure_exchange(self, channel, name: str):
+        """Records and declares a topic exchange, unless the channel's
+        connection has already declared it. Cheap enough to call before
+        every publish."""
+        if name == '' or (name in self._declared_exchanges and
+                          channel.connection is self._connection):
+            return
+        self.ensure_exchanges(channel, (name,))
+
+    def ensure_exchanges(self, channel, names: Iterable[str]):
+        """Records topic exchanges that are not recorded yet and declares
+        any the channel's connection has not declared, in one batch."""
+        for name in names:
+            if name and name not in self._exchanges:
+                self.declare_exchange(name)
+        self.apply(channel)
+
+    def forget_exchange(self, name: str):
+        """Marks an exchange as undeclared, e.g. after it was deleted on the
+        broker, so the next apply declares it again."""
+        self._declared_exchanges.discard(name)
+        spec = self._exchanges.get(name)
+        if spec is not None:
+            self._declared.discard(spec)
+
+    def apply(self, channel):
+        """Declares everything recorded that the channel's connection has not
+        declared yet."""
+        if channel.connection is not self._connection:
+            self._connection = channel.connection
+            self._declared = set()
+            self._declared_exchanges = set()
+            self._queue_names = {}
+
+        pending = [declaration for declaration in self._declarations
+                   if declaration not in self._declared]
+        if not pending:
+            return
+
+        LOGGER.info('declaring %s exchanges, queues and bindings', len(pending))
+        nowait = channel._impl if isinstance(channel, BlockingChannel) else None
+
+        last = len(pending) - 1
+        for index, declaration in enumerate(pending):
+            if nowait is None or index == last or declaration.needs_reply:
+                declaration.declare(channel, self)
+            else:
+                # The underlying channel skips waiting when given no callback
+                declaration.declare(nowait, self)
+
+        self._declared.update(pending)
+        self._declared_exchanges.update(
+            declaration.name for declaration in pending
+            if isinstance(declaration, ExchangeSpec))
@@ -1,3 +1,8 @@
 # pylint: disable
 from .publisher import AQXPublisher
+from .async_publisher import AQXAsyncPublisher
+from .flow import BrokerBlockedError, FlowControl, FlowState, RateLimitedError
+from .outbox import Outbox, OutboxFullError, OutboxStoppedError
+from .pool import AQXPublisherPool
+from .prepared import PreparedEmitter
 from .types import *
@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import pika
+import pika.channel
+import pika.exceptions
+
+from asyncqx.core.async_base import AQXAsyncBase
+from asyncqx.core.base import JSONSerializer
+from asyncqx.core.latency import stamp_publish_time
+from asyncqx.core.message_ids import next_message_id
+from asyncqx.core.metrics import MetricsSink
+from asyncqx.core.rpc import (DIRECT_REPLY_TO, ReplyRouter, decode_reply,
+                              request_properties)
+from asyncqx.core.serializers import encode_message
+from asyncqx.core.types import Serializer, Stringable
+from asyncqx.core.confirms import ConfirmTracker
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AQXAsyncPublisher (AQXAsyncBase):
+    """An asyncio publisher with pipelined publisher confirms.
+
+    `emit` takes the same arguments as AQXPublisher.emit but returns once the
+    broker has confirmed the message. Any number of emits may be awaited
+    concurrently; each publish is tracked by its delivery tag and resolved or
+    failed when the matching Basic.Ack / Basic.Nack arrives.
+
+    `call` works like AQXPublisher.call, with replies consumed from the
+    direct reply-to pseudo-queue of the publishing channel and matched to
+    the awaiting calls by correlation id.
+    """
+    CALL_TIMEOUT = 5.0  # seconds
+
+    def __init__(self,
+                 name: str,
+                 amqp_url: str = None,
+                 *,
+                 default_exchange=None,
+                 default_serializer: Serializer = None,
+                 metrics: MetricsSink = None,
+                 stamp_publish_time: bool = False):
+        super().__init__(amqp_url, metrics=metrics)
+
+        self.name = str(name)
+        self.stamp_publish_time = stamp_publish_time
+
+        self.default_exchange = default_exchange or 'asyncqx'
+        self.default_serializer = default_serializer or JSONSerializer()
+
+        self._confirms: ConfirmTracker[asyncio.Future] = ConfirmTracker()
+        self._declared_exchanges: Dict[str, asyncio.Future] = {}
+
+        self._replies: ReplyRouter[asyncio.Future] = ReplyRouter()
+        self._reply_consumer: Optional[asyncio.Future] = None
+
+    @property
+    def in_flight(self) -> int:
+        """The number of published messages awaiting a broker confirm."""
+        return len(self._confirms)
+
+    async def emit(self,
+                   event: Stringable,
+                   payload: object,
+                   *,
+                   mandatory=False,
+                   correlation_id=None,
+                   headers: object = None,
+                   exchange: Stringable = None,
+                   serializer: Serializer = None) -> None:
+        """Publishes an event and waits for the broker to confirm it.
+
+        Raises:
+            pika.exceptions.NackError: The broker rejected the message.
+            pika.exceptions.UnroutableError: A mandatory message could not be routed.
+        """
+        exchange = exchange or self.default_exchange
+        serializer = serializer or self.default_serializer
+
+        LOGGER.info('emitting event: event=%s exchange=%s', event, exchange)
+
+        encoded = encode_message(serializer, payload)
+        props = self._build_properties(event, mandatory, correlation_id, headers,
+                                       encoded.content_type, encoded.content_encoding)
+        data = encoded.body
+
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        try:
+            await self._publish(str(exchange),
+                                routing_key=str(event),
+                                properties=props,
+                                mandatory=mandatory,
+                                data=data)
+        except Exception as err:
+            if metrics is not None:
+                metrics.increment('emit.error', tags={
+                    'event': event, 'exchange': exchange, 'error': type(err).__name__})
+            raise
+
+        if metrics is not None:
+            tags = {'event': event, 'exchange': exchange}
+            metrics.increment('emit', tags=tags)
+            metrics.observe('emit.latency', time.perf_counter() - started, tags=tags)
+
+    async def call(self,
+                   event: Stringable,
+                   payload: object,
+                   *,
+                   timeout: float = None,
+                   headers: object = None,
+                   exchange: Stringable = None,
+                   serializer: Serializer = None) -> object:
+        """Sends a request to a handler bound with bind_rpc and waits for its reply.
+
+        Raises:
+            TimeoutError: No reply arrived in time.
+            RpcError: The handler failed.
+            pika.exceptions.UnroutableError: No queue is bound for the event.
+        """
+        timeout = self.CALL_TIMEOUT if timeout is None else timeout
+        exchange = str(exchange or self.default_exchange)
+        serializer = serializer or self.default_serializer
+
+        encoded = encode_message(serializer, payload)
+        reply = asyncio.get_running_loop().create_future()
+        correlation_id = self._replies.add(reply)
+        props = request_properties(
+            self._build_properties(event, False, None, headers,
+                                   encoded.content_type, encoded.content_encoding),
+            correlation_id, timeout)
+
+        started = time.perf_counter()
+        try:
+            reply_props, body = await asyncio.wait_for(
+                self._request(exchange, str(event), props, encoded.body, reply), timeout)
+            result = decode_reply(reply_props, body, serializer)
+        except Exception as err:
+            if isinstance(err, asyncio.TimeoutError):
+                err = TimeoutError(f'no reply to {event} within {timeout}s')
+            if self.metrics is not None:
+                self.metrics.increment('rpc.error', tags={
+                    'event': event, 'exchange': exchange, 'error': type(err).__name__})
+            raise err
+        finally:
+            self._replies.discard(correlation_id)
+
+        if self.metrics is not None:
+            self.metrics.observe('rpc.latency', time.perf_counter() - started,
+                                 tags={'exchange': exchange, 'batch': False})
+        return result
+
+    async def _request(self, exchange: str, routing_key: str,
+                       properties: pika.BasicProperties, data: bytes,
+                       reply: asyncio.Future):
+        await self._ensure_channel()
+        await self._ensure_reply_consumer()
+        await self._publish(exchange, routing_key, properties, True, data)
+        return await reply
+
+    async def _ensure_reply_consumer(self):
+        """Consumes the direct reply-to pseudo-queue of the channel, which
+        must happen before requests are published on it."""
+        if self._reply_consumer is None:
+            self._reply_consumer = self._rpc(
+                self._channel.basic_consume, DIRECT_REPLY_TO,
+                self._replies.on_reply, auto_ack=True)
+
+        consumer = self._reply_consumer
+        try:
+            await asyncio.shield(consumer)
+        except Exception:
+            if self._reply_consumer is consumer:
+                self._reply_consumer = None
+            raise
+
+    def _build_properties(self, event: Stringable, mandatory: bool,
+                          correlation_id, headers,
+                          content_type: str = None,
+                          content_encoding: str = None) -> pika.BasicProperties:
+        if self.stamp_publish_time:
+            headers = stamp_publish_time(headers)
+
+        return pika.BasicProperties(
+            app_id=self.name,
+            type=str(event),
+            message_id=next_message_id(),
+            timestamp=int(time.time()),
+            headers=headers,
+            delivery_mode=2 if mandatory else 1,
+            correlation_id=str(correlation_id) if correlation_id else None,
+            content_type=content_type,
+            content_encoding=content_encoding)
+
+    async def _publish(self, exchange: str, routing_key: str,
+                       properties: pika.BasicProperties,
+                       mandatory: bool, data: bytes):
+        await self._ensure_channel()
+        await self._ensure_exchange(exchange)
+
+        confirmed = asyncio.get_running_loop().create_future()
+        delivery_tag = self._confirms.track(
+            confirmed, exchange, routing_key, properties, data, mandatory)
+
+        try:
+            self._channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                properties=properties,
+                mandatory=mandatory,
+                body=data)
+        except Exception:
+            self._confirms.discard(delivery_tag)
+            raise
+
+        metrics = self.metrics
+        if metrics is None:
+            await confirmed
+            return
+
+        started = time.perf_counter()
+        await confirmed
+        metrics.observe('confirm.latency', time.perf_counter() - started,
+                        tags={'exchange': exchange})
+
+    async def _ensure_exchange(self, exchange: str):
+        """Declares an exchange the first time it is published to on a channel.
+
+        Publishing to a missing exchange would close the channel and fail every
+        message in flight on it, so exchanges are declared up front instead.
+        """
+        if exchange == '':
+            return
+
+        declared = self._declared_exchanges.get(exchange)
+        if declared is None:
+            declared = self._rpc(self._channel.exchange_declare,
+                                 exchange,
+                                 exchange_type='topic',
+                                 durable=True)
+            self._declared_exchanges[exchange] = declared
+
+        try:
+            await asyncio.shield(declared)
+        except Exception:
+            if self._declared_exchanges.get(exchange) is declared:
+                del self._declared_exchanges[exchange]
+            raise
+
+    async def _on_channel_open(self, channel: pika.channel.Channel):
+        LOGGER.info('setting channel to confirm delivery')
+        self._fail_unconfirmed(pika.exceptions.ChannelClosed(
+            0, 'channel replaced before confirm'))
+        self._declared_exchanges = {}
+        self._reply_consumer = None
+        channel.add_on_return_callback(self._confirms.on_returned)
+        await self._rpc(channel.confirm_delivery,
+                        ack_nack_callback=self._on_delivery_confirmation)
+
+    def _on_delivery_confirmation(self, frame):
+        for _, confirmed, error in self._confirms.on_confirmation(frame):
+            if confirmed.done():
+                continue
+            if error is None:
+                confirmed.set_result(None)
+            else:
+                confirmed.set_exception(error)
+
+    def _fail_unconfirmed(self, reason: BaseException):
+        for confirmed in self._confirms.reset():
+            if not confirmed.done():
+                confirmed.set_exception(reason)
+
+    def _on_channel_closed(self, channel: pika.channel.Channel,
+                           reason: BaseException):
+        is_current = channel is self._channel
+        super()._on_channel_closed(channel, reason)
+        if is_current:
+            self._fail_unconfirmed(reason)
+            self._replies.fail_all(reason)
+
+    def _on_connection_closed(self, connection, reason: BaseException):
+        super()._on_connection_closed(connection, reason)
+        self._fail_unconfirmed(reason)
+        self._replies.fail_all(reason)
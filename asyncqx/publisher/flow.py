@@ -0,0 +1,324 @@
+"""Publish rate limits and handling of a broker that blocked its publishers.
+
+RabbitMQ blocks the connections of publishers when it runs low on memory or
+disk, announcing it with connection.blocked, and stops reading from them
+until it sends connection.unblocked. A publish on a blocked connection
+waits for its confirm until the alarm clears, however long that takes.
+
+FlowControl records which connections the broker blocked and applies a
+policy to publishes made on them, before anything is sent:
+
+    block:  wait for the connection to be unblocked, up to blocked_timeout,
+            then raise BrokerBlockedError
+    fail:   raise BrokerBlockedError straight away
+    buffer: keep up to buffer_size messages in memory, publishing them
+            once the connection is unblocked, or when the publisher is
+            closed
+
+It also caps the publish rate of exchanges and events with token buckets,
+waiting up to max_wait for a token before raising RateLimitedError.
+
+A connection only reads notifications while it is in use, so the
+connection of a publisher left idle for POLL_INTERVAL is polled before it
+publishes. A notification arriving in the middle of a publish does not
+interrupt it; set `blocked_connection_timeout` in the AMQP url to bound
+that wait.
+"""
+import copy
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Mapping, Optional, Tuple, Union
+
+import pika
+
+from asyncqx.core.metrics import MetricsSink
+
+LOGGER = logging.getLogger(__name__)
+
+BLOCK = 'block'
+FAIL = 'fail'
+BUFFER = 'buffer'
+POLICIES = (BLOCK, FAIL, BUFFER)
+
+# exchange, routing key, properties, mandatory, body
+Message = Tuple[str, str, pika.BasicProperties, bool, bytes]
+# messages per second, or messages per second and burst size
+Rate = Union[float, Tuple[float, float]]
+
+
+class BrokerBlockedError(Exception):
+    """Raised when a publish is refused because the broker blocked the connection."""
+
+
+class RateLimitedError(Exception):
+    """Raised when a publish would wait longer than max_wait for its rate limit."""
+
+
+class TokenBucket:
+    """Allows `rate` messages per second on average and bursts of up to
+    `burst` messages, one second's worth by default."""
+
+    def __init__(self, rate: float, burst: float = None):
+        if rate <= 0:
+            raise ValueError(f'rate must be positive, got {rate}')
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        if self.burst < 1:
+            raise ValueError(f'burst must be at least 1, got {burst}')
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> float:
+        """The tokens available now, negative while taken tokens are owed."""
+        with self._lock:
+            return self._refill(time.monotonic())
+
+    def take(self, max_wait: float = None) -> Optional[float]:
+        """Takes a token, returning the seconds to wait before using it, or
+        None, taking nothing, if that is longer than max_wait.
+
+        Tokens can be taken before they are available, so threads waiting
+        on the same bucket are spaced out rather than woken together.
+        """
+        with self._lock:
+            tokens = self._refill(time.monotonic())
+            wait = (1.0 - tokens) / self.rate if tokens < 1.0 else 0.0
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens = tokens - 1.0
+            return wait
+
+    def put_back(self):
+        """Returns a token taken for a message that was not sent."""
+        with self._lock:
+            self._tokens = min(self.burst, self._refill(time.monotonic()) + 1.0)
+
+    def _refill(self, now: float) -> float:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._tokens
+
+
+@dataclass(frozen=True)
+class FlowState:
+    """A snapshot of the back-pressure on publishers."""
+    blocked: bool
+    reason: Optional[str] = None  # why the broker blocked publishers
+    blocked_for: float = 0.0  # seconds since the broker blocked publishers
+    buffered: int = 0  # messages waiting for the broker to unblock
+    throttled: Tuple[str, ...] = ()  # rate limits out of tokens, as 'exchange:name' or 'event:name'
+
+    @property
+    def ok(self) -> bool:
+        """Whether a publish would go through without waiting."""
+        return not self.blocked and not self.buffered and not self.throttled
+
+
+class FlowControl:
+    """Rate limits and a blocked broker policy, shared by the publishers given it.
+
+    Args:
+        exchange_rates (Mapping[str, Rate], optional): Rate limits by exchange.
+        event_rates (Mapping[str, Rate], optional): Rate limits by event.
+        on_blocked (str, optional): What to do with publishes while the broker blocks the connection. Defaults to 'block'.
+        blocked_timeout (float, optional): Seconds the block policy waits for the broker. Defaults to BLOCKED_TIMEOUT.
+        buffer_size (int, optional): Messages the buffer policy holds. Defaults to BUFFER_SIZE.
+        max_wait (float, optional): Seconds to wait for a rate limit. If None then publishes wait as long as needed.
+        metrics (MetricsSink, optional): Sink for flow.blocked, flow.buffered and flow.wait.
+    """
+    BLOCKED_TIMEOUT: float = 30.0  # seconds
+    BUFFER_SIZE: int = 10_000  # messages
+    POLL_INTERVAL: float = 1.0  # seconds
+    WAIT_STEP: float = 0.1  # seconds
+
+    def __init__(self,
+                 *,
+                 exchange_rates: Mapping[str, Rate] = None,
+                 event_rates: Mapping[str, Rate] = None,
+                 on_blocked: str = BLOCK,
+                 blocked_timeout: float = None,
+                 buffer_size: int = None,
+                 max_wait: float = None,
+                 metrics: MetricsSink = None):
+        if on_blocked not in POLICIES:
+            raise ValueError(f'on_blocked must be one of {POLICIES}, got {on_blocked!r}')
+        self.on_blocked = on_blocked
+        self.blocked_timeout = self.BLOCKED_TIMEOUT if blocked_timeout is None else blocked_timeout
+        self.buffer_size = self.BUFFER_SIZE if buffer_size is None else buffer_size
+        self.max_wait = max_wait
+        self.metrics = metrics
+
+        self._exchange_buckets = {str(name): _bucket(rate)
+                                  for name, rate in (exchange_rates or {}).items()}
+        self._event_buckets = {str(name): _bucket(rate)
+                               for name, rate in (event_rates or {}).items()}
+
+        self._lock = threading.Lock()
+        # Blocked connections, with the reason given and when
+        self._blocked: Dict[object, Tuple[Optional[str], float]] = {}
+        # When each connection last read notifications
+        self._polled: Dict[object, float] = {}
+        self._buffer: Deque[Message] = deque()
+
+    @property
+    def blocked(self) -> bool:
+        """Whether the broker is blocking any connection of the publishers."""
+        return bool(self._blocked)
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def state(self) -> FlowState:
+        with self._lock:
+            blocked = list(self._blocked.values())
+            buffered = len(self._buffer)
+
+        throttled = tuple(
+            [f'exchange:{name}' for name, bucket in self._exchange_buckets.items()
+             if bucket.tokens < 1]
+            + [f'event:{name}' for name, bucket in self._event_buckets.items()
+               if bucket.tokens < 1])
+        if not blocked:
+            return FlowState(False, buffered=buffered, throttled=throttled)
+
+        reason, since = min(blocked, key=lambda entry: entry[1])
+        return FlowState(True, reason, time.monotonic() - since, buffered, throttled)
+
+    def attach(self, connection):
+        """Follows the blocked state of a connection, forgetting closed ones."""
+        with self._lock:
+            self._blocked = {conn: entry for conn, entry in self._blocked.items()
+                             if conn.is_open}
+            self._polled = {conn: polled for conn, polled in self._polled.items()
+                            if conn.is_open}
+            self._polled[connection] = time.monotonic()
+        connection.add_on_connection_blocked_callback(self._on_blocked)
+        connection.add_on_connection_unblocked_callback(self._on_unblocked)
+
+    def is_blocked(self, connection) -> bool:
+        return connection in self._blocked
+
+    def throttle(self, exchange: str, event: str):
+        """Waits for the rate limits of an exchange and event.
+
+        Raises:
+            RateLimitedError: A limit has no token within max_wait.
+        """
+        wait = 0.0
+        taken: List[TokenBucket] = []
+        for kind, name, bucket in (('exchange', exchange, self._exchange_buckets.get(exchange)),
+                                   ('event', event, self._event_buckets.get(event))):
+            if bucket is None:
+                continue
+            max_wait = None if self.max_wait is None else self.max_wait - wait
+            delay = bucket.take(max_wait)
+            if delay is None:
+                # A refused message uses none of the capacity of its other limit
+                for taken_bucket in taken:
+                    taken_bucket.put_back()
+                raise RateLimitedError(f'{kind} {name} is over its rate of {bucket.rate}/s')
+            taken.append(bucket)
+            wait = max(wait, delay)
+
+        if wait > 0:
+            time.sleep(wait)
+            if self.metrics is not None:
+                self.metrics.observe('flow.wait', wait, tags={
+                    'event': event, 'exchange': exchange, 'cause': 'rate'})
+
+    def admit(self, connection, messages: List[Message]) -> bool:
+        """Applies the blocked policy to messages about to be published on a
+        connection. Returns False if they were buffered rather than admitted.
+
+        Raises:
+            BrokerBlockedError: The messages were refused.
+        """
+        self._poll(connection)
+        if connection not in self._blocked:
+            return True
+
+        if self.on_blocked == BUFFER:
+            with self._lock:
+                if len(self._buffer) + len(messages) > self.buffer_size:
+                    raise BrokerBlockedError(
+                        f'broker is blocking publishers and the buffer of '
+                        f'{self.buffer_size} messages is full')
+                self._buffer.extend(_detached(message) for message in messages)
+            if self.metrics is not None:
+                self.metrics.increment('flow.buffered', len(messages))
+            return False
+
+        if self.on_blocked == FAIL:
+            raise BrokerBlockedError(
+                f'broker is blocking publishers: {self._blocked[connection][0]}')
+
+        self._wait_until_unblocked(connection)
+        return True
+
+    def pop_buffered(self) -> Optional[Message]:
+        try:
+            return self._buffer.popleft()
+        except IndexError:
+            return None
+
+    def restore_buffered(self, message: Message):
+        """Puts back a buffered message that failed to publish."""
+        self._buffer.appendleft(message)
+
+    def _wait_until_unblocked(self, connection):
+        started = time.monotonic()
+        deadline = started + self.blocked_timeout
+        while connection in self._blocked:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BrokerBlockedError(
+                    f'broker kept publishers blocked for {self.blocked_timeout}s: '
+                    f'{self._blocked.get(connection, (None,))[0]}')
+            connection.process_data_events(time_limit=min(remaining, self.WAIT_STEP))
+
+        if self.metrics is not None:
+            self.metrics.observe('flow.wait', time.monotonic() - started,
+                                 tags={'cause': 'blocked'})
+
+    def _poll(self, connection):
+        """Reads the notifications an idle connection has not read yet."""
+        now = time.monotonic()
+        if now - self._polled.get(connection, 0.0) > self.POLL_INTERVAL:
+            connection.process_data_events(0)
+        self._polled[connection] = now
+
+    def _on_blocked(self, connection, method_frame):
+        reason = getattr(method_frame.method, 'reason', None)
+        LOGGER.warning('broker blocked publishing: %s', reason)
+        with self._lock:
+            self._blocked.setdefault(connection, (reason, time.monotonic()))
+        if self.metrics is not None:
+            self.metrics.increment('flow.blocked', tags={'reason': reason})
+
+    def _on_unblocked(self, connection, method_frame):
+        LOGGER.info('broker unblocked publishing')
+        with self._lock:
+            self._blocked.pop(connection, None)
+
+
+def _detached(message: Message) -> Message:
+    """Copies the properties of a message kept for later, which callers
+    such as prepared emitters reuse for their next message."""
+    exchange, routing_key, properties, mandatory, body = message
+    properties = copy.copy(properties)
+    if properties.headers is not None:
+        properties.headers = dict(properties.headers)
+    return exchange, routing_key, properties, mandatory, body
+
+
+def _bucket(rate: Rate) -> TokenBucket:
+    if isinstance(rate, tuple):
+        return TokenBucket(*rate)
+    return TokenBucket(rate)
@@ -0,0 +1,450 @@
+"""A durable local outbox publishers can emit to while the broker is away.
+
+Messages are appended to a memory-mapped journal file and published by a
+background drainer thread, which truncates the journal as the broker
+confirms them. Delivery is at least once: messages published but not yet
+confirmed when the process dies, or when the drainer reconnects, are
+published again.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import List, Optional, Tuple
+
+import pika
+import pika.exceptions
+
+from asyncqx.core.metrics import MetricsSink
+from asyncqx.core.topology import Topology
+from asyncqx.transport.base import PikaTransport, Transport
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 64 * 1024 * 1024  # bytes
+
+_MAGIC = b'AQXJ'
+_VERSION = 1
+_HEADER = struct.Struct('>4sHxxQ')  # magic, version, head offset
+_HEADER_SIZE = 64
+_RECORD = struct.Struct('>II')  # payload length, payload crc32
+_ENTRY = struct.Struct('>?BBI')  # mandatory, exchange, routing key, properties lengths
+
+
+class OutboxFullError(Exception):
+    """Raised when a message does not fit in the outbox journal."""
+
+
+class OutboxStoppedError(Exception):
+    """Raised when waiting on an outbox whose drainer stopped on an error."""
+
+
+class Journal:
+    """An append-only journal of records in a fixed size memory-mapped file.
+
+    Records are length-prefixed and checksummed and live between a head,
+    stored in the file header, and a tail found by scanning from the head
+    when the file is opened, so a record torn by a crash is discarded.
+    Positions handed out by the journal are logical and keep growing when
+    truncated records are reclaimed, while the file never grows past its
+    capacity.
+
+    Appends only write to the page cache; they survive the process dying
+    but not the machine until `flush` is called.
+    """
+
+    def __init__(self, path: str, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size < capacity:
+                os.ftruncate(fd, capacity)
+                size = capacity
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.capacity = size
+        self._lock = threading.Condition()
+        # Logical positions are physical offsets plus the bytes reclaimed so far
+        self._reclaimed = 0
+
+        magic, version, head = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC:
+            self._head = self._tail = _HEADER_SIZE
+            self._write_end(_HEADER_SIZE)
+            self._write_head()
+        elif version != _VERSION:
+            self.close()
+            raise ValueError(f'unsupported outbox journal version {version}: {path}')
+        else:
+            self._head = head
+            self._tail = self._recover()
+
+    @property
+    def head(self) -> int:
+        """The position of the first record not yet truncated."""
+        return self._head + self._reclaimed
+
+    @property
+    def size(self) -> int:
+        """The bytes held by records not yet truncated."""
+        return self._tail - self._head
+
+    @property
+    def empty(self) -> bool:
+        return self._tail == self._head
+
+    def append(self, payload: bytes) -> int:
+        """Appends a record and returns the position following it.
+
+        Raises:
+            OutboxFullError: If the record does not fit, even after reclaiming
+                the space of truncated records.
+        """
+        size = _RECORD.size + len(payload)
+        with self._lock:
+            if self._tail + size + _RECORD.size > self.capacity:
+                self._compact()
+                if self._tail + size + _RECORD.size > self.capacity:
+                    raise OutboxFullError(
+                        f'outbox journal {self.path} is full: {self.size} of '
+                        f'{self.capacity} bytes pending')
+
+            start = self._tail
+            end = start + size
+            self._mmap[start + _RECORD.size:end] = payload
+            self._write_end(end)
+            # Written last, so the record only exists once it is complete
+            _RECORD.pack_into(self._mmap, start, len(payload), zlib.crc32(payload))
+
+            self._tail = end
+            self._lock.notify_all()
+            return end + self._reclaimed
+
+    def read(self, position: int, limit: int) -> List[Tuple[int, bytes]]:
+        """Returns up to `limit` records from a position as
+        (next position, payload) pairs."""
+        records = []
+        with self._lock:
+            offset = max(position - self._reclaimed, self._head)
+            while offset < self._tail and len(records) < limit:
+                length, _ = _RECORD.unpack_from(self._mmap, offset)
+                start = offset + _RECORD.size
+                offset = start + length
+                records.append((offset + self._reclaimed, self._mmap[start:offset]))
+        return records
+
+    def wait(self, position: int, timeout: float) -> bool:
+        """Waits until there are records past a position."""
+        with self._lock:
+            return self._lock.wait_for(
+                lambda: self._tail + self._reclaimed > position, timeout)
+
+    def truncate(self, position: int):
+        """Drops every record before a position."""
+        with self._lock:
+            head = position - self._reclaimed
+            if head <= self._head:
+                return
+            if head > self._tail:
+                raise ValueError(f'cannot truncate past the end of the journal: {position}')
+
+            if head == self._tail:
+                # Start over at the front of the file. The end marker goes in
+                # before the head moves, so the old records are never live again.
+                self._write_end(_HEADER_SIZE)
+                self._reclaimed += head - _HEADER_SIZE
+                self._head = self._tail = _HEADER_SIZE
+            else:
+                self._head = head
+            self._write_head()
+
+    def flush(self):
+        """Writes the journal through to disk."""
+        with self._lock:
+            self._mmap.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._mmap.closed:
+                self._mmap.flush()
+                self._mmap.close()
+
+    def _compact(self):
+        """Moves the pending records to the front of the file.
+
+        Only done when they fit in front of the current head, so the records
+        at the head stay intact until the header points at their copy.
+        """
+        pending = self._tail - self._head
+        if self._head < _HEADER_SIZE + pending + _RECORD.size:
+            return
+
+        LOGGER.debug('compacting outbox journal %s: %s bytes pending', self.path, pending)
+        self._mmap.move(_HEADER_SIZE, self._head, pending)
+        self._write_end(_HEADER_SIZE + pending)
+        self._reclaimed += self._head - _HEADER_SIZE
+        self._head = _HEADER_SIZE
+        self._tail = _HEADER_SIZE + pending
+        self._write_head()
+
+    def _recover(self) -> int:
+        """Finds the end of the last complete record after the head."""
+        offset = self._head
+        records = 0
+        while offset + _RECORD.size <= self.capacity:
+            length, crc = _RECORD.unpack_from(self._mmap, offset)
+            end = offset + _RECORD.size + length
+            if length == 0 or end + _RECORD.size > self.capacity:
+                break
+            if zlib.crc32(self._mmap[offset + _RECORD.size:end]) != crc:
+                LOGGER.warning('discarding torn record at offset %s of outbox journal %s',
+                               offset, self.path)
+                break
+            offset = end
+            records += 1
+
+        if records:
+            LOGGER.info('recovered %s unpublished messages from outbox journal %s',
+                        records, self.path)
+        self._write_end(offset)
+        return offset
+
+    def _write_end(self, offset: int):
+        _RECORD.pack_into(self._mmap, offset, 0, 0)
+
+    def _write_head(self):
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, _VERSION, self._head)
+
+
+def encode_entry(exchange: str, routing_key: str, properties: pika.BasicProperties,
+                 mandatory: bool, body: bytes) -> bytes:
+    exchange_bytes = exchange.encode()
+    routing_key_bytes = routing_key.encode()
+    props = b''.join(properties.encode())
+    return b''.join((
+        _ENTRY.pack(mandatory, len(exchange_bytes), len(routing_key_bytes), len(props)),
+        exchange_bytes, routing_key_bytes, props, body))
+
+
+def decode_entry(payload: bytes) -> Tuple[str, str, pika.BasicProperties, bool, bytes]:
+    mandatory, exchange_length, routing_key_length, props_length = \
+        _ENTRY.unpack_from(payload, 0)
+    offset = _ENTRY.size
+    exchange = payload[offset:offset + exchange_length].decode()
+    offset += exchange_length
+    routing_key = payload[offset:offset + routing_key_length].decode()
+    offset += routing_key_length
+    properties = pika.BasicProperties()
+    properties.decode(payload[offset:offset + props_length])
+    offset += props_length
+    return exchange, routing_key, properties, mandatory, payload[offset:]
+
+
+class Outbox:
+    """A journal of messages and the thread publishing them to the broker.
+
+    `append` takes the same arguments as AQXPublisher._publish and returns
+    as soon as the message is in the journal. The drainer publishes journal
+    entries in order on a single channel of its own connection, waits for
+    their confirms in batches and truncates the journal up to the first
+    message not yet acked. A nacked message, and every message after it, is
+    published again, so messages with the same routing key reach the broker
+    in the order they were emitted, after a backoff growing from NACK_DELAY
+    to RETRY_DELAY while the broker keeps nacking. Unroutable messages are
+    logged and dropped, as the broker will not route them on a second try
+    either.
+
+    An unexpected error, such as a journal entry that cannot be decoded,
+    stops the drainer. It is kept in `error`, and raised by
+    `wait_until_drained` as an OutboxStoppedError.
+
+    The journal is flushed to disk every `flush_interval` seconds; appends in
+    between survive the process crashing but not the machine.
+    """
+    BATCH_SIZE = 500
+    RETRY_DELAY = 5  # seconds
+    NACK_DELAY = 0.1  # seconds
+    POLL_INTERVAL = 0.5  # seconds
+
+    def __init__(self,
+                 path: str,
+                 amqp_url: str = None,
+                 *,
+                 capacity: int = DEFAULT_CAPACITY,
+                 transport: Transport = None,
+                 metrics: MetricsSink = None,
+                 flush_interval: float = 1.0):
+        self.journal = Journal(path, capacity)
+        self.metrics = metrics
+        self.flush_interval = flush_interval
+
+        self._url = amqp_url
+        self._transport = transport or PikaTransport()
+        self._topology = Topology()
+        self._connection = None
+        self._channel = None
+
+        self.error: Optional[BaseException] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._drained = threading.Condition()
+
+    def __len__(self) -> int:
+        return self.journal.size
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def append(self, exchange: str, routing_key: str,
+               properties: pika.BasicProperties,
+               mandatory: bool, data: bytes) -> None:
+        self.journal.append(
+            encode_entry(exchange, routing_key, properties, mandatory, data))
+
+    def start(self):
+        """Starts the drainer thread, publishing anything left in the journal
+        by a previous run first."""
+        if self.running:
+            return
+        self._stopping.clear()
+        self.error = None
+        self._thread = threading.Thread(
+            target=self._run, name=f'asyncqx-outbox-{os.path.basename(self.journal.path)}',
+            daemon=True)
+        self._thread.start()
+
+    def wait_until_drained(self, timeout: float = None) -> bool:
+        """Blocks until every appended message has been confirmed.
+
+        Raises:
+            OutboxStoppedError: The drainer stopped on an error.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        with self._drained:
+            self._drained.wait_for(
+                lambda: self.journal.empty or self.error is not None, timeout)
+        if self.error is not None:
+            raise OutboxStoppedError(
+                f'outbox {self.journal.path} stopped draining: {self.error!r}') from self.error
+        return self.journal.empty
+
+    def close(self, timeout: float = None):
+        """Stops the drainer and closes the journal. Messages not yet
+        published stay in the journal for the next run."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.journal.close()
+
+    def _run(self):
+        try:
+            self._drain()
+        except Exception as err:
+            LOGGER.exception('outbox stopped draining journal %s', self.journal.path)
+            self.error = err
+            with self._drained:
+                self._drained.notify_all()
+        finally:
+            self._disconnect()
+
+    def _drain(self):
+        LOGGER.info('draining outbox journal %s', self.journal.path)
+        position = self.journal.head
+        flushed = time.monotonic()
+        nack_delay = self.NACK_DELAY
+
+        while not self._stopping.is_set():
+            if time.monotonic() - flushed >= self.flush_interval:
+                self.journal.flush()
+                flushed = time.monotonic()
+
+            entries = self.journal.read(position, self.BATCH_SIZE)
+            if not entries:
+                self.journal.wait(position, min(self.POLL_INTERVAL, self.flush_interval))
+                continue
+
+            try:
+                position, nacked = self._publish_batch(entries)
+            except pika.exceptions.AMQPError as err:
+                LOGGER.warning('outbox failed to publish, retrying in %ss: %r',
+                               self.RETRY_DELAY, err)
+                self._disconnect()
+                self._stopping.wait(self.RETRY_DELAY)
+                continue
+
+            self.journal.truncate(position)
+            with self._drained:
+                self._drained.notify_all()
+
+            if nacked:
+                # Backs off before publishing the nacked message again
+                self._stopping.wait(nack_delay)
+                nack_delay = min(nack_delay * 2, self.RETRY_DELAY)
+            else:
+                nack_delay = self.NACK_DELAY
+
+        LOGGER.info('stopped draining outbox journal %s', self.journal.path)
+
+    def _publish_batch(self, entries: List[Tuple[int, bytes]]) -> Tuple[int, bool]:
+        """Publishes entries and returns the position up to which they were
+        confirmed, and whether the broker nacked the message there."""
+        channel = self._ensure_channel()
+        messages = [decode_entry(payload) for _, payload in entries]
+
+        self._topology.ensure_exchanges(
+            channel.channel, {message[0] for message in messages})
+
+        delivery_tags = [
+            channel.publish(exchange, routing_key, data, props, mandatory)
+            for exchange, routing_key, props, mandatory, data in messages]
+        outcomes = channel.wait_for_confirms()
+
+        position = self.journal.head
+        for delivery_tag, (end, _), (exchange, routing_key, *_) in zip(
+                delivery_tags, entries, messages):
+            error = outcomes.get(delivery_tag)
+            tags = {'event': routing_key, 'exchange': exchange}
+
+            if isinstance(error, pika.exceptions.NackError):
+                LOGGER.warning('outbox message %s to exchange %s was nacked, '
+                               'publishing it again', routing_key, exchange)
+                if self.metrics is not None:
+                    self.metrics.increment('outbox.nack', tags=tags)
+                return position, True
+
+            if error is not None:
+                LOGGER.warning('dropping unroutable outbox message %s to exchange %s',
+                               routing_key, exchange)
+            if self.metrics is not None:
+                self.metrics.increment(
+                    'outbox.unroutable' if error else 'outbox.published', tags=tags)
+            position = end
+
+        return position, False
+
+    def _ensure_channel(self):
+        if self._channel is None or not self._channel.is_open:
+            self._disconnect()
+            self._connection = self._transport.connect(self._url)
+            self._channel = self._transport.pipelined_channel(self._connection)
+            self._topology.apply(self._channel.channel)
+        return self._channel
+
+    def _disconnect(self):
+        connection, self._connection, self._channel = self._connection, None, None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except Exception:
+                pass
@@ -0,0 +1,255 @@
+"""A bounded pool of publishers shared between threads."""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+from asyncqx.core.metrics import MetricsSink
+from asyncqx.core.sharding import PartitionKey
+from asyncqx.core.types import Serializer, Stringable
+from asyncqx.publisher.flow import FlowControl
+from asyncqx.publisher.publisher import AQXPublisher
+from asyncqx.publisher.types import EmitReport
+from asyncqx.transport.base import Transport
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AQXPublisherPool:
+    """Lends AQXPublisher clients, each owning a connection and its confirm
+    channel, to one thread at a time.
+
+    Pika connections must not be shared between threads, so every thread
+    emitting through the pool checks out a publisher of its own. Publishers
+    are created on demand up to max_size, which bounds the connections the
+    pool opens however many threads emit; beyond it, checkouts wait for a
+    publisher to be returned. The most recently returned publisher is lent
+    first, so publishers left idle for idle_timeout are closed, by a timer
+    if the pool is not used again.
+
+    Idle connections do not service heartbeats, so a publisher idle for
+    longer than health_check_interval has its connection polled before it
+    is lent, and is replaced if the broker dropped it.
+    """
+    MAX_SIZE: int = 8
+    IDLE_TIMEOUT: float = 30.0  # seconds
+    HEALTH_CHECK_INTERVAL: float = 5.0  # seconds
+    CHECKOUT_TIMEOUT: float = 5.0  # seconds
+
+    def __init__(self,
+                 name: str,
+                 amqp_url: str = None,
+                 *,
+                 max_size: int = None,
+                 idle_timeout: float = None,
+                 health_check_interval: float = None,
+                 checkout_timeout: float = None,
+                 default_exchange=None,
+                 default_serializer: Serializer = None,
+                 transport: Transport = None,
+                 metrics: MetricsSink = None,
+                 stamp_publish_time: bool = False,
+                 shards: Mapping[Stringable, int] = None,
+                 partition_key: Union[str, PartitionKey] = None,
+                 flow_control: FlowControl = None):
+        self.max_size = max_size or self.MAX_SIZE
+        if self.max_size < 1:
+            raise ValueError(f'max_size must be at least 1, got {self.max_size}')
+        self.idle_timeout = self.IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.health_check_interval = (self.HEALTH_CHECK_INTERVAL
+                                      if health_check_interval is None else health_check_interval)
+        self.checkout_timeout = (self.CHECKOUT_TIMEOUT
+                                 if checkout_timeout is None else checkout_timeout)
+        self.metrics = metrics
+        # Shared by every publisher, so rate limits apply to the pool as a whole
+        self.flow_control = flow_control
+
+        self._name = name
+        self._url = amqp_url
+        self._options = dict(default_exchange=default_exchange,
+                             default_serializer=default_serializer,
+                             transport=transport,
+                             metrics=metrics,
+                             stamp_publish_time=stamp_publish_time,
+                             shards=shards,
+                             partition_key=partition_key,
+                             flow_control=flow_control)
+
+        self._lock = threading.Condition()
+        self._idle: Deque[Tuple[AQXPublisher, float]] = deque()
+        self._size = 0
+        self._closed = False
+        self._eviction: Optional[threading.Timer] = None
+
+    def __len__(self) -> int:
+        """The number of publishers open, lent or idle."""
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    @contextmanager
+    def checkout(self, timeout: float = None) -> Iterator[AQXPublisher]:
+        """Lends a publisher for the duration of the with block.
+
+        Args:
+            timeout (float, optional): Seconds to wait for a publisher when all max_size are lent.
+                If None then checkout_timeout is used.
+
+        Raises:
+            TimeoutError: No publisher was returned in time.
+        """
+        publisher = self._acquire(self.checkout_timeout if timeout is None else timeout)
+        try:
+            yield publisher
+        finally:
+            self._release(publisher)
+
+    def emit(self,
+             event: Stringable,
+             payload: object,
+             *,
+             mandatory=False,
+             correlation_id=None,
+             headers: object = None,
+             exchange: Stringable = None,
+             serializer: Serializer = None) -> None:
+        """Emits an event like `AQXPublisher.emit` on a pooled publisher."""
+        with self.checkout() as publisher:
+            publisher.emit(event, payload, mandatory=mandatory, correlation_id=correlation_id,
+                           headers=headers, exchange=exchange, serializer=serializer)
+
+    def emit_many(self,
+                  emissions: Iterable[Tuple],
+                  *,
+                  mandatory=False,
+                  headers: object = None,
+                  exchange: Stringable = None,
+                  serializer: Serializer = None) -> EmitReport:
+        """Emits events like `AQXPublisher.emit_many` on a pooled publisher."""
+        with self.checkout() as publisher:
+            return publisher.emit_many(emissions, mandatory=mandatory, headers=headers,
+                                       exchange=exchange, serializer=serializer)
+
+    def close(self):
+        """Closes the idle publishers, and lent ones as they are returned."""
+        with self._lock:
+            self._closed = True
+            idle = [publisher for publisher, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            if self._eviction is not None:
+                self._eviction.cancel()
+                self._eviction = None
+            self._lock.notify_all()
+        self._close_all(idle)
+
+    def _acquire(self, timeout: float) -> AQXPublisher:
+        deadline = time.monotonic() + timeout
+        started = time.perf_counter() if self.metrics is not None else 0.0
+
+        evicted: List[AQXPublisher] = []
+        try:
+            with self._lock:
+                evicted = self._evict_idle()
+                while True:
+                    if self._closed:
+                        raise RuntimeError('publisher pool is closed')
+                    if self._idle:
+                        publisher, returned = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        publisher, returned = None, None
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            f'no publisher was returned to the pool within {timeout}s')
+                    self._lock.wait(remaining)
+        finally:
+            # Closing can wait on the broker, so it is done outside the lock
+            self._close_all(evicted)
+
+        if self.metrics is not None:
+            self.metrics.observe('pool.wait', time.perf_counter() - started)
+
+        if publisher is not None and (
+                time.monotonic() - returned < self.health_check_interval
+                or self._is_healthy(publisher, poll=True)):
+            return publisher
+
+        if publisher is not None:
+            LOGGER.info('replacing unhealthy pooled publisher')
+            self._close_all([publisher])
+        return AQXPublisher(self._name, self._url, **self._options)
+
+    def _release(self, publisher: AQXPublisher):
+        healthy = self._is_healthy(publisher)
+        with self._lock:
+            evicted = self._evict_idle()
+            if healthy and not self._closed:
+                self._idle.append((publisher, time.monotonic()))
+                self._schedule_eviction()
+            else:
+                self._size -= 1
+                evicted.append(publisher)
+            self._lock.notify()
+        self._close_all(evicted)
+
+    def _schedule_eviction(self):
+        """Starts a timer evicting the oldest idle publisher once it expires,
+        unless one is pending. Must be called holding the lock."""
+        if self._eviction is not None or not self._idle:
+            return
+        delay = max(0.0, self._idle[0][1] + self.idle_timeout - time.monotonic())
+        self._eviction = threading.Timer(delay, self._evict_on_timer)
+        self._eviction.daemon = True
+        self._eviction.start()
+
+    def _evict_on_timer(self):
+        with self._lock:
+            self._eviction = None
+            if self._closed:
+                return
+            evicted = self._evict_idle()
+            self._schedule_eviction()
+        self._close_all(evicted)
+
+    def _evict_idle(self) -> List[AQXPublisher]:
+        """Takes the publishers idle for longer than idle_timeout off the pool.
+        Must be called holding the lock."""
+        evicted = []
+        expired = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] <= expired:
+            evicted.append(self._idle.popleft()[0])
+        self._size -= len(evicted)
+        if evicted and self.metrics is not None:
+            self.metrics.increment('pool.evicted', len(evicted))
+        return evicted
+
+    @staticmethod
+    def _is_healthy(publisher: AQXPublisher, poll: bool = False) -> bool:
+        """Whether the publisher's connection and channel are usable. Polling
+        the connection surfaces a connection the broker dropped while idle."""
+        connection, channel = publisher._connection, publisher._channel
+        if connection is None:
+            return True
+        if not connection.is_open or (channel is not None and not channel.is_open):
+            return False
+        if poll:
+            try:
+                connection.process_data_events(time_limit=0)
+            except Exception as err:
+                LOGGER.info('pooled publisher connection failed its health check: %s', err)
+                return False
+        return True
+
+    @staticmethod
+    def _close_all(publishers: List[AQXPublisher]):
+        for publisher in publishers:
+            publisher.close()
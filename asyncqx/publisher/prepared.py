@@ -0,0 +1,78 @@
+"""Emitters reusing the properties built once for a high-volume event."""
+import time
+
+import pika
+
+from asyncqx.core.latency import PUBLISH_TIME_HEADER
+from asyncqx.core.message_ids import next_message_id
+from asyncqx.core.serializers import EncodedMessage
+from asyncqx.core.types import Serializer
+
+
+class PreparedEmitter:
+    """Emits one event type with everything but the payload resolved up front.
+
+    Returned by AQXPublisher.prepare. The routing key, exchange, serializer
+    and a properties template are computed once; each call encodes the
+    payload, refreshes the per-message properties and publishes, skipping
+    the default resolution, string conversion and logging done by `emit`.
+
+    The properties template is reused between calls, so, like its
+    publisher, a prepared emitter must only be used from one thread.
+    """
+    __slots__ = ('publisher', 'event', 'exchange', 'serializer', 'mandatory',
+                 '_props', '_encode_message', '_content_encoding', '_sharded')
+
+    def __init__(self, publisher, event: str, exchange: str,
+                 serializer: Serializer, mandatory: bool, headers):
+        self.publisher = publisher
+        self.event = event
+        self.exchange = exchange
+        self.serializer = serializer
+        self.mandatory = mandatory
+        self._sharded = event in publisher.shards
+
+        self._encode_message = getattr(serializer, 'encode_message', None)
+        self._content_encoding = getattr(serializer, 'content_encoding', None)
+        self._props: pika.BasicProperties = publisher._build_properties(
+            event, mandatory, None, dict(headers) if headers else None,
+            getattr(serializer, 'content_type', None), self._content_encoding)
+
+    def __call__(self, payload: object, *, correlation_id=None) -> None:
+        publisher = self.publisher
+
+        if self._encode_message is None:
+            encoded = EncodedMessage(self.serializer.encode(payload), None,
+                                     self._content_encoding)
+        else:
+            encoded = self._encode_message(payload)
+
+        props = self._props
+        props.message_id = next_message_id()
+        props.timestamp = int(time.time())
+        props.content_encoding = encoded.content_encoding
+        props.correlation_id = str(correlation_id) if correlation_id else None
+        if publisher.stamp_publish_time:
+            if props.headers is None:
+                props.headers = {}
+            props.headers[PUBLISH_TIME_HEADER] = time.time_ns()
+
+        routing_key = publisher._routing_key(self.event, props) if self._sharded else self.event
+        publish = publisher._sender()
+        metrics = publisher.metrics
+        if metrics is None:
+            publish(self.exchange, routing_key, props, self.mandatory, encoded.body)
+            return
+
+        tags = {'event': self.event, 'exchange': self.exchange}
+        started = time.perf_counter()
+        try:
+            publish(self.exchange, routing_key, props, self.mandatory, encoded.body)
+        except Exception as err:
+            metrics.increment('emit.error', tags=dict(tags, error=type(err).__name__))
+            raise
+        metrics.increment('emit', tags=tags)
+        metrics.observe('emit.latency', time.perf_counter() - started, tags=tags)
+
+    def __repr__(self) -> str:
+        return f'<PreparedEmitter event={self.event} exchange={self.exchange}>'
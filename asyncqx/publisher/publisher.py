@@ -1,12 +1,30 @@
+import itertools
 import logging
 import time
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Mapping, Tuple, Union
 
 import pika
 import pika.exceptions
 from retry import retry
 
 from asyncqx.core.base import AQXBase, JSONSerializer
+from asyncqx.core.latency import stamp_publish_time
+from asyncqx.core.message_ids import next_message_id
+from asyncqx.core.metrics import MetricsSink, count_retries
+from asyncqx.core.rpc import (DIRECT_REPLY_TO, ReplyRouter, decode_reply,
+                              request_properties)
+from asyncqx.core.serializers import encode_message
+from asyncqx.core.sharding import (PartitionKey, resolve_partition_key, shard_for,
+                                   shard_routing_key)
+from asyncqx.core.topology import Topology
 from asyncqx.core.types import Serializer, Stringable
+from asyncqx.core.confirms import PipelinedConfirmChannel
+from asyncqx.publisher.flow import FlowControl
+from asyncqx.publisher.outbox import Outbox
+from asyncqx.publisher.prepared import PreparedEmitter
+from asyncqx.publisher.types import EmitReport, EmitResult
+from asyncqx.transport.base import Transport
 
 LOGGER = logging.getLogger(__name__)
 
@@ -14,20 +32,58 @@ LOGGER = logging.getLogger(__name__)
 class AQXPublisher (AQXBase):
     MAX_TRIES: int = 5
     RETRY_DELAY: int = 0
+    CALL_TIMEOUT: float = 5.0  # seconds
 
     def __init__(self,
                  name: str,
                  amqp_url: str = None,
                  *,
                  default_exchange=None,
-                 default_serializer: Serializer = None):
-        super().__init__(amqp_url)
+                 default_serializer: Serializer = None,
+                 transport: Transport = None,
+                 metrics: MetricsSink = None,
+                 stamp_publish_time: bool = False,
+                 topology: Topology = None,
+                 outbox: Union[str, Outbox] = None,
+                 shards: Mapping[Stringable, int] = None,
+                 partition_key: Union[str, PartitionKey] = None,
+                 flow_control: FlowControl = None):
+        super().__init__(amqp_url, transport=transport, metrics=metrics,
+                         topology=topology)
 
         self.name = str(name)
+        self.stamp_publish_time = stamp_publish_time
+
+        # Sharded events are routed to one of their shard queues, bound by
+        # AQXSubscriber.bind(shards=...), by a consistent hash of the
+        # message's partition key. Messages without a key take turns.
+        self.shards: Dict[str, int] = {str(event): count for event, count in (shards or {}).items()}
+        self.partition_key = resolve_partition_key(partition_key)
+        self._next_shard = itertools.count()
+
+        # Flow control rate limits publishes and decides what happens to
+        # them while the broker blocks the connection. It is not applied in
+        # outbox mode, where emitting never waits on the broker.
+        if flow_control is not None and outbox is not None:
+            raise ValueError('flow_control cannot be combined with an outbox')
+        self.flow_control = flow_control
+
+        # In outbox mode messages are appended to a local journal and
+        # published by the outbox's drainer thread, so emitting never waits
+        # on the broker and unroutable mandatory messages are only logged.
+        if isinstance(outbox, str):
+            outbox = Outbox(outbox, amqp_url, transport=transport, metrics=metrics)
+        self.outbox = outbox
+        if outbox is not None:
+            outbox.start()
 
         self.default_exchange = default_exchange or 'asyncqx'
         self.default_serializer = default_serializer or JSONSerializer()
 
+        self._batch_channel: PipelinedConfirmChannel = None
+        self._rpc_channel = None
+        self._replies: ReplyRouter[Future] = ReplyRouter()
+
     def emit(self,
              event: Stringable,
              payload: object,
@@ -43,29 +99,448 @@ class AQXPublisher (AQXBase):
 
         LOGGER.info('emitting event: event=%s exchange=%s', event, exchange)
 
-        props = pika.BasicProperties(
+        encoded = encode_message(serializer, payload)
+        props = self._build_properties(event, mandatory, correlation_id, headers,
+                                       encoded.content_type, encoded.content_encoding)
+        data = encoded.body
+
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        publish = self._sender()
+        try:
+            publish(str(exchange),
+                    routing_key=self._routing_key(str(event), props) if self.shards else str(event),
+                    properties=props,
+                    mandatory=mandatory,
+                    data=data)
+        except Exception as err:
+            if metrics is not None:
+                metrics.increment('emit.error', tags={
+                    'event': event, 'exchange': exchange, 'error': type(err).__name__})
+            raise
+
+        if metrics is not None:
+            tags = {'event': event, 'exchange': exchange}
+            metrics.increment('emit', tags=tags)
+            metrics.observe('emit.latency', time.perf_counter() - started, tags=tags)
+
+    def prepare(self,
+                event: Stringable,
+                *,
+                mandatory=False,
+                headers: object = None,
+                exchange: Stringable = None,
+                serializer: Serializer = None) -> PreparedEmitter:
+        """Prepare an emitter for a single event type.
+
+        The returned callable takes the payload, and optionally a
+        correlation_id, and publishes it like `emit` with the arguments
+        given here, but with the per-call setup done once up front.
+
+        Args:
+            event (Stringable): The event to emit.
+            mandatory (bool, optional): Whether messages must be routed to a queue. Defaults to False.
+            headers (object, optional): Headers sent with every message.
+            exchange (Stringable, optional): The exchange to publish to. If None then the default is used.
+            serializer (Serializer, optional): The serializer to encode payloads with. If None then the default is used.
+
+        Returns:
+            PreparedEmitter: A callable emitting the event with a payload.
+        """
+        return PreparedEmitter(self,
+                               str(event),
+                               str(exchange or self.default_exchange),
+                               serializer or self.default_serializer,
+                               mandatory,
+                               headers)
+
+    def emit_many(self,
+                  emissions: Iterable[Tuple],
+                  *,
+                  mandatory=False,
+                  headers: object = None,
+                  exchange: Stringable = None,
+                  serializer: Serializer = None) -> EmitReport:
+        """Emit many events, waiting once for all of their broker confirms.
+
+        Every payload is serialized up front, all messages are published
+        without waiting on their confirms, and then the outstanding confirms
+        are awaited together. Unroutable and nacked messages are reported
+        rather than raised.
+
+        Args:
+            emissions (Iterable[Tuple]): (event, payload) or (event, payload, options) tuples. options is a mapping of emit keyword arguments overriding the defaults below.
+            mandatory (bool, optional): Default mandatory flag. Defaults to False.
+            headers (object, optional): Default message headers.
+            exchange (Stringable, optional): Default exchange. If None then the publisher default is used.
+            serializer (Serializer, optional): Default serializer. If None then the publisher default is used.
+
+        Raises:
+            ValueError: options has a key that is not one of the defaults.
+
+        Returns:
+            EmitReport: The result of each message, in the order given.
+        """
+        defaults = {
+            'mandatory': mandatory,
+            'correlation_id': None,
+            'headers': headers,
+            'exchange': exchange or self.default_exchange,
+            'serializer': serializer or self.default_serializer,
+        }
+
+        messages: List[Tuple[str, str, pika.BasicProperties, bool, bytes]] = []
+        for emission in emissions:
+            event, payload, *rest = emission
+            if rest:
+                unknown = set(rest[0]) - set(defaults)
+                if unknown:
+                    raise ValueError(f'unknown emit options for {event}: '
+                                     f'{", ".join(sorted(map(str, unknown)))}')
+            options = dict(defaults, **rest[0]) if rest else defaults
+
+            encoded = encode_message(
+                options['serializer'] or self.default_serializer, payload)
+            props = self._build_properties(
+                event, options['mandatory'], options['correlation_id'],
+                options['headers'], encoded.content_type, encoded.content_encoding)
+            data = encoded.body
+            routing_key = str(event)
+            if self.shards:
+                routing_key = self._routing_key(routing_key, props)
+            messages.append((str(options['exchange'] or self.default_exchange),
+                             routing_key, props, bool(options['mandatory']), data))
+
+        LOGGER.info('emitting %s events', len(messages))
+
+        if self.outbox is not None:
+            return self._append_to_outbox(messages)
+
+        flow = self.flow_control
+        if flow is not None:
+            for exchange_name, unused_routing_key, props, *_ in messages:
+                flow.throttle(exchange_name, props.type)
+            self._ensure_connection()
+            if not flow.admit(self._connection, messages):
+                return self._report_accepted(messages)
+            if flow.buffered:
+                self._publish_buffered()
+
+        channel = self._ensure_batch_channel()
+
+        self.topology.ensure_exchanges(
+            channel.channel, {message[0] for message in messages})
+
+        delivery_tags = [
+            channel.publish(exchange_name, routing_key, data, props, is_mandatory)
+            for exchange_name, routing_key, props, is_mandatory, data in messages]
+
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+
+        outcomes = channel.wait_for_confirms()
+
+        report = EmitReport([
+            EmitResult(index=index,
+                       event=props.type,
+                       exchange=exchange_name,
+                       error=outcomes.get(delivery_tag))
+            for index, (delivery_tag, (exchange_name, unused_routing_key, props, *_))
+            in enumerate(zip(delivery_tags, messages))])
+
+        if metrics is not None:
+            metrics.observe('confirm.latency', time.perf_counter() - started,
+                            tags={'batch': True})
+            self._record_report(metrics, report)
+
+        return report
+
+    def close(self):
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.flow_control is not None and self.flow_control.buffered:
+            self._flush_on_close()
+        super().close()
+
+    def _append_to_outbox(self, messages) -> EmitReport:
+        for exchange_name, routing_key, props, is_mandatory, data in messages:
+            self.outbox.append(exchange_name, routing_key, props, is_mandatory, data)
+        return self._report_accepted(messages)
+
+    def _report_accepted(self, messages) -> EmitReport:
+        """Reports messages handed on to be published later as emitted."""
+        report = EmitReport([
+            EmitResult(index=index, event=props.type, exchange=exchange_name)
+            for index, (exchange_name, unused_routing_key, props, *_) in enumerate(messages)])
+        if self.metrics is not None:
+            self._record_report(self.metrics, report)
+        return report
+
+    def call(self,
+             event: Stringable,
+             payload: object,
+             *,
+             timeout: float = None,
+             headers: object = None,
+             exchange: Stringable = None,
+             serializer: Serializer = None) -> object:
+        """Send a request to a handler bound with bind_rpc and wait for its reply.
+
+        Requests are published on a channel of their own, without publisher
+        confirms, and replies come back over the direct reply-to pseudo-queue,
+        so a call costs one round trip to the handler and no declarations.
+
+        Args:
+            event (Stringable): The event to send the request as.
+            payload (object): The request payload.
+            timeout (float, optional): Seconds to wait for the reply. If None then CALL_TIMEOUT is used.
+            headers (object, optional): The request headers.
+            exchange (Stringable, optional): The exchange to publish to. If None then the default is used.
+            serializer (Serializer, optional): The serializer for the request and reply. If None then the default is used.
+
+        Raises:
+            TimeoutError: No reply arrived in time.
+            RpcError: The handler failed.
+            pika.exceptions.UnroutableError: No queue is bound for the event.
+
+        Returns:
+            object: The decoded reply.
+        """
+        return self.call_many([(event, payload)], timeout=timeout, headers=headers,
+                              exchange=exchange, serializer=serializer)[0]
+
+    def call_many(self,
+                  calls: Iterable[Tuple],
+                  *,
+                  timeout: float = None,
+                  headers: object = None,
+                  exchange: Stringable = None,
+                  serializer: Serializer = None,
+                  return_exceptions: bool = False) -> List[object]:
+        """Send many requests at once and wait for all of their replies.
+
+        Args:
+            calls (Iterable[Tuple]): (event, payload) tuples.
+            timeout (float, optional): Seconds to wait for every reply. If None then CALL_TIMEOUT is used.
+            return_exceptions (bool, optional): Return the errors of failed calls in place of their
+                replies rather than raising the first of them. Defaults to False.
+
+        Returns:
+            List[object]: The decoded replies, in the order the calls were given.
+        """
+        timeout = self.CALL_TIMEOUT if timeout is None else timeout
+        exchange = str(exchange or self.default_exchange)
+        serializer = serializer or self.default_serializer
+
+        channel = self._ensure_rpc_channel()
+        self.topology.ensure_exchange(channel, exchange)
+
+        started = time.perf_counter()
+        requests: List[Tuple[str, str, Future]] = []
+        results = []
+        try:
+            for event, payload in calls:
+                encoded = encode_message(serializer, payload)
+                future: Future = Future()
+                correlation_id = self._replies.add(future)
+                requests.append((str(event), correlation_id, future))
+                props = request_properties(
+                    self._build_properties(event, False, None, headers,
+                                           encoded.content_type, encoded.content_encoding),
+                    correlation_id, timeout)
+                channel.basic_publish(exchange, str(event), encoded.body, props, mandatory=True)
+
+            LOGGER.info('waiting for %s replies', len(requests))
+            self._wait_for_replies([future for *_, future in requests], started + timeout)
+
+            for event, correlation_id, future in requests:
+                try:
+                    if not future.done():
+                        raise TimeoutError(f'no reply to {event} within {timeout}s')
+                    props, body = future.result()
+                    results.append(decode_reply(props, body, serializer))
+                except Exception as err:
+                    if self.metrics is not None:
+                        self.metrics.increment('rpc.error', tags={
+                            'event': event, 'exchange': exchange, 'error': type(err).__name__})
+                    if not return_exceptions:
+                        raise
+                    results.append(err)
+        finally:
+            # Replies that never arrived would otherwise stay pending until
+            # the call channel closes
+            for unused_event, correlation_id, future in requests:
+                if not future.done():
+                    self._replies.discard(correlation_id)
+
+        if self.metrics is not None:
+            self.metrics.observe('rpc.latency', time.perf_counter() - started,
+                                 tags={'exchange': exchange, 'batch': len(requests) > 1})
+        return results
+
+    def _ensure_rpc_channel(self):
+        """Returns the channel calls are made on, consuming its direct
+        reply-to pseudo-queue when it is opened."""
+        self._ensure_connection()
+
+        if self._rpc_channel is None or not self._rpc_channel.is_open:
+            self._replies.fail_all(pika.exceptions.ChannelClosed(
+                0, 'call channel closed before the reply arrived'))
+            LOGGER.info('opening call channel')
+            self._rpc_channel = self._connection.channel()
+            self._rpc_channel.add_on_return_callback(self._replies.on_returned)
+            self._rpc_channel.basic_consume(
+                DIRECT_REPLY_TO, self._replies.on_reply, auto_ack=True)
+
+        return self._rpc_channel
+
+    def _wait_for_replies(self, futures: List[Future], deadline: float):
+        for future in futures:
+            while not future.done():
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return
+                self._connection.process_data_events(time_limit=remaining)
+
+    @staticmethod
+    def _record_report(metrics, report: EmitReport):
+        for result in report.results:
+            tags = {'event': result.event, 'exchange': result.exchange}
+            if result.ok:
+                metrics.increment('emit', tags=tags)
+            else:
+                tags['error'] = type(result.error).__name__
+                metrics.increment('emit.error', tags=tags)
+
+    def _routing_key(self, event: str, props: pika.BasicProperties) -> str:
+        """Returns the routing key of the shard a sharded event is sent to."""
+        shards = self.shards.get(event)
+        if shards is None:
+            return event
+
+        try:
+            key = self.partition_key(props)
+        except Exception as error:
+            LOGGER.warning('partition key of %s failed, sending it to any shard: %s', event, error)
+            key = None
+        if key is None:
+            return shard_routing_key(event, next(self._next_shard) % shards)
+        return shard_routing_key(event, shard_for(key, shards))
+
+    def _build_properties(self, event: Stringable, mandatory: bool,
+                          correlation_id, headers,
+                          content_type: str = None,
+                          content_encoding: str = None) -> pika.BasicProperties:
+        if self.stamp_publish_time:
+            headers = stamp_publish_time(headers)
+
+        return pika.BasicProperties(
             app_id=self.name,
             type=str(event),
+            message_id=next_message_id(),
             timestamp=int(time.time()),
             headers=headers,
             delivery_mode=2 if mandatory else 1,
-            correlation_id=str(correlation_id) if correlation_id else None)
+            correlation_id=str(correlation_id) if correlation_id else None,
+            content_type=content_type,
+            content_encoding=content_encoding)
+
+    def _ensure_batch_channel(self) -> PipelinedConfirmChannel:
+        """Returns the channel used by emit_many, opening it if needed.
+
+        emit_many publishes on its own channel because the main channel waits
+        for the confirm of every message published on it.
+        """
+        self._ensure_connection()
 
-        data = serializer.encode(payload)
+        if self._batch_channel is None or not self._batch_channel.is_open:
+            LOGGER.info('opening batch channel')
+            self._batch_channel = self._transport.pipelined_channel(
+                self._connection)
 
-        self._publish(str(exchange),
-                      routing_key=str(event),
-                      properties=props,
-                      mandatory=mandatory,
-                      data=data)
+        return self._batch_channel
+
+    def _connect(self):
+        super()._connect()
+        if self.flow_control is not None:
+            self.flow_control.attach(self._connection)
+            self._connection.add_on_connection_unblocked_callback(self._on_unblocked)
+
+    def _on_unblocked(self, connection, unused_method_frame):
+        """Publishes the messages buffered while the broker blocked publishers
+        as soon as it unblocks them, so an idle publisher does not keep them."""
+        flow = self.flow_control
+        if not flow.buffered or flow.is_blocked(connection):
+            return
+        try:
+            self._publish_buffered()
+        except Exception as err:
+            LOGGER.error('failed to publish buffered messages once unblocked: %s', err)
+
+    def _sender(self):
+        """Returns the function emit and prepared emitters publish a message with."""
+        if self.outbox is not None:
+            return self.outbox.append
+        if self.flow_control is not None:
+            return self._publish_under_flow_control
+        return self._publish
+
+    def _publish_under_flow_control(self, exchange: str, routing_key: str,
+                                    properties: pika.BasicProperties,
+                                    mandatory: bool, data: bytes):
+        flow = self.flow_control
+        flow.throttle(exchange, properties.type)
+        self._ensure_connection()
+        if not flow.admit(self._connection,
+                          [(exchange, routing_key, properties, mandatory, data)]):
+            return
+        if flow.buffered:
+            self._publish_buffered()
+        self._publish(exchange, routing_key, properties, mandatory, data)
+
+    def _publish_buffered(self):
+        """Publishes the messages buffered while the broker blocked
+        publishers, ahead of newer ones."""
+        flow = self.flow_control
+        LOGGER.info('publishing %s buffered messages', flow.buffered)
+        while True:
+            message = flow.pop_buffered()
+            if message is None:
+                return
+            try:
+                self._publish(*message)
+            except pika.exceptions.UnroutableError as err:
+                LOGGER.warning('dropping buffered message %s to exchange %s: %s',
+                               message[1], message[0], err)
+            except Exception:
+                flow.restore_buffered(message)
+                raise
+
+    def _flush_on_close(self):
+        try:
+            self._ensure_connection()
+            # Reads an unblock the connection has not read yet
+            self._connection.process_data_events(0)
+            if not self.flow_control.is_blocked(self._connection):
+                self._publish_buffered()
+        except Exception as err:
+            LOGGER.error('failed to publish buffered messages on close: %s', err)
+        if self.flow_control.buffered:
+            LOGGER.error('dropping %s buffered messages on close', self.flow_control.buffered)
 
     @retry(pika.exceptions.AMQPConnectionError, tries=MAX_TRIES, delay=RETRY_DELAY, logger=LOGGER)
+    @count_retries('publish', pika.exceptions.AMQPConnectionError)
     def _publish(self, exchange: str, routing_key: str,
                  properties: pika.BasicProperties,
                  mandatory: bool, data: bytes):
         self._ensure_channel()
+        self.topology.ensure_exchange(self._channel, exchange)
 
         try:
+            metrics = self.metrics
+            started = time.perf_counter() if metrics is not None else 0.0
+
+            # Blocks until the broker confirms the message
             self._channel.basic_publish(
                 exchange=exchange,
                 routing_key=routing_key,
@@ -73,6 +548,10 @@ class AQXPublisher (AQXBase):
                 mandatory=mandatory,
                 body=data)
 
+            if metrics is not None:
+                metrics.observe('confirm.latency', time.perf_counter() - started,
+                                tags={'exchange': exchange})
+
         except pika.exceptions.UnroutableError as err:
             LOGGER.debug('message %s to exchange %s was unroutable: %s',
                          routing_key, exchange, err)
@@ -80,11 +559,9 @@ class AQXPublisher (AQXBase):
                 raise
 
         except pika.exceptions.ChannelClosedByBroker as err:
-            if err.reply_code == 404:  # exchange not found
-                self.channel.exchange_declare(exchange,
-                                              exchange_type='topic',
-                                              durable=True)
-                # Retry now that the exchange is declared
+            if err.reply_code == 404:  # exchange deleted since it was declared
+                self.topology.forget_exchange(exchange)
+                # Retry on a new channel, declaring the exchange again
                 self._publish(exchange, routing_key,
                               properties, mandatory, data)
             else:
@@ -1,4 +1,7 @@
-from typing import Dict, Protocol, runtime_checkable
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Protocol, runtime_checkable
+
+import pika.exceptions
 
 from asyncqx.core.types import Serializer, Stringable
 
@@ -14,3 +17,45 @@ class Publisher(Protocol):
              headers: Dict = None,
              exchange: Stringable = None,
              serializer: Serializer = None) -> None: ...
+
+
+@dataclass
+class EmitResult:
+    """The outcome of a single message published by emit_many."""
+    index: int
+    event: str
+    exchange: str
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def unroutable(self) -> bool:
+        return isinstance(self.error, pika.exceptions.UnroutableError)
+
+    @property
+    def nacked(self) -> bool:
+        return isinstance(self.error, pika.exceptions.NackError)
+
+
+@dataclass
+class EmitReport:
+    """Per message results of emit_many, in the order the messages were given."""
+    results: List[EmitResult] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return all(result.ok for result in self.results)
+
+    @property
+    def unroutable(self) -> List[EmitResult]:
+        return [result for result in self.results if result.unroutable]
+
+    @property
+    def nacked(self) -> List[EmitResult]:
+        return [result for result in self.results if result.nacked]
+
+    def __len__(self) -> int:
+        return len(self.results)
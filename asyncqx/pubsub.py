@@ -1,8 +1,40 @@
 """Combines the publisher and subscriber classes into a single interface"""
 
+import functools
+import logging
+import time
+import traceback
+import uuid
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Tuple, Union
+
+import pika
+
+from asyncqx.core.metrics import MetricsSink
+from asyncqx.core.sharding import PartitionKey
 from asyncqx.core.types import Serializer, Stringable
+from asyncqx.publisher.flow import FlowControl
+from asyncqx.publisher.outbox import Outbox
 from asyncqx.publisher.publisher import AQXPublisher
+from asyncqx.publisher.types import EmitReport
+from asyncqx.subscriber.dedup import DedupStore
+from asyncqx.subscriber.retries import RetryPolicy
 from asyncqx.subscriber.subscriber import AQXSubscriber
+from asyncqx.tools import TopicRouter
+from asyncqx.transport.base import Transport
+
+LOGGER = logging.getLogger(__name__)
+
+DELIVERY_BROKER = 'broker'
+DELIVERY_LOCAL = 'local'
+DELIVERY_BOTH = 'both'
+DELIVERY_POLICIES = (DELIVERY_BROKER, DELIVERY_LOCAL, DELIVERY_BOTH)
+
+ORIGIN_HEADER = 'x-asyncqx-origin'
+
+
+class LocalBinding(NamedTuple):
+    callback: object
+    policy: str
 
 
 class AQXPubSub:
@@ -14,17 +46,38 @@ class AQXPubSub:
                  default_exchange: Stringable = None,
                  default_serializer: Serializer = None,
                  default_queue: Stringable = None,
-                 default_exclusive = False):
+                 default_exclusive = False,
+                 transport: Transport = None,
+                 metrics: MetricsSink = None,
+                 stamp_publish_time: bool = False,
+                 staleness_budget: float = None,
+                 outbox: Union[str, Outbox] = None,
+                 shards: Mapping[Stringable, int] = None,
+                 partition_key: Union[str, PartitionKey] = None,
+                 dedup: DedupStore = None,
+                 flow_control: FlowControl = None):
         self.publisher = AQXPublisher(
             name, amqp_url, default_exchange=default_exchange,
-            default_serializer=default_serializer)
+            default_serializer=default_serializer, transport=transport,
+            metrics=metrics, stamp_publish_time=stamp_publish_time,
+            outbox=outbox, shards=shards, partition_key=partition_key,
+            flow_control=flow_control)
 
         self.subscriber = AQXSubscriber(
             amqp_url,
             default_exchange=default_exchange,
             default_serializer=default_serializer,
             default_queue=default_queue,
-            default_exclusive=default_exclusive)
+            default_exclusive=default_exclusive,
+            transport=transport,
+            metrics=metrics,
+            staleness_budget=staleness_budget,
+            dedup=dedup)
+
+        self.metrics = metrics
+        self.origin = uuid.uuid4().hex
+        self._local: Dict[str, TopicRouter[LocalBinding]] = {}
+        self._loopback = False
 
     def emit(self,
              event: Stringable,
@@ -34,28 +87,236 @@ class AQXPubSub:
              correlation_id=None,
              headers: object = None,
              exchange: Stringable = None,
-             serializer: Serializer = None) -> None:
+             serializer: Serializer = None,
+             remote: bool = True) -> None:
+        """Emits an event, first calling the in-process bindings it matches.
+
+        Bindings with the local or both delivery policy are called on the
+        emitting thread with the payload object itself, which is never
+        serialized for them and should be treated as read-only.
+
+        A publisher cannot tell whether other processes consume an event, so
+        it is published to the broker unless the caller passes remote=False,
+        even when only local bindings of this object match it.
+
+        Args:
+            remote (bool, optional): Whether to publish the event to the broker as well. Pass False
+                for events only consumed in this process. Defaults to True.
+        """
+        exchange = exchange or self.publisher.default_exchange
+        if self._local:
+            self._deliver_locally(exchange, event, payload, correlation_id, headers)
+        if not remote:
+            return None
+
         return self.publisher.emit(
             event,
             payload,
             mandatory=mandatory,
             correlation_id=correlation_id,
+            headers=self._stamp_origin(headers),
+            exchange=exchange,
+            serializer=serializer)
+
+    def emit_many(self,
+                  emissions: Iterable[Tuple],
+                  *,
+                  mandatory=False,
+                  headers: object = None,
+                  exchange: Stringable = None,
+                  serializer: Serializer = None,
+                  remote: bool = True) -> EmitReport:
+        """Emits many events like `emit`, publishing them with the publisher's
+        `emit_many`. Returns None when remote is False."""
+        exchange = exchange or self.publisher.default_exchange
+        if self._local:
+            emissions = list(emissions)
+            for event, payload, *rest in emissions:
+                options = rest[0] if rest else {}
+                self._deliver_locally(
+                    options.get('exchange') or exchange, event, payload,
+                    options.get('correlation_id'), options.get('headers', headers))
+        if not remote:
+            return None
+
+        if self._loopback:
+            emissions = [self._stamp_emission(emission) for emission in emissions]
+        return self.publisher.emit_many(
+            emissions,
+            mandatory=mandatory,
+            headers=self._stamp_origin(headers),
+            exchange=exchange,
+            serializer=serializer)
+
+    def call(self,
+             event: Stringable,
+             payload: object,
+             *,
+             timeout: float = None,
+             headers: object = None,
+             exchange: Stringable = None,
+             serializer: Serializer = None) -> object:
+        return self.publisher.call(
+            event,
+            payload,
+            timeout=timeout,
             headers=headers,
             exchange=exchange,
             serializer=serializer)
 
+    def call_many(self,
+                  calls: Iterable[Tuple],
+                  *,
+                  timeout: float = None,
+                  headers: object = None,
+                  exchange: Stringable = None,
+                  serializer: Serializer = None,
+                  return_exceptions: bool = False) -> List[object]:
+        return self.publisher.call_many(
+            calls,
+            timeout=timeout,
+            headers=headers,
+            exchange=exchange,
+            serializer=serializer,
+            return_exceptions=return_exceptions)
+
     def bind(self,
              *events: Stringable,
              queue_name: Stringable = None,
              exchange: Stringable = None,
              exclusive: bool = False,
-             serializer: Serializer = None):
-        return self.subscriber.bind(
+             serializer: Serializer = None,
+             delivery: str = DELIVERY_BROKER,
+             shards: int = None,
+             claim: Iterable[int] = None,
+             retry_policy: RetryPolicy = None):
+        """Binds a callback like `AQXSubscriber.bind`.
+
+        Args:
+            delivery (str, optional): Where the callback receives events from. 'broker' consumes them from
+                the queue only. 'local' calls it in-process for events emitted by this object and never
+                binds a queue. 'both' does both, skipping broker copies of events it already received
+                in-process. Defaults to 'broker'.
+
+        Only the instance that emitted an event skips its broker copy, so a 'both' binding should
+        consume a queue no other AQXPubSub consumes, such as a server-named or exclusive one. When
+        instances share a named queue, whichever consumes the copy handles the event again.
+
+        Raises:
+            ValueError: delivery is unknown, or is 'local' with queue_name, exclusive, shards, claim
+                or retry_policy, which only apply to bindings consuming a queue.
+        """
+        if delivery not in DELIVERY_POLICIES:
+            raise ValueError(
+                f'delivery must be one of {", ".join(DELIVERY_POLICIES)}, got {delivery!r}')
+        if delivery == DELIVERY_LOCAL:
+            given = [name for name, value in (
+                ('queue_name', queue_name), ('exclusive', exclusive), ('shards', shards),
+                ('claim', claim), ('retry_policy', retry_policy)) if value]
+            if given:
+                raise ValueError(f'local bindings consume no queue, got {", ".join(given)}')
+
+        if delivery == DELIVERY_BROKER:
+            return self.subscriber.bind(
+                *events,
+                queue_name=queue_name,
+                exchange=exchange,
+                exclusive=exclusive,
+                serializer=serializer,
+                shards=shards,
+                claim=claim,
+                retry_policy=retry_policy)
+
+        exchange = str(exchange or self.publisher.default_exchange)
+
+        def decorator(callback):
+            router = self._local.setdefault(exchange, TopicRouter())
+            for event in events:
+                router.add(str(event), LocalBinding(callback, delivery))
+
+            if delivery == DELIVERY_BOTH:
+                self._loopback = True
+                self.subscriber.bind(
+                    *events,
+                    queue_name=queue_name,
+                    exchange=exchange,
+                    exclusive=exclusive,
+                    serializer=serializer,
+                    envelope=True,
+                    shards=shards,
+                    claim=claim,
+                    retry_policy=retry_policy)(self._skip_loopback(callback, serializer))
+            return callback
+
+        return decorator
+
+    def bind_rpc(self,
+                 *events: Stringable,
+                 queue_name: Stringable = None,
+                 exchange: Stringable = None,
+                 exclusive: bool = False,
+                 serializer: Serializer = None):
+        return self.subscriber.bind_rpc(
             *events,
             queue_name=queue_name,
             exchange=exchange,
             exclusive=exclusive,
             serializer=serializer)
 
-    def consume(self):
-        return self.subscriber.consume()
+    def consume(self, workers: int = 1):
+        return self.subscriber.consume(workers=workers)
+
+    def _deliver_locally(self, exchange: Stringable, event: Stringable, payload: object,
+                         correlation_id, headers):
+        router = self._local.get(str(exchange))
+        bindings = router.match(str(event)) if router is not None else ()
+        if not bindings:
+            return
+
+        event = str(event)
+        props = pika.BasicProperties(
+            app_id=self.publisher.name,
+            type=event,
+            timestamp=int(time.time()),
+            headers=headers,
+            correlation_id=str(correlation_id) if correlation_id else None)
+
+        metrics = self.metrics
+        for binding in bindings:
+            try:
+                binding.callback(event, payload, props)
+            except Exception as error:
+                if metrics is not None:
+                    metrics.increment('callback.error', tags={
+                        'event': event, 'queue': None, 'error': type(error).__name__})
+                LOGGER.error(traceback.format_exc())
+                LOGGER.error('error in local callback for message type %s: %s', event, error)
+            else:
+                if metrics is not None:
+                    metrics.increment('consume', tags={'event': event, 'queue': None})
+
+    def _skip_loopback(self, callback, serializer: Serializer):
+        """Wraps a callback bound with envelope=True so broker copies of events
+        this object emitted are dropped before they are decoded."""
+        subscriber = self.subscriber
+        serializer = serializer or subscriber.default_serializer
+
+        @functools.wraps(callback)
+        def message_callback(event, message, props):
+            if (props.headers or {}).get(ORIGIN_HEADER) == self.origin:
+                return None
+            return callback(
+                event, message.decode(subscriber.serializers.resolve(props, serializer)), props)
+
+        return message_callback
+
+    def _stamp_origin(self, headers):
+        if not self._loopback:
+            return headers
+        return dict(headers or {}, **{ORIGIN_HEADER: self.origin})
+
+    def _stamp_emission(self, emission: Tuple) -> Tuple:
+        if len(emission) < 3 or 'headers' not in emission[2]:
+            return emission
+        event, payload, options = emission
+        return event, payload, dict(options, headers=self._stamp_origin(options['headers']))
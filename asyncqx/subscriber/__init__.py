@@ -1,3 +1,8 @@
 # pylint: disable
 from .subscriber import AQXSubscriber
+from .async_subscriber import AQXAsyncSubscriber
+from .dedup import DedupStore, FileDedupStore, MemoryDedupStore
+from .envelope import MessageEnvelope
+from .lanes import LaneExecutor, by_correlation_id, by_header
+from .retries import RetryPolicy
 from .types import *
@@ -0,0 +1,337 @@
+import asyncio
+import functools
+import inspect
+import logging
+import time
+import traceback
+from typing import Callable, Iterable, Optional, Set
+
+import pika
+import pika.channel
+import pika.exceptions
+
+from asyncqx.core.async_base import AQXAsyncBase
+from asyncqx.core.base import JSONSerializer
+from asyncqx.core.latency import STALE_DROP, check_stale_action, is_stale, message_age
+from asyncqx.core.metrics import MetricsSink
+from asyncqx.core.rpc import reply_properties
+from asyncqx.core.serializers import DEFAULT_REGISTRY, SerializerRegistry, encode_message
+from asyncqx.core.types import EventListener, Serializer, Stringable
+from asyncqx.subscriber.envelope import MessageEnvelope
+from asyncqx.subscriber.subscriber import EventBinding, LateBindingMixin, queue_staleness_budget
+from asyncqx.tools import TopicRouter
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AQXAsyncSubscriber (LateBindingMixin, AQXAsyncBase):
+    """An asyncio subscriber processing messages concurrently.
+
+    Listeners may be plain functions or `async def` coroutines. Each queue is
+    consumed with manual acks and a `basic_qos` prefetch of `concurrency`, so
+    at most `concurrency` messages per queue are held in memory and handled
+    at once. A message is acked once its listeners have finished.
+
+    Publish time tracking and staleness budgets work as in AQXSubscriber.
+    """
+
+    def __init__(self,
+                 amqp_url: str = None,
+                 *,
+                 default_serializer=None,
+                 default_exchange=None,
+                 default_queue=None,
+                 default_exclusive=False,
+                 serializers: SerializerRegistry = None,
+                 concurrency: int = 10,
+                 metrics: MetricsSink = None,
+                 staleness_budget: float = None,
+                 on_stale: str = STALE_DROP):
+        super().__init__(amqp_url=amqp_url, metrics=metrics)
+        check_stale_action(on_stale)
+
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+
+        self.default_serializer = default_serializer or JSONSerializer()
+        self.default_exchange = default_exchange or 'asyncqx'
+        self.default_queue = default_queue or ''
+        self.default_exclusive = default_exclusive
+        self.serializers = serializers or DEFAULT_REGISTRY
+        self.concurrency = concurrency
+        self.staleness_budget = staleness_budget
+        self.on_stale = on_stale
+
+        self._late_bindings = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def in_flight(self) -> int:
+        """The number of messages currently being handled."""
+        return len(self._tasks)
+
+    def bind(self,
+             *events: Stringable,
+             queue_name: Stringable = None,
+             exchange: Stringable = None,
+             exclusive: bool = None,
+             serializer: Serializer = None,
+             envelope: bool = False,
+             staleness_budget: float = None):
+        """Create a decorator to bind callbacks to one or more events.
+
+        Accepts the same arguments as AQXSubscriber.bind. The decorated
+        callback may be a coroutine function.
+
+        Returns:
+            Decorator: Returns a decorator which can bind function as an event callback.
+        """
+
+        exchange = exchange or self.default_exchange
+        if staleness_budget is None:
+            staleness_budget = self.staleness_budget
+        serializer = serializer or self.default_serializer
+        queue_name = queue_name or self.default_queue
+        exclusive = exclusive if exclusive is not None else self.default_exclusive
+
+        def decorator(callback: EventListener):
+            LOGGER.info(
+                'late-binding callback %s to events %s from queue %s',
+                callback, events, queue_name)
+
+            @functools.wraps(callback)
+            async def message_callback(unused_ch, method, props, body):
+                message = MessageEnvelope.wrap(method, props, body)
+                event = props.type
+                source = props.app_id
+
+                LOGGER.info(
+                    'received message type %s from source %s of length %s',
+                    event, source, len(message))
+
+                metrics = self.metrics
+                stage = 'decode'
+                try:
+                    started = time.perf_counter() if metrics is not None else 0.0
+                    data = message if envelope else message.decode(
+                        self.serializers.resolve(props, serializer))
+
+                    stage = 'callback'
+                    decoded = time.perf_counter() if metrics is not None else 0.0
+                    result = callback(event, data, props)
+                    if inspect.isawaitable(result):
+                        await result
+
+                    if metrics is not None:
+                        tags = {'event': event, 'queue': queue_name or None}
+                        metrics.increment('consume', tags=tags)
+                        metrics.observe('decode.latency', decoded - started, tags=tags)
+                        metrics.observe('callback.latency', time.perf_counter() - decoded, tags=tags)
+                        lag = message_age(props)
+                        if lag is not None:
+                            metrics.observe('handled.lag', lag, tags=tags)
+
+                except Exception as error:
+                    if metrics is not None:
+                        metrics.increment(f'{stage}.error', tags={
+                            'event': event, 'queue': queue_name or None,
+                            'error': type(error).__name__})
+                    LOGGER.error(traceback.format_exc())
+                    LOGGER.error(
+                        'error in callback for message type %s from source %s: %s',
+                        event, source, error)
+
+            self._add_late_binding(
+                exchange,
+                queue_name,
+                events,
+                exclusive,
+                callback=message_callback,
+                staleness_budget=staleness_budget)
+
+            return callback
+
+        return decorator
+
+    def bind_rpc(self,
+                 *events: Stringable,
+                 queue_name: Stringable = None,
+                 exchange: Stringable = None,
+                 exclusive: bool = None,
+                 serializer: Serializer = None):
+        """Create a decorator to bind request handlers to one or more events.
+
+        Accepts the same arguments as AQXSubscriber.bind_rpc. The decorated
+        handler may be a coroutine function.
+
+        Returns:
+            Decorator: Returns a decorator which can bind function as a request handler.
+        """
+        serializer = serializer or self.default_serializer
+
+        def decorator(handler: EventListener):
+            @functools.wraps(handler)
+            async def responder(event, payload, props):
+                try:
+                    result = handler(event, payload, props)
+                    if inspect.isawaitable(result):
+                        result = await result
+                    encoded = encode_message(serializer, result)
+                except Exception as error:
+                    self._reply(props, reply_properties(props, None, error=error), b'')
+                    raise
+                self._reply(props, reply_properties(props, None, encoded), encoded.body)
+
+            self.bind(*events, queue_name=queue_name, exchange=exchange,
+                      exclusive=exclusive, serializer=serializer)(responder)
+            return handler
+
+        return decorator
+
+    async def consume(self):
+        """Create all queues and exchanges and begin consuming events.
+
+        Runs until the connection is closed by the client or the broker.
+        Delayed retries on AMQPConnectionErrors.
+        """
+        while True:
+            await self._ensure_channel()
+            await self._apply_late_bindings()
+
+            stopped = asyncio.get_running_loop().create_future()
+            self._pending_rpcs.add(stopped)
+
+            try:
+                await stopped
+            except (pika.exceptions.ConnectionClosedByClient,
+                    pika.exceptions.ChannelClosedByClient,
+                    pika.exceptions.ConnectionClosedByBroker):
+                return
+            except pika.exceptions.AMQPError as err:
+                LOGGER.warning('consuming stopped: %s, reconnecting', err)
+                await asyncio.sleep(self.RETRY_DELAY)
+
+    async def close(self):
+        """Waits for in-flight messages to be handled and closes the connection."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await super().close()
+
+    async def _apply_late_bindings(self):
+        """For each binding, create the queue and exchange and bind the callback.
+
+        Declarations are sent without waiting for their replies, except for
+        server-named queues, and the basic_qos call that follows them acts as
+        a barrier: if any declaration failed the channel is closed and it
+        raises. As with AQXSubscriber, a switching coroutine is created when
+        more than one binding shares an exchange - queue combination.
+        """
+        channel = self._channel
+
+        consumers = []
+        for (exchange, queue), event_bindings in self._late_bindings.items():
+            assert len(event_bindings) > 0, (
+                'exchange-queue combo is present but event_bindings is empty', exchange, queue)
+
+            exclusive = bool(queue == '') or any(
+                eb.exclusive for eb in event_bindings)
+
+            channel.exchange_declare(exchange,
+                                     exchange_type='topic',
+                                     durable=True)
+            if queue:
+                channel.queue_declare(queue,
+                                      durable=not exclusive,
+                                      exclusive=exclusive,
+                                      auto_delete=exclusive)
+                queue_name = queue
+            else:
+                declared = await self._rpc(channel.queue_declare,
+                                           queue,
+                                           durable=not exclusive,
+                                           exclusive=exclusive,
+                                           auto_delete=exclusive)
+                queue_name = declared.method.queue
+
+            if len(event_bindings) == 1:
+                message_callback = event_bindings[0].callback
+            else:
+                message_callback = create_async_event_switch(event_bindings)
+
+            for event_binding in event_bindings:
+                for routing_key in event_binding.bound_keys:
+                    channel.queue_bind(queue_name,
+                                       exchange,
+                                       routing_key=routing_key)
+
+            consumers.append((queue_name, message_callback,
+                              queue_staleness_budget(event_bindings)))
+
+        await self._rpc(channel.basic_qos, prefetch_count=self.concurrency)
+
+        for queue_name, message_callback, staleness_budget in consumers:
+            channel.basic_consume(
+                queue=queue_name,
+                on_message_callback=functools.partial(
+                    self._on_message, message_callback,
+                    queue_name=queue_name, staleness_budget=staleness_budget),
+                auto_ack=False)
+
+    def _reply(self, request: pika.BasicProperties, props: pika.BasicProperties,
+               body: bytes):
+        if not request.reply_to:
+            LOGGER.warning('request %s from %s has no reply_to', request.type, request.app_id)
+            return
+        if self._channel is None or not self._channel.is_open:
+            LOGGER.warning('channel closed before replying to %s', request.reply_to)
+            return
+        self._channel.basic_publish('', request.reply_to, body, props)
+
+    def _on_message(self, message_callback: Callable,
+                    channel: pika.channel.Channel, method, props, body,
+                    queue_name: str = '', staleness_budget: Optional[float] = None):
+        if is_stale(props, queue_name, staleness_budget, self.on_stale, self.metrics):
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._handle_message(message_callback, channel, method, props, body))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle_message(self, message_callback: Callable,
+                              channel: pika.channel.Channel, method, props, body):
+        try:
+            await message_callback(channel, method, props, body)
+        finally:
+            if channel.is_open:
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def create_async_event_switch(event_bindings: Iterable[EventBinding]) -> Callable:
+    """Returns a coroutine function that will switch callbacks based on the
+    event type. The asyncio counterpart of create_event_switch.
+
+    Args:
+        event_bindings (Iterable[EventBinding]): The bindings sharing a queue.
+
+    Returns:
+        Callable: A coroutine function awaiting each matching binding in turn.
+    """
+    router: TopicRouter[EventBinding] = TopicRouter()
+    for event_binding in event_bindings:
+        for pattern in event_binding.events:
+            router.add(str(pattern), event_binding)
+
+    async def switch(ch, method, props: pika.BasicProperties, body):
+        event = props.type
+        assert event is not None
+
+        message = MessageEnvelope.wrap(method, props, body)
+        for event_binding in router.match(str(event)):
+            try:
+                await event_binding.callback(ch, method, props, message)
+            except Exception as err:
+                LOGGER.error(traceback.format_exc())
+                LOGGER.error('error switching event %s: %s', event, err)
+
+    return switch
@@ -0,0 +1,108 @@
+"""Buffering of deliveries for listeners that handle messages in batches."""
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from pika.spec import BasicProperties
+
+LOGGER = logging.getLogger(__name__)
+
+BatchItem = Tuple[str, object, BasicProperties]
+
+
+class MessageBatcher:
+    """Buffers the decoded deliveries of one batched binding.
+
+    Deliveries are added on the connection thread. The buffer is flushed to
+    `on_flush(batcher, channel, delivery_tags, items)` once it holds `batch_size`
+    messages, or `max_wait` seconds after its first message arrived, using a
+    connection timer so an idle queue still flushes a partial batch.
+    Buffered deliveries left for the broker to redeliver, because their
+    channel closed, are passed to `on_drop(items)`.
+    """
+
+    def __init__(self, listener: Callable[[List[BatchItem]], object],
+                 decode: Callable, queue_name: str, batch_size: int,
+                 max_wait: float, on_flush: Callable,
+                 on_drop: Callable[[List[BatchItem]], object] = None):
+        if batch_size < 1:
+            raise ValueError(f'batch_size must be at least 1, got {batch_size}')
+        if max_wait < 0:
+            raise ValueError(f'max_wait must not be negative, got {max_wait}')
+
+        self.listener = listener
+        self.decode = decode
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+        self._on_flush = on_flush
+        self._on_drop = on_drop
+        self._channel = None
+        self._delivery_tags: List[int] = []
+        self._items: List[BatchItem] = []
+        self._timer: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def use_channel(self, channel):
+        """Switches to the channel deliveries now arrive on, dropping those
+        buffered from the previous one."""
+        if channel is not self._channel:
+            # Unsettled deliveries of a closed channel are redelivered
+            self._discard()
+            self._channel = channel
+
+    def add(self, channel, delivery_tag: int, item: BatchItem):
+        self.use_channel(channel)
+
+        self._delivery_tags.append(delivery_tag)
+        self._items.append(item)
+
+        if len(self._items) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = channel.connection.call_later(self.max_wait, self._on_timer)
+
+    def flush(self):
+        """Hands the buffered deliveries to on_flush. Must be called on the
+        connection thread."""
+        self._cancel_timer()
+        if not self._items:
+            return
+
+        channel = self._channel
+        delivery_tags, self._delivery_tags = self._delivery_tags, []
+        items, self._items = self._items, []
+
+        if not channel.is_open:
+            LOGGER.warning('channel closed before a batch of %s messages was handled; '
+                           'the broker will redeliver them', len(items))
+            self._drop(items)
+            return
+
+        self._on_flush(self, channel, delivery_tags, items)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def _cancel_timer(self):
+        timer, self._timer = self._timer, None
+        if timer is not None:
+            try:
+                self._channel.connection.remove_timeout(timer)
+            except Exception:
+                pass
+
+    def _discard(self):
+        self._cancel_timer()
+        items = self._items
+        self._delivery_tags = []
+        self._items = []
+        if items:
+            self._drop(items)
+
+    def _drop(self, items: List[BatchItem]):
+        if self._on_drop is not None:
+            self._on_drop(items)
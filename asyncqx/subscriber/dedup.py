@@ -0,0 +1,193 @@
+"""Stores of recently seen message ids, for skipping duplicate deliveries.
+
+Publishers stamp every message with a unique `message_id`, which stays the
+same when the message is published again, whether by a retried publish, an
+outbox replay or a broker redelivery. A subscriber given a store records
+the id of each delivery on arrival and acks deliveries whose id it has
+already seen, before decoding them. The id is forgotten if the delivery is
+not handled, so its redelivery is.
+
+A consumer killed while handling a message never forgets its id. The
+broker redelivers the message to another consumer, which skips it if the
+store outlived the killed one, as a FileDedupStore shared between
+processes does.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Protocol
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+DEFAULT_CAPACITY = 100_000  # message ids
+DEFAULT_TTL = 3600.0  # seconds
+
+
+class DedupStore(Protocol):
+
+    def add(self, key: str) -> bool:
+        """Records a key. Returns False if it was already recorded."""
+
+    def discard(self, key: str) -> None:
+        """Forgets a key, so it is no longer a duplicate."""
+
+
+class MemoryDedupStore:
+    """Keeps the most recently added keys of this process, up to capacity,
+    for ttl seconds each. The least recently added key is forgotten first."""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, ttl: float = DEFAULT_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._expiries: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._expiries)
+
+    def add(self, key: str) -> bool:
+        now = time.monotonic()
+        expiries = self._expiries
+        with self._lock:
+            expires = expiries.get(key)
+            if expires is not None and expires > now:
+                return False
+
+            expiries[key] = now + self.ttl
+            expiries.move_to_end(key)
+            while len(expiries) > self.capacity:
+                expiries.popitem(last=False)
+            # Keys are added in expiry order, so expired ones are at the front
+            while expiries:
+                oldest = next(iter(expiries.values()))
+                if oldest > now:
+                    break
+                expiries.popitem(last=False)
+            return True
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._expiries.pop(key, None)
+
+
+_MAGIC = b'AQXD'
+_VERSION = 1
+_HEADER = struct.Struct('>4sHxxQ')  # magic, version, slot count
+_HEADER_SIZE = 64
+_SLOT = struct.Struct('<Qd')  # key fingerprint, expiry time
+
+
+class FileDedupStore:
+    """A fixed size hash table of key fingerprints in a memory-mapped file,
+    shared by every process opening the same path.
+
+    Put the file on a tmpfs such as /dev/shm to share it through memory
+    only. Each key has PROBES candidate slots. A key takes the first free or
+    expired one, or else the one expiring soonest, so the table never grows
+    and a full table forgets its oldest keys. Keys are compared by a 64 bit
+    fingerprint, so two keys are mistaken for each other about once in
+    2**64 lookups. Updates are serialized between processes with a lock on
+    the file.
+    """
+    PROBES = 8
+
+    def __init__(self, path: str, slots: int = DEFAULT_CAPACITY * 2, ttl: float = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._lock_file()
+            try:
+                self.slots = self._open_table(slots)
+            finally:
+                self._unlock_file()
+            self._map = mmap.mmap(self._fd, _HEADER_SIZE + self.slots * _SLOT.size)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self._lock = threading.Lock()
+
+    def add(self, key: str) -> bool:
+        fingerprint = _fingerprint(key)
+        now = time.time()
+        with self._lock:
+            self._lock_file()
+            try:
+                slot = self._find(fingerprint, now)
+                if slot is None:
+                    return False
+                _SLOT.pack_into(self._map, slot, fingerprint, now + self.ttl)
+                return True
+            finally:
+                self._unlock_file()
+
+    def discard(self, key: str) -> None:
+        fingerprint = _fingerprint(key)
+        with self._lock:
+            self._lock_file()
+            try:
+                for offset in self._probe(fingerprint):
+                    if _SLOT.unpack_from(self._map, offset)[0] == fingerprint:
+                        _SLOT.pack_into(self._map, offset, 0, 0.0)
+            finally:
+                self._unlock_file()
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _find(self, fingerprint: int, now: float) -> Optional[int]:
+        """Returns the offset of the slot to record a fingerprint in, or
+        None if it is recorded and has not expired."""
+        target, target_expiry = None, None
+        for offset in self._probe(fingerprint):
+            recorded, expiry = _SLOT.unpack_from(self._map, offset)
+            if recorded == fingerprint and expiry > now:
+                return None
+            if recorded == 0 or expiry <= now:
+                expiry = 0.0
+            if target is None or expiry < target_expiry:
+                target, target_expiry = offset, expiry
+        return target
+
+    def _probe(self, fingerprint: int):
+        first = fingerprint % self.slots
+        for index in range(min(self.PROBES, self.slots)):
+            yield _HEADER_SIZE + ((first + index) % self.slots) * _SLOT.size
+
+    def _open_table(self, slots: int) -> int:
+        """Initializes a new file, or returns the slot count of an existing one."""
+        if os.fstat(self._fd).st_size >= _HEADER_SIZE:
+            magic, version, existing = _HEADER.unpack(os.pread(self._fd, _HEADER.size, 0))
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError(f'{self.path} is not a dedup store')
+            return existing
+
+        if slots < 1:
+            raise ValueError(f'slots must be at least 1, got {slots}')
+        os.ftruncate(self._fd, _HEADER_SIZE + slots * _SLOT.size)
+        os.pwrite(self._fd, _HEADER.pack(_MAGIC, _VERSION, slots), 0)
+        return slots
+
+    def _lock_file(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _unlock_file(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def _fingerprint(key: str) -> int:
+    fingerprint = int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+    # 0 marks an empty slot
+    return fingerprint or 1
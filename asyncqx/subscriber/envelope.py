@@ -0,0 +1,56 @@
+"""Delivered messages shared by the bindings they are dispatched to, decoded lazily."""
+from typing import List, Tuple
+
+from pika.spec import BasicProperties
+
+from asyncqx.core.types import Serializer
+
+
+class MessageEnvelope:
+    """A delivered message shared by every binding it is dispatched to.
+
+    The body is decoded lazily and at most once per serializer, so a message
+    matching several bindings on a queue is only parsed once. The decoded
+    payload is shared between listeners and should be treated as read-only.
+    """
+    __slots__ = ('method', 'props', '_data', '_decoded')
+
+    def __init__(self, method, props: BasicProperties, body: bytes):
+        self.method = method
+        self.props = props
+        self._data = body
+        self._decoded: List[Tuple[Serializer, object]] = []
+
+    @classmethod
+    def wrap(cls, method, props: BasicProperties, body) -> 'MessageEnvelope':
+        """Returns body if it is already an envelope, otherwise wraps it."""
+        if isinstance(body, cls):
+            return body
+        return cls(method, props, body)
+
+    @property
+    def event(self) -> str:
+        return self.props.type
+
+    @property
+    def body(self) -> memoryview:
+        """A zero-copy view of the raw message body."""
+        return memoryview(self._data)
+
+    @property
+    def data(self) -> bytes:
+        """The raw message body as delivered."""
+        return self._data
+
+    def decode(self, serializer: Serializer) -> object:
+        """Returns the body decoded with serializer, decoding it on first use."""
+        for decoded_by, payload in self._decoded:
+            if decoded_by is serializer:
+                return payload
+
+        payload = serializer.decode(self._data)
+        self._decoded.append((serializer, payload))
+        return payload
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,74 @@
+"""Ordered parallel dispatch of messages over keyed worker lanes."""
+import itertools
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Callable, List
+
+from asyncqx.core.sharding import (PartitionKey, by_correlation_id, by_header,
+                                   resolve_partition_key)
+
+
+class LaneExecutor:
+    """Runs work on a fixed number of threads, each with its own bounded
+    FIFO queue.
+
+    Work submitted with the same key always runs on the same lane, so it runs
+    in the order it was submitted, while work with other keys runs on the
+    other lanes concurrently. Work without a key is spread over the lanes in
+    turn. Submitting to a full lane blocks until it has room.
+    """
+
+    def __init__(self, lanes: int, depth: int, thread_name_prefix: str = 'asyncqx-lane'):
+        if lanes < 1:
+            raise ValueError(f'lanes must be at least 1, got {lanes}')
+
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=depth) for _ in range(lanes)]
+        self._next_lane = itertools.count()
+        self._threads = [
+            threading.Thread(target=self._work, args=(lane_queue,),
+                             name=f'{thread_name_prefix}-{index}', daemon=True)
+            for index, lane_queue in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self) -> int:
+        return len(self._queues)
+
+    def lane_for(self, key) -> int:
+        if key is None:
+            return next(self._next_lane) % len(self._queues)
+        if not isinstance(key, bytes):
+            key = str(key).encode()
+        return zlib.crc32(key) % len(self._queues)
+
+    def submit(self, fn: Callable, *args, key=None) -> Future:
+        future: Future = Future()
+        self._queues[self.lane_for(key)].put((future, fn, args))
+        return future
+
+    def shutdown(self, wait: bool = True):
+        """Stops every lane once the work already queued on it has run."""
+        for lane_queue in self._queues:
+            lane_queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    @staticmethod
+    def _work(lane_queue: queue.Queue):
+        while True:
+            work = lane_queue.get()
+            if work is None:
+                return
+
+            future, fn, args = work
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
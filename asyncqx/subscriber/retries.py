@@ -0,0 +1,101 @@
+"""Delayed redelivery of messages whose callbacks failed, and dead-lettering
+of those that keep failing.
+
+A failed message is republished to a delay queue holding messages for a
+fixed time, `{queue}.retry.{ms}`, which has a message TTL and dead-letters
+expired messages back to the binding's queue through the default exchange.
+The consumer moves on to the next message straight away and the broker
+holds the failed one for the backoff. Each attempt has a delay queue of
+its own, so a long backoff never holds up a shorter one queued behind it.
+
+Redelivered messages carry their attempt number and the binding that
+failed, so other bindings sharing the queue skip them. Messages failing
+their last attempt are published to the dead-letter exchange, routed to
+`{queue}.dead` by the queue name.
+"""
+import copy
+from dataclasses import dataclass
+from typing import Iterable, Optional, Tuple
+
+import pika
+
+ATTEMPT_HEADER = 'x-asyncqx-attempt'
+RETRY_BINDING_HEADER = 'x-asyncqx-retry-binding'
+ERROR_HEADER = 'x-asyncqx-error'
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How often and how long after a failure a binding retries a message.
+
+    Attempt n + 1 is delivered `delay * multiplier ** (n - 1)` seconds after
+    attempt n failed, up to max_delay. After max_attempts the message is
+    dead-lettered. Messages that cannot be decoded are dead-lettered
+    straight away.
+    """
+    max_attempts: int = 5
+    delay: float = 1.0  # seconds
+    multiplier: float = 2.0
+    max_delay: float = 300.0  # seconds
+    dead_letter_exchange: Optional[str] = None
+
+    def __post_init__(self):
+        if self.max_attempts < 1:
+            raise ValueError(f'max_attempts must be at least 1, got {self.max_attempts}')
+        if self.delay <= 0:
+            raise ValueError(f'delay must be positive, got {self.delay}')
+
+    def delay_ms(self, attempt: int) -> int:
+        """Milliseconds to wait after a failed attempt before the next one."""
+        seconds = min(self.max_delay, self.delay * self.multiplier ** (attempt - 1))
+        return max(1, round(seconds * 1000))
+
+    def delays_ms(self) -> Tuple[int, ...]:
+        """The distinct delays of every retry, one delay queue each."""
+        return tuple(dict.fromkeys(
+            self.delay_ms(attempt) for attempt in range(1, self.max_attempts)))
+
+    def dead_letter_exchange_for(self, exchange: str) -> str:
+        return self.dead_letter_exchange or f'{exchange}.dead'
+
+
+def binding_name(callback, taken: Iterable[str] = ()) -> str:
+    """Names a binding after its callback, numbering it when another binding
+    on its queue already took that name, as a callback bound twice or two
+    local functions of the same name would."""
+    name = f'{callback.__module__}.{getattr(callback, "__qualname__", callback)}'
+    taken = set(taken)
+    if name not in taken:
+        return name
+    number = 2
+    while f'{name}#{number}' in taken:
+        number += 1
+    return f'{name}#{number}'
+
+
+def attempt_of(props: pika.BasicProperties) -> int:
+    """The attempt a delivery is, 1 for messages never retried."""
+    return int((props.headers or {}).get(ATTEMPT_HEADER, 1))
+
+
+def delay_queue_name(queue_name: str, delay_ms: int) -> str:
+    return f'{queue_name}.retry.{delay_ms}'
+
+
+def dead_letter_queue_name(queue_name: str) -> str:
+    return f'{queue_name}.dead'
+
+
+def redelivery_properties(props: pika.BasicProperties, attempt: int, binding: str,
+                          error: BaseException = None) -> pika.BasicProperties:
+    """Copies the properties of a failed message for its next attempt."""
+    redelivered = copy.copy(props)
+    headers = dict(props.headers or {})
+    headers.pop('x-death', None)
+    headers[ATTEMPT_HEADER] = attempt
+    headers[RETRY_BINDING_HEADER] = binding
+    if error is not None:
+        headers[ERROR_HEADER] = f'{type(error).__name__}: {error}'
+    redelivered.headers = headers
+    redelivered.expiration = None
+    return redelivered
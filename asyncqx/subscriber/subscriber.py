@@ -1,16 +1,35 @@
 import functools
 import logging
+import threading
+import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Callable, Dict, Iterable, List, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import pika
 import pika.exceptions
 from retry import retry
 
 from asyncqx.core.base import AQXBase, JSONSerializer
+from asyncqx.core.latency import STALE_DROP, check_stale_action, is_stale, message_age
+from asyncqx.core.metrics import MetricsSink, count_retries
+from asyncqx.core.rpc import reply_properties
+from asyncqx.core.serializers import DEFAULT_REGISTRY, SerializerRegistry, encode_message
+from asyncqx.core.sharding import (PartitionKey, resolve_claim, resolve_partition_key,
+                                   shard_queue_name, shard_routing_key)
+from asyncqx.core.topology import QueueSpec, Topology
 from asyncqx.core.types import EventListener, Serializer, Stringable
-from asyncqx.tools import amqp_match
+from asyncqx.subscriber.batching import BatchItem, MessageBatcher
+from asyncqx.subscriber.dedup import DedupStore
+from asyncqx.subscriber.envelope import MessageEnvelope
+from asyncqx.subscriber.lanes import LaneExecutor
+from asyncqx.subscriber.retries import (ATTEMPT_HEADER, RETRY_BINDING_HEADER, RetryPolicy,
+                                        attempt_of, binding_name, dead_letter_queue_name,
+                                        delay_queue_name, redelivery_properties)
+from asyncqx.subscriber.supervisor import WorkerSupervisor
+from asyncqx.tools import TopicRouter
+from asyncqx.transport.base import Transport
 
 LOGGER = logging.getLogger(__name__)
 
@@ -22,11 +41,102 @@ class EventBinding:
     events: Tuple[Stringable, ...]
     callback: Callable
     exclusive: bool
+    routing_keys: Tuple[str, ...] = ()
+    staleness_budget: Optional[float] = None
+    name: Optional[str] = None  # unique on the queue, for redeliveries to the binding
+
+    @property
+    def bound_keys(self) -> Tuple[Stringable, ...]:
+        """The routing keys the queue is bound with, the events unless they
+        are published under other keys, as sharded events are."""
+        return self.routing_keys or self.events
+
+
+class LateBindingMixin:
+    """Collects event bindings grouped by exchange and queue until they are
+    applied to a channel when consuming starts."""
+    _late_bindings: Dict[Tuple[str, str], List[EventBinding]]
+
+    def _add_late_binding(self, exchange, queue_name, events, exclusive, callback,
+                          routing_keys: Tuple[str, ...] = (),
+                          staleness_budget: Optional[float] = None,
+                          name: Optional[str] = None):
+        exchange = str(exchange)
+        queue_name = str(queue_name)
 
+        events = tuple(str(event) for event in events)
 
-class AQXSubscriber (AQXBase):
+        binding_key = (exchange, queue_name)
+        self._late_bindings.setdefault(binding_key, [])
+        self._late_bindings[binding_key].append(
+            EventBinding(
+                events=events,
+                callback=callback,
+                exclusive=exclusive,
+                routing_keys=routing_keys,
+                staleness_budget=staleness_budget,
+                name=name))
+
+    def _binding_name(self, exchange, queue_name, callback) -> str:
+        """Names a binding uniquely among the bindings of its queue."""
+        bindings = self._late_bindings.get((str(exchange), str(queue_name)), ())
+        return binding_name(callback, [binding.name for binding in bindings if binding.name])
+
+
+class AQXSubscriber (LateBindingMixin, AQXBase):
+    """Consumes events from RabbitMQ and dispatches them to bound callbacks.
+
+    By default messages are auto-acked and callbacks run on the connection
+    thread, one at a time. With `auto_ack=False` each message is acked once
+    its callbacks succeed, or rejected without requeueing when one fails,
+    and `prefetch_count` bounds how many unacked messages the broker sends.
+    With `callback_threads` callbacks run on a thread pool while the
+    connection thread keeps servicing heartbeats; acks are handed back to
+    the connection thread with `add_callback_threadsafe`.
+
+    With `lanes` callbacks run on that many threads instead, each with its
+    own queue. Messages are assigned a lane by hashing their
+    `partition_key`, their correlation id by default, so messages with the
+    same key are handled one at a time in delivery order while other keys
+    are handled concurrently. With manual acks each lane queue holds up to
+    `prefetch_count` messages, which defaults to LANE_DEPTH per lane, so the
+    broker stops delivering before a hot key can queue more; with auto_ack
+    a full lane blocks the connection thread.
+
+    Bindings made with a `batch_size` get lists of `(event, payload, props)`
+    rather than one message per call. Messages are decoded as they arrive
+    and buffered per binding until the batch is full or `max_wait` seconds
+    have passed since its first message. With manual acks a batch is
+    settled with a single `multiple=True` ack or nack when no delivery
+    ahead of it on the channel is still unsettled, and one by one otherwise.
+
+    Messages from publishers created with `stamp_publish_time=True` carry a
+    nanosecond publish time. Their publish to receive and publish to handled
+    lags are reported to the metrics sink, and messages older than
+    `staleness_budget` seconds are logged and, with `on_stale='drop'`, acked
+    without being decoded or handled.
+
+    Bindings made with a `retry_policy` hand failed messages back to the
+    broker instead of dropping them: they are republished to a delay queue
+    that returns them to the binding after the policy's backoff, and to a
+    dead-letter exchange once their attempts run out. The message is then
+    settled as handled once the broker confirms the republish, so the
+    consumer never waits out a backoff, and requeued if the republish fails.
+
+    With a `dedup` store, deliveries whose `message_id` was already seen on
+    their queue are acked without being decoded or handled, so a message
+    published or delivered twice is handled once. An id is recorded when
+    the delivery arrives, so a concurrent duplicate is skipped too, and
+    forgotten again when its callback fails or its batch is dropped, so a
+    redelivery of it is handled. An id is not forgotten if the consumer
+    process dies while handling it, so with a store outliving the process,
+    such as a FileDedupStore, the broker's redelivery of that message is
+    skipped as a duplicate.
+    """
     RETRY_DELAY = AQXBase.RETRY_DELAY
     RETRY_JITTER = AQXBase.RETRY_JITTER
+    BATCH_MAX_WAIT = 1.0  # seconds
+    LANE_DEPTH = 16
 
     def __init__(self,
                  amqp_url: str = None,
@@ -34,40 +144,126 @@ class AQXSubscriber (AQXBase):
                  default_serializer=None,
                  default_exchange=None,
                  default_queue=None,
-                 default_exclusive=False):
-        super().__init__(amqp_url=amqp_url)
+                 default_exclusive=False,
+                 serializers: SerializerRegistry = None,
+                 auto_ack: bool = True,
+                 prefetch_count: int = 0,
+                 callback_threads: int = 0,
+                 lanes: int = 0,
+                 partition_key: Union[str, PartitionKey] = None,
+                 transport: Transport = None,
+                 metrics: MetricsSink = None,
+                 staleness_budget: float = None,
+                 on_stale: str = STALE_DROP,
+                 topology: Topology = None,
+                 dedup: DedupStore = None):
+        super().__init__(amqp_url=amqp_url, transport=transport, metrics=metrics,
+                         topology=topology)
+        check_stale_action(on_stale)
 
         self.default_serializer = default_serializer or JSONSerializer()
         self.default_exchange = default_exchange or 'asyncqx'
         self.default_queue = default_queue or ''
         self.default_exclusive = default_exclusive
+        self.serializers = serializers or DEFAULT_REGISTRY
+        self.staleness_budget = staleness_budget
+        self.on_stale = on_stale
+        self.dedup = dedup
+
+        if callback_threads and lanes:
+            raise ValueError('callback_threads and lanes cannot be combined')
+
+        self.auto_ack = auto_ack
+        self.callback_threads = callback_threads
+        self.lanes = lanes
+        # Only called when dispatching to lanes
+        self.partition_key = resolve_partition_key(partition_key)
+        # Without a prefetch limit the broker pushes every ready message into
+        # the thread pool's queue, so default it to the pool size.
+        self.prefetch_count = prefetch_count or (
+            (callback_threads or lanes * self.LANE_DEPTH) if not auto_ack else 0)
+
+        if callback_threads and auto_ack:
+            LOGGER.warning(
+                'callback threads with auto_ack do not bound in-flight messages')
+
+        self._executor: Union[ThreadPoolExecutor, LaneExecutor] = None
 
         self._late_bindings: Dict[Tuple[Stringable,
                                         Stringable], List[EventBinding]] = {}
+        self._batchers: List[MessageBatcher] = []
+
+        # Delivery tags not yet acked or rejected on the consuming channel
+        self._unsettled: Set[int] = set()
+        self._unsettled_channel = None
+
+        self._reply_channel = None
+        self._retry_channel = None
 
     def bind(self,
              *events: Stringable,
              queue_name: Stringable = None,
              exchange: Stringable = None,
              exclusive: bool = None,
-             serializer: Serializer = None):
+             serializer: Serializer = None,
+             envelope: bool = False,
+             staleness_budget: float = None,
+             batch_size: int = None,
+             max_wait: float = None,
+             shards: int = None,
+             claim: Iterable[int] = None,
+             retry_policy: RetryPolicy = None):
         """Create a decorate to bind callbacks to one or more events.
 
         Args:
             queue_name (Stringable, optional): The name of the queue to receive events from. If None then the default is used.
             exchange (Stringable, optional): The exchange the queue is bound to. If None then the default is used.
             exclusive (bool, optional): If the subscriber should be the only one. Defaults to False.
-            serializer (Serializer, optional): The Serializer to use for deserializing messages. If None then the default is used.
+            serializer (Serializer, optional): The Serializer to use for deserializing messages. Messages stamped with another
+                registered content type are decoded with the registered serializer instead. If None then the default is used.
+            envelope (bool, optional): Pass the callback the MessageEnvelope instead of the decoded payload,
+                for handlers that only forward or inspect the raw body. Defaults to False.
+            staleness_budget (float, optional): The maximum age in seconds of stamped messages to handle. If None then
+                the subscriber's budget is used. Bindings sharing a queue drop messages over the largest of their budgets.
+            batch_size (int, optional): Call the callback with lists of up to this many (event, payload, props)
+                tuples instead of once per message. A batched binding must have its queue to itself.
+            max_wait (float, optional): The most seconds to wait for a batch to fill before handling it anyway.
+                Defaults to BATCH_MAX_WAIT.
+            shards (int, optional): Consume events published by a publisher sharding them over this many
+                shards. Shard i is the queue `{queue_name}.{i}`, bound to the events with a `.{i}` suffix.
+            claim (Iterable[int], optional): The shards this subscriber consumes, so consumers on several
+                nodes can split the shards between them. Defaults to every shard.
+            retry_policy (RetryPolicy, optional): Redeliver messages the callback fails on after a delay, and
+                dead-letter them once the policy's attempts are used up. If None then they are dropped.
+
+        Raises:
+            ValueError: shards or retry_policy is given without a queue name, or claim has shards out of
+                range, or retry_policy is combined with batch_size. The decorator raises it for a batch_size
+                below 1 or a negative max_wait.
 
         Returns:
             Decorator: Returns a decorator which can bind function as an event callback.
         """
 
         exchange = exchange or self.default_exchange
+        if staleness_budget is None:
+            staleness_budget = self.staleness_budget
         serializer = serializer or self.default_serializer
         queue_name = queue_name or self.default_queue
         exclusive = exclusive if exclusive is not None else self.default_exclusive
 
+        if retry_policy is not None and (not queue_name or batch_size is not None):
+            raise ValueError('retrying bindings need a queue name and cannot be batched')
+
+        if shards is None:
+            queues = [(queue_name, ())]
+        elif not queue_name:
+            raise ValueError('sharded bindings need a queue name')
+        else:
+            queues = [(shard_queue_name(str(queue_name), shard),
+                       tuple(shard_routing_key(str(event), shard) for event in events))
+                      for shard in resolve_claim(shards, claim)]
+
         def decorator(callback: EventListener):
             """Binds an EventListener callback to the specified events and queue.
 
@@ -81,40 +277,180 @@ class AQXSubscriber (AQXBase):
                 'late-binding callback %s to events %s from queue %s',
                 callback, events, queue_name)
 
+            if batch_size is not None:
+                for bound_queue, routing_keys in queues:
+                    self._add_late_binding(
+                        exchange,
+                        bound_queue,
+                        events,
+                        exclusive,
+                        callback=self._create_batcher(
+                            callback, bound_queue, serializer, envelope, staleness_budget,
+                            batch_size, self.BATCH_MAX_WAIT if max_wait is None else max_wait),
+                        routing_keys=routing_keys)
+                return callback
+
             @functools.wraps(callback)
-            def message_callback(unused_ch, unused_method, props, body):
+            def message_callback(unused_ch, method, props, body, name: str,
+                                 retry_queue: str = None):
+                headers = props.headers
+                if headers and headers.get(RETRY_BINDING_HEADER, name) != name:
+                    # A redelivery for another binding on the queue
+                    return True
+
+                message = MessageEnvelope.wrap(method, props, body)
                 event = props.type
                 source = props.app_id
 
                 LOGGER.info(
                     'received message type %s from source %s of length %s',
-                    event, source, len(body))
+                    event, source, len(message))
 
+                metrics = self.metrics
+                stage = 'decode'
                 try:
-                    data = serializer.decode(body)
+                    started = time.perf_counter() if metrics is not None else 0.0
+                    data = message if envelope else message.decode(
+                        self.serializers.resolve(props, serializer))
+
+                    stage = 'callback'
+                    if metrics is None:
+                        callback(event, data, props)
+                        return True
+
+                    tags = {'event': event, 'queue': queue_name or None}
+                    decoded = time.perf_counter()
                     callback(event, data, props)
 
+                    metrics.increment('consume', tags=tags)
+                    metrics.observe('decode.latency', decoded - started, tags=tags)
+                    metrics.observe('callback.latency', time.perf_counter() - decoded, tags=tags)
+                    lag = message_age(props)
+                    if lag is not None:
+                        metrics.observe('handled.lag', lag, tags=tags)
+                    return True
+
                 except Exception as error:
+                    if metrics is not None:
+                        metrics.increment(f'{stage}.error', tags={
+                            'event': event, 'queue': queue_name or None,
+                            'error': type(error).__name__})
                     LOGGER.error(traceback.format_exc())
                     LOGGER.error(
                         'error in callback for message type %s from source %s: %s',
                         event, source, error)
-
-            self._add_late_binding(
-                exchange,
-                queue_name,
-                events,
-                exclusive,
-                callback=message_callback)
+                    if retry_queue is None:
+                        return False
+
+                    return self._retry(retry_policy, name, str(exchange), retry_queue, props,
+                                       message.data, error, final=stage == 'decode')
+
+            for bound_queue, routing_keys in queues:
+                if retry_policy is not None:
+                    self._declare_retry_topology(retry_policy, str(exchange), str(bound_queue))
+                name = self._binding_name(exchange, bound_queue, callback)
+                self._add_late_binding(
+                    exchange,
+                    bound_queue,
+                    events,
+                    exclusive,
+                    callback=functools.partial(
+                        message_callback, name=name,
+                        retry_queue=None if retry_policy is None else str(bound_queue)),
+                    routing_keys=routing_keys,
+                    staleness_budget=staleness_budget,
+                    name=name)
 
             return callback
 
         return decorator
 
-    @retry(pika.exceptions.AMQPConnectionError, delay=RETRY_DELAY, jitter=RETRY_JITTER)
-    def consume(self):
+    def bind_rpc(self,
+                 *events: Stringable,
+                 queue_name: Stringable = None,
+                 exchange: Stringable = None,
+                 exclusive: bool = None,
+                 serializer: Serializer = None):
+        """Create a decorator to bind request handlers to one or more events.
+
+        Handlers are called like event callbacks and what they return is
+        sent back to the caller of AQXPublisher.call, encoded with the
+        serializer. When a handler raises, the caller gets an RpcError and
+        the request is settled like a failed callback. Handlers competing
+        for requests should share a named queue.
+
+        Args:
+            queue_name (Stringable, optional): The name of the queue to receive requests from. If None then the default is used.
+            exchange (Stringable, optional): The exchange the queue is bound to. If None then the default is used.
+            exclusive (bool, optional): If the subscriber should be the only one. Defaults to False.
+            serializer (Serializer, optional): The Serializer for requests and replies. If None then the default is used.
+
+        Returns:
+            Decorator: Returns a decorator which can bind function as a request handler.
+        """
+        serializer = serializer or self.default_serializer
+
+        def decorator(handler: EventListener):
+            @functools.wraps(handler)
+            def responder(event, payload, props):
+                if not props.reply_to:
+                    LOGGER.warning('request %s from %s has no reply_to', event, props.app_id)
+                    return handler(event, payload, props)
+
+                try:
+                    encoded = encode_message(serializer, handler(event, payload, props))
+                except Exception as error:
+                    self._reply(props.reply_to, reply_properties(props, None, error=error), b'')
+                    raise
+                self._reply(props.reply_to, reply_properties(props, None, encoded), encoded.body)
+
+            self.bind(*events, queue_name=queue_name, exchange=exchange,
+                      exclusive=exclusive, serializer=serializer)(responder)
+            return handler
+
+        return decorator
+
+    def consume(self, workers: int = 1):
         """Create all queues and exchanges and begin consuming events.
 
+        Args:
+            workers (int, optional): The number of worker processes to consume with. Each worker opens
+                its own connection and competes for messages on the durable queues. Anonymous queues get
+                one queue per worker, so each worker receives every matching event. Defaults to 1.
+
+        Raises:
+            ValueError: A named exclusive queue is bound and workers is greater than 1.
+        """
+        if workers == 1:
+            return self._consume()
+
+        self._check_bindings_for_workers(workers)
+        WorkerSupervisor(self, workers).run()
+
+    def stop(self):
+        """Stops consuming. Safe to call from other threads and signal handlers."""
+        if self._connection is not None and self._connection.is_open:
+            self._connection.add_callback_threadsafe(self._stop_consuming)
+
+    def _stop_consuming(self):
+        for batcher in self._batchers:
+            batcher.flush()
+        if self._channel is not None and self._channel.is_open:
+            self._channel.stop_consuming()
+
+    def _check_bindings_for_workers(self, workers: int):
+        for (unused_exchange, queue), event_bindings in self._late_bindings.items():
+            if queue == '':
+                LOGGER.info('each of %s workers consumes its own anonymous queue', workers)
+            elif any(eb.exclusive for eb in event_bindings):
+                raise ValueError(
+                    f'exclusive queue {queue} cannot be consumed by {workers} workers')
+
+    @retry(pika.exceptions.AMQPConnectionError, delay=RETRY_DELAY, jitter=RETRY_JITTER)
+    @count_retries('consume', pika.exceptions.AMQPConnectionError)
+    def _consume(self):
+        """Consume events in this process.
+
         Delayed retries on AQMPConnectionErrors
         """
         self._ensure_channel()
@@ -124,14 +460,23 @@ class AQXSubscriber (AQXBase):
             self.channel.start_consuming()
         except pika.exceptions.ConnectionClosedByBroker:
             pass
+        finally:
+            self._shutdown_executor()
 
     def _apply_late_bindings(self):
         """For each binding, create the queue and exchange and bind the callback.
 
+        Every exchange, queue and binding is recorded in the topology and
+        declared in a single pipelined batch before consuming starts.
+
         If more than one binding has been created for any combindation of queue - exchange
         then a switching function is created to act as an intermediary between the queue
         and the multiple bound functions.
         """
+        if self.prefetch_count:
+            self._channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        consumers = []
         for (exchange, queue), event_bindings in self._late_bindings.items():
             assert len(event_bindings) > 0, (
                 'exchange-queue combo is present but event_bindings is empty', exchange, queue)
@@ -139,74 +484,510 @@ class AQXSubscriber (AQXBase):
             exclusive = bool(queue == '') or any(
                 eb.exclusive for eb in event_bindings)
 
-            self._declare_queue_exchange(exchange, queue, exclusive)
-
-            if len(event_bindings) == 1:
-                message_callback = event_bindings[0].callback
+            batched = any(isinstance(eb.callback, MessageBatcher) for eb in event_bindings)
+            if batched and len(event_bindings) > 1:
+                raise ValueError(
+                    f'batched binding must have queue {queue or "(anonymous)"} '
+                    f'on exchange {exchange} to itself')
+
+            queue_spec = self._declare_queue_exchange(exchange, queue, exclusive)
+
+            if batched:
+                consumer_callback = self._create_batch_consumer_callback(
+                    event_bindings[0].callback)
+            elif len(event_bindings) == 1:
+                consumer_callback = self._create_consumer_callback(
+                    event_bindings[0].callback, queue,
+                    queue_staleness_budget(event_bindings))
             else:
-                message_callback = create_event_switch(event_bindings)
+                consumer_callback = self._create_consumer_callback(
+                    create_event_switch(event_bindings), queue,
+                    queue_staleness_budget(event_bindings))
 
             for event_binding in event_bindings:
-                for event in event_binding.events:
-                    self._channel.queue_bind(
-                        exchange=exchange,
-                        queue=queue,
-                        routing_key=event)
+                for routing_key in event_binding.bound_keys:
+                    self.topology.bind(queue_spec, exchange, routing_key)
 
-            self._channel.basic_consume(
-                queue=queue,
-                on_message_callback=message_callback,
-                auto_ack=True)
+            consumers.append((queue_spec, consumer_callback))
 
-    def _declare_queue_exchange(self, exchange, queue, exclusive):
-        self._channel.exchange_declare(
+        self.topology.apply(self._channel)
+
+        for queue_spec, consumer_callback in consumers:
+            self._channel.basic_consume(
+                queue=self.topology.queue_name(queue_spec),
+                on_message_callback=consumer_callback,
+                auto_ack=self.auto_ack)
+
+    def _create_consumer_callback(self, message_callback: Callable,
+                                  queue_name: str = '',
+                                  staleness_budget: float = None) -> Callable:
+        """Wraps a message callback to run it on the thread pool or lanes, if
+        any, and to settle the delivery once it completes. Stale deliveries
+        are dropped before they are dispatched."""
+        executor = self._ensure_executor()
+        partition_key = self.partition_key if self.lanes else None
+        dedup = self.dedup
+        check_age = self.metrics is not None or staleness_budget is not None
+
+        def on_message(ch, method, props, body):
+            if not self.auto_ack:
+                self._track_delivery(ch, method.delivery_tag)
+
+            if check_age and is_stale(props, queue_name, staleness_budget,
+                                      self.on_stale, self.metrics):
+                self._settle(ch, method.delivery_tag, True)
+                return
+
+            key = None
+            if dedup is not None:
+                key = self._dedup_key(queue_name, props)
+                if key is not None and not dedup.add(key):
+                    self._skip_duplicate(ch, method.delivery_tag, queue_name, props)
+                    return
+
+            if executor is None:
+                outcome = message_callback(ch, method, props, body)
+                self._settle_outcome(ch, method.delivery_tag, outcome, key)
+                return
+
+            def on_done(future: Future):
+                outcome = future.result() if future.exception() is None else False
+                ch.connection.add_callback_threadsafe(functools.partial(
+                    self._settle_outcome, ch, method.delivery_tag, outcome, key))
+
+            if partition_key is None:
+                future = executor.submit(message_callback, ch, method, props, body)
+            else:
+                future = executor.submit(message_callback, ch, method, props, body,
+                                         key=self._partition(partition_key, props))
+            future.add_done_callback(on_done)
+
+        return on_message
+
+    def _create_batch_consumer_callback(self, batcher: MessageBatcher) -> Callable:
+        """Decodes deliveries on the connection thread and buffers them in a
+        batcher, settling those that are dropped or fail to decode."""
+        self._ensure_executor()
+        if batcher not in self._batchers:
+            self._batchers.append(batcher)
+
+        dedup = self.dedup
+
+        def on_message(ch, method, props, body):
+            delivery_tag = method.delivery_tag
+            if not self.auto_ack:
+                self._track_delivery(ch, delivery_tag)
+            # Forgets the dedup keys of deliveries left on a closed channel
+            # before their redeliveries are checked
+            batcher.use_channel(ch)
+
+            key = None
+            if dedup is not None:
+                key = self._dedup_key(batcher.queue_name, props)
+                if key is not None and not dedup.add(key):
+                    self._skip_duplicate(ch, delivery_tag, batcher.queue_name, props)
+                    return
+
+            try:
+                item = batcher.decode(method, props, body)
+            except Exception as error:
+                if key is not None:
+                    dedup.discard(key)
+                if self.metrics is not None:
+                    self.metrics.increment('decode.error', tags={
+                        'event': props.type, 'queue': batcher.queue_name or None,
+                        'error': type(error).__name__})
+                LOGGER.error(traceback.format_exc())
+                LOGGER.error('error decoding message type %s from source %s: %s',
+                             props.type, props.app_id, error)
+                self._settle(ch, delivery_tag, False)
+                return
+
+            if item is None:
+                self._settle(ch, delivery_tag, True)
+            else:
+                batcher.add(ch, delivery_tag, item)
+
+        return on_message
+
+    def _create_batcher(self, listener: Callable, queue_name: str,
+                        serializer: Serializer, envelope: bool,
+                        staleness_budget: Optional[float], batch_size: int,
+                        max_wait: float) -> MessageBatcher:
+        if not self.auto_ack and 0 < self.prefetch_count < batch_size:
+            LOGGER.warning(
+                'prefetch_count %s is below batch_size %s, so batches from queue %s '
+                'are only handled after waiting %ss', self.prefetch_count, batch_size,
+                queue_name, max_wait)
+
+        def decode(method, props, body) -> Optional[BatchItem]:
+            """Returns the batch item for a delivery, or None if it is dropped
+            for being stale."""
+            event = props.type
+            if (self.metrics is not None or staleness_budget is not None) and is_stale(
+                    props, queue_name, staleness_budget, self.on_stale, self.metrics):
+                return None
+
+            message = MessageEnvelope.wrap(method, props, body)
+            data = message if envelope else message.decode(
+                self.serializers.resolve(props, serializer))
+            return event, data, props
+
+        return MessageBatcher(listener, decode, queue_name, batch_size, max_wait,
+                              on_flush=self._handle_batch,
+                              on_drop=functools.partial(self._forget_batch, queue_name))
+
+    def _forget_batch(self, queue_name: str, items: List[BatchItem]):
+        """Forgets the dedup keys of batched deliveries that were not
+        handled, so their redeliveries are."""
+        if self.dedup is None:
+            return
+        for unused_event, unused_data, props in items:
+            key = self._dedup_key(queue_name, props)
+            if key is not None:
+                self.dedup.discard(key)
+
+    def _handle_batch(self, batcher: MessageBatcher, channel,
+                      delivery_tags: List[int], items: List[BatchItem]):
+        """Runs a batch listener, on the thread pool if any, and settles
+        the batch once it completes."""
+        executor = self._executor
+        if executor is None:
+            succeeded = self._call_batch_listener(batcher, items)
+            if not succeeded:
+                self._forget_batch(batcher.queue_name, items)
+            self._settle_batch(channel, delivery_tags, succeeded)
+            return
+
+        def on_done(future: Future):
+            succeeded = future.exception() is None and future.result()
+            if not succeeded:
+                self._forget_batch(batcher.queue_name, items)
+            channel.connection.add_callback_threadsafe(
+                functools.partial(self._settle_batch, channel, delivery_tags, succeeded))
+
+        future = executor.submit(self._call_batch_listener, batcher, items)
+        future.add_done_callback(on_done)
+
+    def _call_batch_listener(self, batcher: MessageBatcher,
+                             items: List[BatchItem]) -> bool:
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        try:
+            succeeded = batcher.listener(items) is not False
+        except Exception as error:
+            if metrics is not None:
+                metrics.increment('callback.error', tags={
+                    'queue': batcher.queue_name or None, 'error': type(error).__name__})
+            LOGGER.error(traceback.format_exc())
+            LOGGER.error('error in batch callback for %s messages from queue %s: %s',
+                         len(items), batcher.queue_name, error)
+            return False
+
+        if metrics is not None:
+            tags = {'queue': batcher.queue_name or None, 'batch': True}
+            metrics.increment('consume', len(items), tags=tags)
+            metrics.observe('callback.latency', time.perf_counter() - started, tags=tags)
+        return succeeded
+
+    def _ensure_executor(self) -> Union[ThreadPoolExecutor, LaneExecutor, None]:
+        if self._executor is not None:
+            return self._executor
+
+        if self.callback_threads:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.callback_threads,
+                thread_name_prefix='asyncqx-callback')
+        elif self.lanes:
+            depth = self.LANE_DEPTH if self.auto_ack else self.prefetch_count
+            self._executor = LaneExecutor(self.lanes, depth)
+        return self._executor
+
+    def _reply(self, reply_to: str, props: pika.BasicProperties, body: bytes):
+        """Sends a reply from the connection thread."""
+        publish = functools.partial(self._publish_reply, reply_to, props, body)
+        if self._executor is None:
+            publish()
+        else:
+            self._connection.add_callback_threadsafe(publish)
+
+    def _publish_reply(self, reply_to: str, props: pika.BasicProperties, body: bytes):
+        # Replies go out on a channel without publisher confirms, as the
+        # caller is waiting on them rather than the subscriber
+        try:
+            if self._reply_channel is None or not self._reply_channel.is_open:
+                self._reply_channel = self._connection.channel()
+            self._reply_channel.basic_publish('', reply_to, body, props)
+        except pika.exceptions.AMQPError as err:
+            LOGGER.warning('could not reply to %s: %s', reply_to, err)
+
+    @staticmethod
+    def _dedup_key(queue_name: str, props: pika.BasicProperties) -> Optional[str]:
+        """Identifies a delivery by its queue and message id. Retries are
+        told apart by their attempt, as each is a new delivery to handle."""
+        message_id = props.message_id
+        if message_id is None:
+            return None
+        attempt = (props.headers or {}).get(ATTEMPT_HEADER)
+        if attempt is None:
+            return f'{queue_name}:{message_id}'
+        return f'{queue_name}:{message_id}:{attempt}'
+
+    def _skip_duplicate(self, channel, delivery_tag: int, queue_name: str,
+                        props: pika.BasicProperties):
+        if self.metrics is not None:
+            self.metrics.increment('duplicate', tags={
+                'event': props.type, 'queue': queue_name or None})
+        LOGGER.info('skipping duplicate message %s of type %s from source %s',
+                    props.message_id, props.type, props.app_id)
+        self._settle(channel, delivery_tag, True)
+
+    def _declare_retry_topology(self, policy: RetryPolicy, exchange: str, queue_name: str):
+        """Records the delay queues returning failed messages to a queue and
+        the dead-letter queue for those out of attempts."""
+        for delay_ms in policy.delays_ms():
+            self.topology.declare_queue(delay_queue_name(queue_name, delay_ms), arguments={
+                'x-message-ttl': delay_ms,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue_name,
+            })
+
+        dead_letter_exchange = policy.dead_letter_exchange_for(exchange)
+        self.topology.declare_exchange(dead_letter_exchange, exchange_type='direct')
+        dead_letters = self.topology.declare_queue(dead_letter_queue_name(queue_name))
+        self.topology.bind(dead_letters, dead_letter_exchange, queue_name)
+
+    def _retry(self, policy: RetryPolicy, binding: str, exchange: str, queue_name: str,
+               props: pika.BasicProperties, body: bytes, error: BaseException,
+               final: bool) -> Future:
+        """Sends a failed message to the delay queue of its next attempt, or
+        to the dead-letter exchange, from the connection thread.
+
+        Returns a future resolved on the connection thread with whether the
+        broker confirmed the message.
+        """
+        attempt = attempt_of(props)
+        if final or attempt >= policy.max_attempts:
+            target = (policy.dead_letter_exchange_for(exchange), queue_name)
+            props = redelivery_properties(props, attempt, binding, error)
+            outcome = 'dead_letter'
+        else:
+            target = ('', delay_queue_name(queue_name, policy.delay_ms(attempt)))
+            props = redelivery_properties(props, attempt + 1, binding, error)
+            outcome = 'redelivery'
+
+        if self.metrics is not None:
+            self.metrics.increment(outcome, tags={'event': props.type, 'queue': queue_name})
+        LOGGER.info('sending message type %s to %s after attempt %s',
+                    props.type, target[1], attempt)
+
+        published: Future = Future()
+        publish = functools.partial(self._publish_retry, *target, props, body, published)
+        if self._executor is None:
+            publish()
+        else:
+            self._connection.add_callback_threadsafe(publish)
+        return published
+
+    def _publish_retry(self, exchange: str, routing_key: str,
+                       props: pika.BasicProperties, body: bytes, published: Future):
+        # Waits for the confirm, so a message is only settled as handled
+        # once the broker holds its redelivery
+        try:
+            if self._retry_channel is None or not self._retry_channel.is_open:
+                self._retry_channel = self._connection.channel()
+                self._retry_channel.confirm_delivery()
+            self._retry_channel.basic_publish(exchange, routing_key, body, props, mandatory=True)
+        except pika.exceptions.AMQPError as err:
+            LOGGER.error('could not send message type %s to %s for another attempt: %s',
+                         props.type, routing_key, err)
+            published.set_result(False)
+        else:
+            published.set_result(True)
+
+    def _settle_outcome(self, channel, delivery_tag: int, outcome, dedup_key: Optional[str]):
+        """Settles a delivery by what its message callback returned: False
+        for a failure, or the future of the republish of a failed message.
+
+        Must be called on the connection thread.
+        """
+        if isinstance(outcome, Future):
+            outcome.add_done_callback(functools.partial(
+                self._settle_republished, channel, delivery_tag, dedup_key))
+            return
+
+        if outcome is False and dedup_key is not None:
+            self.dedup.discard(dedup_key)
+        self._settle(channel, delivery_tag, outcome)
+
+    def _settle_republished(self, channel, delivery_tag: int, dedup_key: Optional[str],
+                            published: Future):
+        """Acks a failed delivery once the broker holds its next attempt, or
+        requeues it if the republish failed, so the message is never lost."""
+        if published.result():
+            self._settle(channel, delivery_tag, True)
+            return
+
+        if dedup_key is not None:
+            self.dedup.discard(dedup_key)
+        LOGGER.warning('requeueing delivery %s, as its next attempt was not sent', delivery_tag)
+        self._settle(channel, delivery_tag, False, requeue=True)
+
+    @staticmethod
+    def _partition(partition_key: PartitionKey, props: pika.BasicProperties):
+        try:
+            return partition_key(props)
+        except Exception as error:
+            LOGGER.error('error reading the partition key of message type %s, '
+                         'dispatching it unordered: %s', props.type, error)
+            return None
+
+    def _track_delivery(self, channel, delivery_tag: int):
+        if channel is not self._unsettled_channel:
+            # Delivery tags start over on a new channel
+            self._unsettled = set()
+            self._unsettled_channel = channel
+        self._unsettled.add(delivery_tag)
+
+    def _settle_batch(self, channel, delivery_tags: List[int], succeeded: bool):
+        """Acks or rejects a batch of deliveries when consuming with manual acks.
+
+        A multiple=True ack or nack settles every unsettled delivery up to
+        its tag, so it is only used when the batch holds all of them.
+        Must be called on the connection thread.
+        """
+        if self.auto_ack:
+            return
+
+        last = delivery_tags[-1]
+        if channel is not self._unsettled_channel or sum(
+                1 for tag in self._unsettled if tag <= last) != len(delivery_tags):
+            for delivery_tag in delivery_tags:
+                self._settle(channel, delivery_tag, succeeded)
+            return
+
+        if not channel.is_open:
+            LOGGER.warning('channel closed before a batch of %s deliveries was settled; '
+                           'the broker will redeliver them', len(delivery_tags))
+            return
+
+        if succeeded is False:
+            channel.basic_nack(delivery_tag=last, multiple=True, requeue=False)
+        else:
+            channel.basic_ack(delivery_tag=last, multiple=True)
+        self._unsettled.difference_update(delivery_tags)
+
+    def _settle(self, channel, delivery_tag: int, succeeded: bool, requeue: bool = False):
+        """Acks or rejects a delivery when consuming with manual acks.
+
+        Must be called on the connection thread.
+        """
+        if self.auto_ack:
+            return
+
+        self._unsettled.discard(delivery_tag)
+        if not channel.is_open:
+            LOGGER.warning('channel closed before delivery %s was settled; '
+                           'the broker will redeliver it', delivery_tag)
+            return
+
+        if succeeded is False:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+        else:
+            channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _declare_queue_exchange(self, exchange, queue, exclusive) -> QueueSpec:
+        self.topology.declare_exchange(
             exchange,
             exchange_type='topic',
             durable=True)
 
-        self._channel.queue_declare(
+        return self.topology.declare_queue(
             queue,
             durable=not exclusive,
             exclusive=exclusive,
-            auto_delete=exclusive)
+            auto_delete=exclusive,
+            alias=exchange)
 
-    def _add_late_binding(self, exchange, queue_name, events, exclusive, callback):
-        exchange = str(exchange)
-        queue_name = str(queue_name)
 
-        events = tuple(str(event) for event in events)
-
-        binding_key = (exchange, queue_name)
-        self._late_bindings.setdefault(binding_key, [])
-        self._late_bindings[binding_key].append(
-            EventBinding(
-                events=events,
-                callback=callback,
-                exclusive=exclusive))
+def queue_staleness_budget(event_bindings: Iterable[EventBinding]) -> Optional[float]:
+    """The staleness budget of a queue's deliveries. Bindings sharing a queue
+    only drop messages older than the largest of their budgets, and none if
+    any of them has no budget."""
+    budgets = [event_binding.staleness_budget for event_binding in event_bindings]
+    if None in budgets:
+        return None
+    return max(budgets)
 
 
 def create_event_switch(event_bindings: Iterable[EventBinding]) -> Callable:
     """Returns a function that will switch callbacks based on the event type.
 
     This allows multiple different callbacks to be bound to the same queue for
-    cleaner code.
+    cleaner code. The binding patterns are compiled into a TopicRouter once, so
+    dispatching a message costs a cache lookup rather than a pattern match per
+    binding.
 
     Args:
-        event_bindings (Iterable[EventBinding]): [description]
+        event_bindings (Iterable[EventBinding]): The bindings sharing a queue.
 
     Returns:
-        Callable: [description]
+        Callable: A pika message callback dispatching to the matching bindings.
     """
+    router: TopicRouter[EventBinding] = TopicRouter()
+    for event_binding in event_bindings:
+        for pattern in event_binding.events:
+            router.add(str(pattern), event_binding)
+
     def switch(ch, method, props: pika.BasicProperties, body):
         event = props.type
         assert event is not None
 
-        for event_binding in event_bindings:
-            if any(amqp_match(str(event), str(pattern)) for pattern in event_binding.events):
-                try:
-                    event_binding.callback(ch, method, props, body)
-                except Exception as err:
-                    LOGGER.error(traceback.format_exc())
-                    LOGGER.error('error switching event %s: %s', event, err)
+        succeeded = True
+        republished: List[Future] = []
+        message = MessageEnvelope.wrap(method, props, body)
+        for event_binding in router.match(str(event)):
+            try:
+                outcome = event_binding.callback(ch, method, props, message)
+            except Exception as err:
+                succeeded = False
+                LOGGER.error(traceback.format_exc())
+                LOGGER.error('error switching event %s: %s', event, err)
+                continue
+            if isinstance(outcome, Future):
+                republished.append(outcome)
+            elif outcome is False:
+                succeeded = False
+
+        # A binding that failed without retrying settles the delivery as a
+        # failure whatever became of the republishes of the others
+        if not succeeded or not republished:
+            return succeeded
+        return all_republished(republished)
 
     return switch
+
+
+def all_republished(futures: List[Future]) -> Future:
+    """Returns a future resolving to whether every one of the republish
+    futures of a delivery resolved True, once they all have."""
+    combined: Future = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(unused_future: Future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        combined.set_result(all(
+            future.exception() is None and future.result() is True for future in futures))
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return combined
@@ -0,0 +1,146 @@
+"""Runs a subscriber in several worker processes."""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Dict, List
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WorkerSupervisor:
+    """Starts N worker processes consuming with the same subscriber and keeps
+    them running.
+
+    Workers are forked so they inherit the subscriber's late bindings,
+    including closures, without pickling. Each worker opens its own
+    connection and consumes the same durable queues as a competing consumer.
+    A worker that dies is restarted; SIGINT or SIGTERM stops every worker
+    and waits for them to shut down.
+    """
+    RESTART_DELAY = 1  # seconds
+    SHUTDOWN_TIMEOUT = 30  # seconds
+
+    def __init__(self, subscriber, workers: int):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+
+        try:
+            self._context = multiprocessing.get_context('fork')
+        except ValueError as err:
+            raise RuntimeError(
+                'consuming with several workers requires the fork start method') from err
+
+        self.subscriber = subscriber
+        self.workers = workers
+
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._stopping = False
+
+    @property
+    def pids(self) -> List[int]:
+        return [process.pid for process in self._processes.values()
+                if process.is_alive()]
+
+    def run(self):
+        """Starts the workers and supervises them until stopped.
+
+        Signal handlers are only installed when called from the main thread;
+        otherwise `stop` must be called to end supervision.
+        """
+        previous_handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            previous_handlers = {
+                signum: signal.signal(signum, self._on_signal)
+                for signum in (signal.SIGINT, signal.SIGTERM)}
+
+        try:
+            for index in range(self.workers):
+                self._start_worker(index)
+
+            while not self._stopping:
+                sentinels = [process.sentinel
+                             for process in self._processes.values()]
+                multiprocessing.connection.wait(sentinels, timeout=0.5)
+                self._restart_dead_workers()
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self._stop_workers()
+
+    def stop(self):
+        """Asks the supervisor to stop its workers and return from run."""
+        self._stopping = True
+
+    def _on_signal(self, signum, unused_frame):
+        LOGGER.info('received signal %s, stopping workers', signum)
+        self.stop()
+
+    def _start_worker(self, index: int):
+        process = self._context.Process(
+            target=_run_worker,
+            args=(self.subscriber, index),
+            name=f'asyncqx-worker-{index}',
+            daemon=True)
+        process.start()
+
+        LOGGER.info('started worker %s with pid %s', index, process.pid)
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    def _restart_dead_workers(self):
+        for index, process in list(self._processes.items()):
+            if process.is_alive() or self._stopping:
+                continue
+
+            LOGGER.warning('worker %s with pid %s exited with code %s',
+                           index, process.pid, process.exitcode)
+            process.join()
+
+            # Avoid a tight restart loop when workers die straight away
+            uptime = time.monotonic() - self._started_at[index]
+            if uptime < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY - uptime)
+
+            if not self._stopping:
+                self._start_worker(index)
+
+    def _stop_workers(self):
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.SHUTDOWN_TIMEOUT
+        for index, process in self._processes.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                LOGGER.warning('worker %s did not stop in time, killing it', index)
+                process.kill()
+                process.join()
+
+        self._processes = {}
+
+
+def _run_worker(subscriber, index: int):
+    # Connections inherited from the parent must never be used by a child
+    subscriber._connection = None
+    subscriber._channel = None
+
+    def on_signal(unused_signum, unused_frame):
+        if subscriber._connection is None or not subscriber._connection.is_open:
+            sys.exit(0)
+        subscriber.stop()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    LOGGER.info('worker %s consuming in pid %s', index, os.getpid())
+    try:
+        subscriber._consume()
+    finally:
+        subscriber.close()
@@ -1,13 +1,115 @@
 """Contains some general tools used by asyncqx"""
-import re
+import functools
+from collections import OrderedDict
+from typing import Dict, Generic, List, Sequence, Tuple, TypeVar
+
+T = TypeVar('T')
+
+WORD_SEPARATOR = '.'
+SINGLE_WORD = '*'
+ANY_WORDS = '#'
+
+
+class _TrieNode:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.values: List[Tuple[int, object]] = []
+
+
+class TopicRouter(Generic[T]):
+    """Matches routing keys against topic exchange binding patterns.
+
+    Patterns are compiled once into a trie of words. A `*` word matches
+    exactly one word and a `#` word matches zero or more words, following
+    the RabbitMQ topic exchange semantics. Resolved routing keys are
+    memoized in a bounded LRU cache so repeated event types are resolved
+    with a single dictionary lookup.
+    """
+
+    def __init__(self, cache_size: int = 1024):
+        self._root = _TrieNode()
+        self._count = 0
+        self._cache_size = cache_size
+        self._cache: 'OrderedDict[str, Tuple[T, ...]]' = OrderedDict()
+
+    def add(self, pattern: str, value: T) -> None:
+        """Adds a binding pattern that resolves to the given value.
+
+        Values are returned by `match` in the order they were added. A value
+        added under several patterns is returned at most once per key.
+        """
+        node = self._root
+        for word in pattern.split(WORD_SEPARATOR):
+            node = node.children.setdefault(word, _TrieNode())
+        node.values.append((self._count, value))
+        self._count += 1
+        self._cache.clear()
+
+    def match(self, key: str) -> Tuple[T, ...]:
+        """Returns the values of all patterns matching the routing key."""
+        try:
+            values = self._cache[key]
+            self._cache.move_to_end(key)
+            return values
+        except KeyError:
+            pass
+
+        values = self._resolve(key)
+
+        if self._cache_size > 0:
+            self._cache[key] = values
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return values
+
+    def _resolve(self, key: str) -> Tuple[T, ...]:
+        found: Dict[int, object] = {}
+        _collect(self._root, key.split(WORD_SEPARATOR), 0, found)
+
+        values: List[T] = []
+        seen = set()
+        for order in sorted(found):
+            value = found[order]
+            if id(value) not in seen:
+                seen.add(id(value))
+                values.append(value)  # type: ignore
+        return tuple(values)
+
+
+def _collect(node: _TrieNode, words: Sequence[str], index: int,
+             found: Dict[int, object]) -> None:
+    any_words = node.children.get(ANY_WORDS)
+    if any_words is not None:
+        # `#` may swallow any number of the remaining words, including none
+        for start in range(index, len(words) + 1):
+            _collect(any_words, words, start, found)
+
+    if index == len(words):
+        for order, value in node.values:
+            found[order] = value
+        return
+
+    child = node.children.get(words[index])
+    if child is not None:
+        _collect(child, words, index + 1, found)
+
+    single_word = node.children.get(SINGLE_WORD)
+    if single_word is not None:
+        _collect(single_word, words, index + 1, found)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_pattern(pattern: str) -> TopicRouter[bool]:
+    router: TopicRouter[bool] = TopicRouter(cache_size=0)
+    router.add(pattern, True)
+    return router
 
 
-# https://stackoverflow.com/questions/50679145/how-to-match-the-routing-key-with-binding-pattern-for-rabbitmq-topic-exchange-us
 def amqp_match(key: str, pattern: str) -> bool:
     """Checks if a string matches a pattern used by RabbitMQ topic exchange."""
     if key == pattern:
         return True
-    replaced = pattern.replace(r'*', r'([^.]+)').replace(r'#', r'([^.]+.?)+')
-    regex_string = f"^{replaced}$"
-    match = re.search(regex_string, key)
-    return match is not None
+    return bool(_compile_pattern(pattern).match(key))
@@ -0,0 +1,2 @@
+from .base import PikaTransport, Transport
+from .memory import InMemoryBroker, InMemoryTransport
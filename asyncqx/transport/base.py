@@ -0,0 +1,35 @@
+from typing import Any, Optional, Protocol
+
+import pika
+from pika.adapters import blocking_connection
+
+from asyncqx.core.confirms import PipelinedConfirmChannel
+
+
+class Transport(Protocol):
+    """Opens the connections AQXBase publishes and consumes through.
+
+    Connections and channels returned by a transport provide the subset of
+    the pika BlockingConnection and BlockingChannel interfaces used by
+    asyncqx, so the same publisher and subscriber code runs against any
+    back end.
+    """
+
+    def connect(self, amqp_url: Optional[str]) -> Any:
+        """Returns an open BlockingConnection-like connection."""
+
+    def pipelined_channel(self, connection: Any) -> Any:
+        """Returns a channel with the PipelinedConfirmChannel interface."""
+
+
+class PikaTransport:
+    """Connects to a RabbitMQ broker with pika's BlockingConnection."""
+
+    def connect(self, amqp_url: Optional[str]) -> blocking_connection.BlockingConnection:
+        connection_parameters = pika.URLParameters(
+            amqp_url) if amqp_url else None
+        return pika.BlockingConnection(connection_parameters)
+
+    def pipelined_channel(self, connection: blocking_connection.BlockingConnection
+                          ) -> PipelinedConfirmChannel:
+        return PipelinedConfirmChannel(connection.channel())
@@ -0,0 +1,889 @@
+"""An in-process stand-in for a RabbitMQ broker.
+
+Implements enough of AMQP 0-9-1 for the full asyncqx publish / consume path
+to run at memory speed: direct, fanout and topic exchanges, durable,
+exclusive and auto-delete queues, server-named queues, bindings, publisher
+confirms, mandatory returns, manual acks with prefetch, queue message TTLs,
+dead-lettering of rejected and expired messages, direct reply-to and
+connection.blocked notifications.
+
+Like pika's BlockingConnection, a connection is used from one thread at a
+time and delivers messages only while that thread is consuming or
+processing data events. Publishing from other connections on other threads
+is safe.
+"""
+import copy
+import functools
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import pika.exceptions
+from pika import frame, spec
+from pika.adapters.blocking_connection import ReturnedMessage
+
+from asyncqx.tools import TopicRouter
+
+LOGGER = logging.getLogger(__name__)
+
+NOT_FOUND = 404
+RESOURCE_LOCKED = 405
+PRECONDITION_FAILED = 406
+CONNECTION_FORCED = 320
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class _Message:
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body', 'redelivered')
+
+    def __init__(self, exchange: str, routing_key: str,
+                 properties: spec.BasicProperties, body: bytes):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = False
+
+
+class _Exchange:
+
+    def __init__(self, name: str, exchange_type: str, durable: bool,
+                 auto_delete: bool, arguments: dict):
+        self.name = name
+        self.type = exchange_type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+        self.bindings: List[Tuple[str, str]] = []
+        self._router: Optional[TopicRouter[str]] = None
+
+    def bind(self, routing_key: str, queue_name: str):
+        if (routing_key, queue_name) not in self.bindings:
+            self.bindings.append((routing_key, queue_name))
+            self._router = None
+
+    def unbind(self, routing_key: str = None, queue_name: str = None):
+        self.bindings = [
+            (key, name) for key, name in self.bindings
+            if not (name == queue_name and routing_key in (None, key))]
+        self._router = None
+
+    def route(self, routing_key: str) -> List[str]:
+        if self.type == 'fanout':
+            names = [name for _, name in self.bindings]
+        elif self.type == 'topic':
+            if self._router is None:
+                self._router = TopicRouter()
+                for key, name in self.bindings:
+                    self._router.add(key, name)
+            names = list(self._router.match(routing_key))
+        else:
+            names = [name for key, name in self.bindings if key == routing_key]
+
+        # Routers dedupe by identity, and equal queue names may be distinct
+        # strings, so a queue bound with several matching keys is deduped here
+        return list(dict.fromkeys(names))
+
+
+class _Consumer:
+
+    def __init__(self, tag: str, channel: 'InMemoryChannel', queue_name: str,
+                 callback: Callable, auto_ack: bool, prefetch_count: int):
+        self.tag = tag
+        self.channel = channel
+        self.queue_name = queue_name
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+        self.active = True
+
+    @property
+    def has_capacity(self) -> bool:
+        return self.active and (self.auto_ack or self.prefetch_count == 0 or
+                                self.unacked < self.prefetch_count)
+
+
+class _Queue:
+
+    def __init__(self, name: str, durable: bool, owner: Optional['InMemoryConnection'],
+                 auto_delete: bool, arguments: dict):
+        self.name = name
+        self.durable = durable
+        self.owner = owner
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+        self.messages: Deque[_Message] = deque()
+        self.consumers: List[_Consumer] = []
+        self._next_consumer = 0
+
+    def next_consumer(self) -> Optional[_Consumer]:
+        count = len(self.consumers)
+        for offset in range(count):
+            index = (self._next_consumer + offset) % count
+            consumer = self.consumers[index]
+            if consumer.has_capacity:
+                self._next_consumer = index + 1
+                return consumer
+        return None
+
+
+class InMemoryBroker:
+    """A process-local broker shared by every InMemoryTransport given it."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._exchanges: Dict[str, _Exchange] = {
+            '': _Exchange('', 'direct', True, False, {})}
+        self._queues: Dict[str, _Queue] = {}
+        self._connections: Set['InMemoryConnection'] = set()
+        self.available = True
+        self.blocked_reason: Optional[str] = None
+
+        # Messages in queues with an x-message-ttl, by expiry time
+        self._expiries: List[Tuple[float, int, str, _Message]] = []
+        self._expiry_ids = itertools.count()
+        self._expired = threading.Condition(self._lock)
+        self._reaper: Optional[threading.Thread] = None
+
+    def connect(self) -> 'InMemoryConnection':
+        if not self.available:
+            raise pika.exceptions.AMQPConnectionError('broker is unavailable')
+
+        connection = InMemoryConnection(self)
+        with self._lock:
+            self._connections.add(connection)
+        return connection
+
+    def close_connections(self, reply_code: int = CONNECTION_FORCED,
+                          reply_text: str = 'CONNECTION_FORCED'):
+        """Closes every client connection, as a broker restart would."""
+        with self._lock:
+            connections = list(self._connections)
+
+        for connection in connections:
+            connection._close_by_broker(reply_code, reply_text)
+
+    def block_connections(self, reason: str = 'low on memory'):
+        """Notifies every connection that the broker blocked it, as a
+        resource alarm would. Publishes are not actually held back."""
+        with self._lock:
+            self.blocked_reason = reason
+            connections = list(self._connections)
+
+        for connection in connections:
+            connection._notify_blocked(reason)
+
+    def unblock_connections(self):
+        with self._lock:
+            self.blocked_reason = None
+            connections = list(self._connections)
+
+        for connection in connections:
+            connection._notify_unblocked()
+
+    def queue_depth(self, queue_name: str) -> int:
+        """Returns the number of ready messages in a queue."""
+        with self._lock:
+            return len(self._queues[queue_name].messages)
+
+    def consumer_count(self, queue_name: str) -> int:
+        """Returns the number of consumers on a queue, 0 if it does not exist."""
+        with self._lock:
+            queue_ = self._queues.get(queue_name)
+            return len(queue_.consumers) if queue_ is not None else 0
+
+    def has_exchange(self, name: str) -> bool:
+        return name in self._exchanges
+
+    def has_queue(self, name: str) -> bool:
+        return name in self._queues
+
+    def bindings(self, exchange: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._exchanges[exchange].bindings)
+
+    # Operations below are called by channels with the broker lock held
+
+    def _declare_exchange(self, name: str, exchange_type: str, passive: bool,
+                          durable: bool, auto_delete: bool, arguments: dict):
+        exchange = self._exchanges.get(name)
+        if exchange is None:
+            if passive:
+                raise _channel_error(NOT_FOUND, f"no exchange '{name}'")
+            self._exchanges[name] = _Exchange(
+                name, exchange_type, durable, auto_delete, arguments)
+        elif not passive and (exchange.type != exchange_type or
+                              exchange.durable != durable):
+            raise _channel_error(
+                PRECONDITION_FAILED,
+                f"inequivalent arg for exchange '{name}'")
+
+    def _declare_queue(self, connection: 'InMemoryConnection', name: str,
+                       passive: bool, durable: bool, exclusive: bool,
+                       auto_delete: bool, arguments: dict) -> _Queue:
+        existing = self._queues.get(name)
+        if existing is not None:
+            if existing.owner is not None and existing.owner is not connection:
+                raise _channel_error(
+                    RESOURCE_LOCKED,
+                    f"cannot obtain exclusive access to locked queue '{name}'")
+            if not passive and existing.durable != durable:
+                raise _channel_error(
+                    PRECONDITION_FAILED,
+                    f"inequivalent arg 'durable' for queue '{name}'")
+            return existing
+
+        if passive:
+            raise _channel_error(NOT_FOUND, f"no queue '{name}'")
+
+        name = name or f'amq.gen-{uuid.uuid4().hex}'
+        created = _Queue(name, durable, connection if exclusive else None,
+                         auto_delete, arguments)
+        self._queues[name] = created
+        # Every queue is bound to the default exchange by its name
+        self._exchanges[''].bind(name, name)
+        return created
+
+    def _delete_queue(self, name: str):
+        queue_ = self._queues.pop(name, None)
+        if queue_ is None:
+            return
+        for consumer in queue_.consumers:
+            consumer.active = False
+        for exchange in self._exchanges.values():
+            exchange.unbind(queue_name=name)
+
+    def _get_queue(self, name: str) -> _Queue:
+        queue_ = self._queues.get(name)
+        if queue_ is None:
+            raise _channel_error(NOT_FOUND, f"no queue '{name}'")
+        return queue_
+
+    def _get_exchange(self, name: str) -> _Exchange:
+        exchange = self._exchanges.get(name)
+        if exchange is None:
+            raise _channel_error(NOT_FOUND, f"no exchange '{name}'")
+        return exchange
+
+    def _publish(self, message: _Message) -> bool:
+        """Routes a message to its queues. Returns False if it was unroutable."""
+        exchange = self._get_exchange(message.exchange)
+        queue_names = exchange.route(message.routing_key)
+
+        routed = False
+        for name in queue_names:
+            queue_ = self._queues.get(name)
+            if queue_ is None:
+                continue
+            routed = True
+            copied = _Message(message.exchange, message.routing_key,
+                              _copy_properties(message.properties), message.body)
+            queue_.messages.append(copied)
+            ttl = queue_.arguments.get('x-message-ttl')
+            if ttl is not None:
+                self._expire_later(name, copied, ttl / 1000)
+            self._dispatch(queue_)
+
+        return routed
+
+    def _expire_later(self, queue_name: str, message: _Message, ttl: float):
+        heapq.heappush(self._expiries, (time.monotonic() + ttl, next(self._expiry_ids),
+                                        queue_name, message))
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_expired,
+                                            name='asyncqx-memory-ttl', daemon=True)
+            self._reaper.start()
+        self._expired.notify()
+
+    def _reap_expired(self):
+        """Dead-letters messages still queued when their TTL runs out."""
+        with self._lock:
+            while True:
+                if not self._expiries:
+                    self._expired.wait()
+                    continue
+
+                deadline, _, queue_name, message = self._expiries[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._expired.wait(remaining)
+                    continue
+
+                heapq.heappop(self._expiries)
+                queue_ = self._queues.get(queue_name)
+                if queue_ is not None and message in queue_.messages:
+                    queue_.messages.remove(message)
+                    self._dead_letter(queue_name, message, 'expired')
+
+    def _dispatch(self, queue_: _Queue):
+        while queue_.messages:
+            consumer = queue_.next_consumer()
+            if consumer is None:
+                return
+            consumer.channel._deliver(consumer, queue_.messages.popleft())
+
+    def _requeue(self, queue_name: str, message: _Message):
+        queue_ = self._queues.get(queue_name)
+        if queue_ is None:
+            return
+        message.redelivered = True
+        queue_.messages.appendleft(message)
+        self._dispatch(queue_)
+
+    def _dead_letter(self, queue_name: str, message: _Message, reason: str):
+        queue_ = self._queues.get(queue_name)
+        if queue_ is None:
+            return
+
+        exchange = queue_.arguments.get('x-dead-letter-exchange')
+        if exchange is None or exchange not in self._exchanges:
+            return
+
+        properties = _copy_properties(message.properties)
+        headers = dict(properties.headers or {})
+        deaths = list(headers.get('x-death') or [])
+        deaths.insert(0, {
+            'queue': queue_name,
+            'reason': reason,
+            'exchange': message.exchange,
+            'routing-keys': [message.routing_key],
+        })
+        headers['x-death'] = deaths
+        properties.headers = headers
+
+        routing_key = queue_.arguments.get(
+            'x-dead-letter-routing-key', message.routing_key)
+        self._publish(_Message(exchange, routing_key, properties, message.body))
+
+    def _consumer_cancelled(self, consumer: _Consumer):
+        queue_ = self._queues.get(consumer.queue_name)
+        if queue_ is None:
+            return
+        if consumer in queue_.consumers:
+            queue_.consumers.remove(consumer)
+        if queue_.auto_delete and not queue_.consumers:
+            self._delete_queue(queue_.name)
+
+    def _connection_closed(self, connection: 'InMemoryConnection'):
+        self._connections.discard(connection)
+        for name, queue_ in list(self._queues.items()):
+            if queue_.owner is connection:
+                self._delete_queue(name)
+
+
+def _channel_error(reply_code: int, reply_text: str):
+    return pika.exceptions.ChannelClosedByBroker(reply_code, reply_text)
+
+
+def _copy_properties(properties: spec.BasicProperties) -> spec.BasicProperties:
+    copied = copy.copy(properties)
+    if properties.headers is not None:
+        copied.headers = dict(properties.headers)
+    return copied
+
+
+class InMemoryChannel:
+    """The BlockingChannel-like channel of an InMemoryConnection."""
+
+    def __init__(self, connection: 'InMemoryConnection', channel_number: int):
+        self._connection = connection
+        self._broker = connection._broker
+        self.channel_number = channel_number
+
+        self._open = True
+        self._confirming = False
+        self._prefetch_count = 0
+        self._last_queue = ''
+        self._delivery_tags = itertools.count(1)
+        self._consumers: Dict[str, _Consumer] = {}
+        self._unacked: Dict[int, Tuple[str, _Message, _Consumer]] = {}
+        self._return_callbacks: List[Callable] = []
+        self._consuming = False
+        self._reply_to: Optional[str] = None
+
+    @property
+    def connection(self) -> 'InMemoryConnection':
+        return self._connection
+
+    @property
+    def is_open(self) -> bool:
+        return self._open and self._connection.is_open
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    @property
+    def consumer_tags(self) -> List[str]:
+        return list(self._consumers)
+
+    def close(self, reply_code: int = 0, reply_text: str = 'Normal shutdown'):
+        with self._broker._lock:
+            self._close()
+
+    def confirm_delivery(self):
+        self._raise_if_closed()
+        self._confirming = True
+
+    def add_on_return_callback(self, callback: Callable):
+        self._return_callbacks.append(callback)
+
+    def exchange_declare(self, exchange: str, exchange_type='direct',
+                         passive: bool = False, durable: bool = False,
+                         auto_delete: bool = False, internal: bool = False,
+                         arguments: dict = None):
+        exchange_type = getattr(exchange_type, 'value', exchange_type)
+        with self._broker._lock:
+            self._raise_if_closed()
+            self._call(self._broker._declare_exchange, exchange, exchange_type,
+                       passive, durable, auto_delete, arguments or {})
+        return frame.Method(self.channel_number, spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue: str, passive: bool = False,
+                      durable: bool = False, exclusive: bool = False,
+                      auto_delete: bool = False, arguments: dict = None):
+        with self._broker._lock:
+            self._raise_if_closed()
+            declared = self._call(self._broker._declare_queue,
+                                  self._connection, queue, passive, durable,
+                                  exclusive, auto_delete, arguments or {})
+            self._last_queue = declared.name
+            return frame.Method(self.channel_number, spec.Queue.DeclareOk(
+                queue=declared.name,
+                message_count=len(declared.messages),
+                consumer_count=len(declared.consumers)))
+
+    def queue_bind(self, queue: str, exchange: str, routing_key: str = None,
+                   arguments: dict = None):
+        with self._broker._lock:
+            self._raise_if_closed()
+            queue = queue or self._last_queue
+            self._call(self._broker._get_queue, queue)
+            bound = self._call(self._broker._get_exchange, exchange)
+            bound.bind(queue if routing_key is None else routing_key, queue)
+        return frame.Method(self.channel_number, spec.Queue.BindOk())
+
+    def queue_unbind(self, queue: str, exchange: str = None,
+                     routing_key: str = None, arguments: dict = None):
+        with self._broker._lock:
+            self._raise_if_closed()
+            queue = queue or self._last_queue
+            self._call(self._broker._get_exchange, exchange).unbind(
+                queue if routing_key is None else routing_key, queue)
+        return frame.Method(self.channel_number, spec.Queue.UnbindOk())
+
+    def queue_delete(self, queue: str, if_unused: bool = False,
+                     if_empty: bool = False):
+        with self._broker._lock:
+            self._raise_if_closed()
+            self._broker._delete_queue(queue or self._last_queue)
+        return frame.Method(self.channel_number, spec.Queue.DeleteOk())
+
+    def queue_purge(self, queue: str):
+        with self._broker._lock:
+            self._raise_if_closed()
+            purged = self._call(self._broker._get_queue, queue or self._last_queue)
+            count = len(purged.messages)
+            purged.messages.clear()
+        return frame.Method(self.channel_number,
+                            spec.Queue.PurgeOk(message_count=count))
+
+    def basic_qos(self, prefetch_size: int = 0, prefetch_count: int = 0,
+                  global_qos: bool = False):
+        self._raise_if_closed()
+        self._prefetch_count = prefetch_count
+
+    def basic_consume(self, queue: str, on_message_callback: Callable,
+                      auto_ack: bool = False, exclusive: bool = False,
+                      consumer_tag: str = None, arguments: dict = None) -> str:
+        with self._broker._lock:
+            self._raise_if_closed()
+            if queue == DIRECT_REPLY_TO:
+                queue = self._consume_direct_reply_to(auto_ack)
+            consumed = self._call(self._broker._get_queue, queue or self._last_queue)
+            consumer_tag = consumer_tag or f'ctag{self.channel_number}.{uuid.uuid4().hex}'
+            consumer = _Consumer(consumer_tag, self, consumed.name,
+                                 on_message_callback, auto_ack,
+                                 self._prefetch_count)
+            self._consumers[consumer_tag] = consumer
+            consumed.consumers.append(consumer)
+            self._broker._dispatch(consumed)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag: str):
+        with self._broker._lock:
+            consumer = self._consumers.pop(consumer_tag, None)
+            if consumer is not None:
+                consumer.active = False
+                self._broker._consumer_cancelled(consumer)
+        return []
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes,
+                      properties: spec.BasicProperties = None,
+                      mandatory: bool = False):
+        properties = properties or spec.BasicProperties()
+        with self._broker._lock:
+            self._raise_if_closed()
+            if properties.reply_to == DIRECT_REPLY_TO:
+                if self._reply_to is None:
+                    self._fail(PRECONDITION_FAILED,
+                               'PRECONDITION_FAILED - fast reply consumer does not exist')
+                properties = _copy_properties(properties)
+                properties.reply_to = self._reply_to
+
+            message = _Message(exchange, routing_key, properties, bytes(body))
+            routed = self._call(self._broker._publish, message)
+
+        if routed or not mandatory:
+            return
+
+        returned = ReturnedMessage(
+            spec.Basic.Return(312, 'NO_ROUTE', exchange, routing_key),
+            message.properties, message.body)
+
+        if self._confirming:
+            raise pika.exceptions.UnroutableError([returned])
+
+        for callback in self._return_callbacks:
+            self._connection._post(
+                lambda callback=callback: callback(
+                    self, returned.method, returned.properties, returned.body))
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+        self._settle(delivery_tag, multiple, lambda name, message: None)
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False,
+                   requeue: bool = True):
+        if requeue:
+            self._settle(delivery_tag, multiple, self._broker._requeue)
+        else:
+            self._settle(delivery_tag, multiple, self._reject)
+
+    def basic_reject(self, delivery_tag: int = 0, requeue: bool = True):
+        self.basic_nack(delivery_tag, multiple=False, requeue=requeue)
+
+    def start_consuming(self):
+        """Processes deliveries until every consumer on the channel is cancelled."""
+        self._consuming = True
+        try:
+            while self._consuming and self._consumers:
+                self._connection._process_events(0.1)
+                self._raise_if_closed()
+        finally:
+            self._consuming = False
+
+    def stop_consuming(self, consumer_tag: str = None):
+        for tag in [consumer_tag] if consumer_tag else list(self._consumers):
+            self.basic_cancel(tag)
+        self._consuming = False
+
+    def _consume_direct_reply_to(self, auto_ack: bool) -> str:
+        """Stands in for the direct reply-to pseudo-queue with an exclusive
+        queue that replies are routed to by its name. Lock must be held."""
+        if not auto_ack:
+            self._fail(PRECONDITION_FAILED,
+                       'PRECONDITION_FAILED - reply consumer cannot acknowledge')
+        if self._reply_to is None:
+            self._reply_to = f'{DIRECT_REPLY_TO}.{uuid.uuid4().hex}'
+            self._broker._declare_queue(self._connection, self._reply_to, False,
+                                        False, True, True, {})
+        return self._reply_to
+
+    def _reject(self, queue_name: str, message: _Message):
+        self._broker._dead_letter(queue_name, message, 'rejected')
+
+    def _settle(self, delivery_tag: int, multiple: bool, dispose: Callable):
+        with self._broker._lock:
+            self._raise_if_closed()
+            if multiple:
+                tags = [tag for tag in self._unacked
+                        if delivery_tag == 0 or tag <= delivery_tag]
+            elif delivery_tag in self._unacked:
+                tags = [delivery_tag]
+            else:
+                self._fail(PRECONDITION_FAILED,
+                           f'PRECONDITION_FAILED - unknown delivery tag {delivery_tag}')
+
+            touched = set()
+            for tag in tags:
+                queue_name, message, consumer = self._unacked.pop(tag)
+                consumer.unacked -= 1
+                dispose(queue_name, message)
+                touched.add(queue_name)
+
+            for queue_name in touched:
+                queue_ = self._broker._queues.get(queue_name)
+                if queue_ is not None:
+                    self._broker._dispatch(queue_)
+
+    def _deliver(self, consumer: _Consumer, message: _Message):
+        """Hands a message to a consumer. Called with the broker lock held."""
+        delivery_tag = next(self._delivery_tags)
+        if not consumer.auto_ack:
+            consumer.unacked += 1
+            self._unacked[delivery_tag] = (consumer.queue_name, message, consumer)
+
+        method = spec.Basic.Deliver(
+            consumer_tag=consumer.tag,
+            delivery_tag=delivery_tag,
+            redelivered=message.redelivered,
+            exchange=message.exchange,
+            routing_key=message.routing_key)
+
+        def deliver():
+            if consumer.active and self.is_open:
+                consumer.callback(self, method, message.properties, message.body)
+
+        self._connection._post(deliver)
+
+    def _call(self, operation: Callable, *args):
+        try:
+            return operation(*args)
+        except pika.exceptions.ChannelClosedByBroker as err:
+            self._close()
+            raise err
+
+    def _fail(self, reply_code: int, reply_text: str):
+        self._close()
+        raise _channel_error(reply_code, reply_text)
+
+    def _raise_if_closed(self):
+        self._connection._raise_if_closed()
+        if not self._open:
+            raise pika.exceptions.ChannelWrongStateError('Channel is closed.')
+
+    def _close(self):
+        """Closes the channel, requeueing unacked messages. Lock must be held."""
+        if not self._open:
+            return
+        self._open = False
+        self._consuming = False
+
+        for consumer in self._consumers.values():
+            consumer.active = False
+            self._broker._consumer_cancelled(consumer)
+        self._consumers = {}
+
+        unacked, self._unacked = self._unacked, {}
+        for queue_name, message, _ in unacked.values():
+            self._broker._requeue(queue_name, message)
+
+
+class InMemoryConnection:
+    """The BlockingConnection-like connection to an InMemoryBroker."""
+
+    def __init__(self, broker: InMemoryBroker):
+        self._broker = broker
+        self._open = True
+        self._closed_by_broker: Optional[Exception] = None
+        self._channels: Dict[int, InMemoryChannel] = {}
+        self._channel_numbers = itertools.count(1)
+        self._events: 'queue.Queue[Callable]' = queue.Queue()
+        self._timers: List[Tuple[float, int, Callable]] = []
+        self._timer_ids = itertools.count(1)
+        self._cancelled_timers: Set[int] = set()
+        self._blocked_callbacks: List[Callable] = []
+        self._unblocked_callbacks: List[Callable] = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    @property
+    def is_closed(self) -> bool:
+        return not self._open
+
+    def channel(self, channel_number: int = None) -> InMemoryChannel:
+        self._raise_if_closed()
+        channel_number = channel_number or next(self._channel_numbers)
+        channel = InMemoryChannel(self, channel_number)
+        self._channels[channel_number] = channel
+        return channel
+
+    def close(self, reply_code: int = 200, reply_text: str = 'Normal shutdown'):
+        if not self._open:
+            raise pika.exceptions.ConnectionWrongStateError(
+                'Connection is already closed')
+        with self._broker._lock:
+            self._shutdown()
+
+    def add_callback_threadsafe(self, callback: Callable):
+        self._post(callback)
+
+    def add_on_connection_blocked_callback(self, callback: Callable):
+        self._blocked_callbacks.append(callback)
+        reason = self._broker.blocked_reason
+        if reason is not None:
+            self._post(functools.partial(
+                callback, self, frame.Method(0, spec.Connection.Blocked(reason))))
+
+    def add_on_connection_unblocked_callback(self, callback: Callable):
+        self._unblocked_callbacks.append(callback)
+
+    def call_later(self, delay: float, callback: Callable) -> int:
+        timer_id = next(self._timer_ids)
+        heapq.heappush(self._timers, (time.monotonic() + delay, timer_id, callback))
+        return timer_id
+
+    def remove_timeout(self, timeout_id: int):
+        self._cancelled_timers.add(timeout_id)
+
+    def process_data_events(self, time_limit: float = 0):
+        self._process_events(time_limit)
+
+    def sleep(self, duration: float):
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._process_events(remaining)
+
+    def _post(self, callback: Callable):
+        self._events.put(callback)
+
+    def _process_events(self, time_limit: Optional[float]):
+        """Runs due timers and posted callbacks, waiting up to time_limit
+        seconds for the first one."""
+        self._raise_if_closed()
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        processed = False
+
+        while True:
+            processed = self._run_due_timers() or processed
+
+            try:
+                callback = self._events.get_nowait()
+            except queue.Empty:
+                if processed:
+                    return
+                timeout = self._wait_timeout(deadline)
+                if timeout is not None and timeout <= 0:
+                    return
+                try:
+                    callback = self._events.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+
+            callback()
+            processed = True
+            self._raise_if_closed()
+
+    def _wait_timeout(self, deadline: Optional[float]) -> Optional[float]:
+        now = time.monotonic()
+        timeouts = []
+        if deadline is not None:
+            timeouts.append(deadline - now)
+        if self._timers:
+            timeouts.append(self._timers[0][0] - now)
+        return min(timeouts) if timeouts else None
+
+    def _run_due_timers(self) -> bool:
+        ran = False
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, timer_id, callback = heapq.heappop(self._timers)
+            if timer_id in self._cancelled_timers:
+                self._cancelled_timers.discard(timer_id)
+                continue
+            callback()
+            ran = True
+        return ran
+
+    def _notify_blocked(self, reason: str):
+        method_frame = frame.Method(0, spec.Connection.Blocked(reason))
+        for callback in list(self._blocked_callbacks):
+            self._post(functools.partial(callback, self, method_frame))
+
+    def _notify_unblocked(self):
+        method_frame = frame.Method(0, spec.Connection.Unblocked())
+        for callback in list(self._unblocked_callbacks):
+            self._post(functools.partial(callback, self, method_frame))
+
+    def _raise_if_closed(self):
+        if self._closed_by_broker is not None:
+            raise self._closed_by_broker
+        if not self._open:
+            raise pika.exceptions.ConnectionWrongStateError(
+                'Connection is closed')
+
+    def _close_by_broker(self, reply_code: int, reply_text: str):
+        with self._broker._lock:
+            if not self._open:
+                return
+            self._closed_by_broker = pika.exceptions.ConnectionClosedByBroker(
+                reply_code, reply_text)
+            self._shutdown()
+        # Wake a thread waiting for events so it notices the close
+        self._post(lambda: None)
+
+    def _shutdown(self):
+        """Closes every channel and releases exclusive queues. Lock must be held."""
+        for channel in self._channels.values():
+            channel._close()
+        self._channels = {}
+        self._open = False
+        self._broker._connection_closed(self)
+
+
+class InMemoryPipelinedChannel:
+    """The in-memory counterpart of PipelinedConfirmChannel.
+
+    Messages are routed as they are published, so every outcome is known by
+    the time wait_for_confirms is called.
+    """
+
+    def __init__(self, channel: InMemoryChannel):
+        self._channel = channel
+        self._channel.confirm_delivery()
+        self._delivery_tags = itertools.count(1)
+        self._outcomes: Dict[int, Optional[Exception]] = {}
+
+    @property
+    def is_open(self) -> bool:
+        return self._channel.is_open
+
+    @property
+    def channel(self) -> InMemoryChannel:
+        return self._channel
+
+    def publish(self, exchange: str, routing_key: str, body: bytes,
+                properties: spec.BasicProperties, mandatory: bool) -> int:
+        delivery_tag = next(self._delivery_tags)
+        try:
+            self._channel.basic_publish(exchange, routing_key, body,
+                                        properties, mandatory)
+            self._outcomes[delivery_tag] = None
+        except pika.exceptions.UnroutableError as err:
+            self._outcomes[delivery_tag] = err
+        return delivery_tag
+
+    def wait_for_confirms(self) -> Dict[int, Optional[Exception]]:
+        outcomes, self._outcomes = self._outcomes, {}
+        return outcomes
+
+    def close(self):
+        if self._channel.is_open:
+            self._channel.close()
+
+
+class InMemoryTransport:
+    """Connects asyncqx clients to an InMemoryBroker."""
+
+    def __init__(self, broker: InMemoryBroker = None):
+        self.broker = broker or InMemoryBroker()
+
+    def connect(self, amqp_url: Optional[str]) -> InMemoryConnection:
+        return self.broker.connect()
+
+    def pipelined_channel(self, connection: InMemoryConnection
+                          ) -> InMemoryPipelinedChannel:
+        return InMemoryPipelinedChannel(connection.channel())
@@ -0,0 +1,66 @@
+"""Runs the benchmark suite and writes the combined results as JSON.
+
+Runs against an in-memory broker unless --amqp-url is given, so results
+from the two targets are only comparable with themselves. Compare JSON
+files from different releases to track regressions.
+
+Usage:
+    python -m benchmarks [--amqp-url URL] [--suites NAME ...] [--quick] [--json PATH]
+"""
+import argparse
+
+from benchmarks import (bench_consume, bench_event_switch, bench_latency,
+                        bench_pool, bench_prepare, bench_publish,
+                        bench_reconnect, bench_rpc, bench_serializers)
+from benchmarks.common import PAYLOAD_SIZES, Target, add_target_arguments, write_results
+
+SUITES = ('publish', 'prepare', 'pool', 'consume', 'latency', 'rpc',
+          'dispatch', 'serializers', 'reconnect')
+
+
+def run_suite(name: str, target: Target, quick: bool):
+    scale = 10 if quick else 1
+    sizes = PAYLOAD_SIZES[:2] if quick else PAYLOAD_SIZES
+
+    if name == 'publish':
+        return bench_publish.run(target, 10000 // scale, sizes)
+    if name == 'prepare':
+        return bench_prepare.run(target, 10000 // scale)
+    if name == 'pool':
+        return bench_pool.run(target, 10000 // scale)
+    if name == 'consume':
+        return bench_consume.run(target, 10000 // scale)
+    if name == 'latency':
+        return bench_latency.run(target, 2000 // scale, sizes)
+    if name == 'rpc':
+        return bench_rpc.run(target, 2000 // scale)
+    if name == 'dispatch':
+        return bench_event_switch.run([1, 10, 100], 10000 // scale)
+    if name == 'serializers':
+        return bench_serializers.run(5, sizes)
+    if name == 'reconnect':
+        return bench_reconnect.run(target, 100 // scale)
+    raise ValueError(f'unknown suite {name}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--quick', action='store_true',
+                        help='run fewer messages and payload sizes')
+    parser.set_defaults(json_path='benchmark-results.json')
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    results = {}
+    for name in args.suites:
+        print(f'running {name} against {target.name}')
+        results[name] = run_suite(name, target, args.quick)
+
+    write_results(args.json_path, target, results)
+    print(f'wrote results to {args.json_path}')
+
+
+if __name__ == '__main__':
+    main()
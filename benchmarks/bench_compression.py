@@ -0,0 +1,81 @@
+"""Measures compression ratio against CPU cost for each codec on
+representative event payloads.
+
+Usage:
+    python -m benchmarks.bench_compression [--repeat N]
+"""
+import argparse
+import random
+import string
+import timeit
+
+from asyncqx.core import CompressedSerializer, JSONSerializer
+from asyncqx.core.serializers import COMPRESSION_CODECS
+
+
+def make_record(rng: random.Random, index: int) -> dict:
+    return {
+        'id': index,
+        'uuid': ''.join(rng.choices(string.hexdigits.lower(), k=32)),
+        'status': rng.choice(['created', 'updated', 'deleted']),
+        'score': rng.random(),
+        'tags': rng.sample(['alpha', 'beta', 'gamma', 'delta', 'epsilon'], 2),
+        'description': ' '.join(rng.choices(
+            ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur'], k=12)),
+    }
+
+
+def make_payloads():
+    rng = random.Random(42)
+    return {
+        'event-200B': make_record(rng, 0),
+        'batch-10KB': [make_record(rng, index) for index in range(40)],
+        'batch-100KB': [make_record(rng, index) for index in range(400)],
+        'batch-1MB': [make_record(rng, index) for index in range(4000)],
+    }
+
+
+def run(repeat: int = 5):
+    rows = []
+    plain = JSONSerializer()
+    for name, payload in make_payloads().items():
+        raw = plain.encode(payload)
+        for codec in COMPRESSION_CODECS:
+            serializer = CompressedSerializer(plain, codec=codec, threshold=0)
+            compressed = serializer.encode(payload)
+
+            number = max(1, 200000 // len(raw))
+            compress = min(timeit.repeat(
+                lambda: serializer.encode_message(payload),
+                number=number, repeat=repeat)) / number
+            decompress = min(timeit.repeat(
+                lambda: serializer.decode(compressed),
+                number=number, repeat=repeat)) / number
+
+            rows.append({
+                'payload': name,
+                'codec': codec,
+                'raw_bytes': len(raw),
+                'compressed_bytes': len(compressed),
+                'ratio': len(raw) / len(compressed),
+                'encode_us': compress * 1e6,
+                'decode_us': decompress * 1e6,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'payload':>12} {'codec':>6} {'raw':>9} {'packed':>9} "
+          f"{'ratio':>6} {'encode us':>10} {'decode us':>10}")
+    for row in run(args.repeat):
+        print(f"{row['payload']:>12} {row['codec']:>6} {row['raw_bytes']:>9} "
+              f"{row['compressed_bytes']:>9} {row['ratio']:>6.2f} "
+              f"{row['encode_us']:>10.1f} {row['decode_us']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
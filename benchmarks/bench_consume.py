@@ -0,0 +1,106 @@
+"""Measures AQXSubscriber throughput draining a preloaded queue as the
+number of bindings sharing the queue grows.
+
+Usage:
+    python -m benchmarks.bench_consume [--amqp-url URL] [--messages N] [--json PATH]
+"""
+import argparse
+import threading
+import time
+
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+
+from benchmarks.common import (BENCH_EXCHANGE, Target, add_target_arguments,
+                               make_payload, print_rows, rate, start_consuming,
+                               stop_consuming, write_results)
+
+QUEUE = 'asyncqx-bench-consume'
+
+
+def binding_pattern(index: int) -> str:
+    return f'bench.service{index}.*'
+
+
+def run_once(target: Target, bindings: int, messages: int, payload_bytes: int,
+             auto_ack: bool) -> dict:
+    publisher = AQXPublisher('bench', default_exchange=BENCH_EXCHANGE,
+                             **target.clients())
+    subscriber = AQXSubscriber(default_exchange=BENCH_EXCHANGE,
+                               auto_ack=auto_ack,
+                               prefetch_count=0 if auto_ack else 1000,
+                               **target.clients())
+
+    received = 0
+    first = last = 0.0
+    done = threading.Event()
+
+    def on_event(event, data, props):
+        nonlocal received, first, last
+        last = time.perf_counter()
+        if received == 0:
+            first = last
+        received += 1
+        if received == messages:
+            done.set()
+
+    for index in range(bindings):
+        subscriber.bind(binding_pattern(index), queue_name=QUEUE)(on_event)
+
+    try:
+        # Declare and bind the queue the way the subscriber will, then preload it
+        channel = publisher.channel
+        channel.exchange_declare(BENCH_EXCHANGE, exchange_type='topic', durable=True)
+        channel.queue_declare(QUEUE, durable=True, exclusive=False, auto_delete=False)
+        channel.queue_purge(QUEUE)
+        for index in range(bindings):
+            channel.queue_bind(QUEUE, BENCH_EXCHANGE,
+                               routing_key=binding_pattern(index))
+
+        payload = make_payload(payload_bytes)
+        report = publisher.emit_many(
+            (f'bench.service{n % bindings}.created', payload)
+            for n in range(messages))
+        assert report.ok, 'benchmark messages were not confirmed'
+
+        thread = start_consuming(subscriber)
+        if not done.wait(300):
+            raise TimeoutError(f'consumed {received} of {messages} messages')
+        stop_consuming(subscriber, thread)
+    finally:
+        target.delete_queue(QUEUE)
+        publisher.close()
+
+    return {
+        'bindings': bindings,
+        'auto_ack': auto_ack,
+        'payload_bytes': payload_bytes,
+        'messages': messages,
+        'msgs_per_s': rate(messages - 1, last - first),
+    }
+
+
+def run(target: Target, messages: int = 10000, bindings=(1, 10, 100),
+        payload_bytes: int = 256):
+    return [run_once(target, count, messages, payload_bytes, auto_ack)
+            for count in bindings
+            for auto_ack in (True, False)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--bindings', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--payload-bytes', type=int, default=256)
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    rows = run(target, args.messages, args.bindings, args.payload_bytes)
+    print_rows(rows, ('bindings', 'auto_ack', 'payload_bytes', 'messages',
+                      'msgs_per_s'))
+    write_results(args.json_path, target, {'consume': rows})
+
+
+if __name__ == '__main__':
+    main()
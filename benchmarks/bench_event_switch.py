@@ -0,0 +1,95 @@
+"""Compares the dispatch cost of create_event_switch against the previous
+regex based switch as the number of bindings on a queue grows.
+
+Usage:
+    python -m benchmarks.bench_event_switch [--messages N]
+"""
+import argparse
+import re
+import timeit
+from types import SimpleNamespace
+
+from asyncqx.subscriber.subscriber import EventBinding, create_event_switch
+
+
+def legacy_amqp_match(key: str, pattern: str) -> bool:
+    if key == pattern:
+        return True
+    replaced = pattern.replace(r'*', r'([^.]+)').replace(r'#', r'([^.]+.?)+')
+    regex_string = f"^{replaced}$"
+    match = re.search(regex_string, key)
+    return match is not None
+
+
+def legacy_event_switch(event_bindings):
+    def switch(ch, method, props, body):
+        event = props.type
+        for event_binding in event_bindings:
+            if any(legacy_amqp_match(str(event), str(pattern)) for pattern in event_binding.events):
+                event_binding.callback(ch, method, props, body)
+
+    return switch
+
+
+def make_bindings(count: int):
+    def callback(ch, method, props, body):
+        pass
+
+    bindings = []
+    for index in range(count):
+        if index % 3 == 0:
+            events = (f'service{index}.*.created',)
+        elif index % 3 == 1:
+            events = (f'service{index}.#',)
+        else:
+            events = (f'service{index}.entity.updated', f'service{index}.entity.deleted')
+        bindings.append(EventBinding(events=events, callback=callback, exclusive=False))
+    return bindings
+
+
+def make_messages(count: int, binding_count: int):
+    messages = []
+    for index in range(count):
+        service = index % binding_count
+        props = SimpleNamespace(type=f'service{service}.entity.created')
+        messages.append(props)
+    return messages
+
+
+def run(binding_counts, messages: int, repeat: int = 5):
+    rows = []
+    for binding_count in binding_counts:
+        bindings = make_bindings(binding_count)
+        props = make_messages(messages, binding_count)
+
+        for name, factory in (('legacy', legacy_event_switch),
+                              ('router', create_event_switch)):
+            switch = factory(bindings)
+
+            def dispatch():
+                for message_props in props:
+                    switch(None, None, message_props, b'')
+
+            best = min(timeit.repeat(dispatch, number=1, repeat=repeat))
+            rows.append({
+                'bindings': binding_count,
+                'switch': name,
+                'ns_per_message': best / messages * 1e9,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--bindings', type=int, nargs='+',
+                        default=[1, 10, 50, 100])
+    args = parser.parse_args()
+
+    print(f"{'bindings':>8} {'switch':>8} {'ns/msg':>10}")
+    for row in run(args.bindings, args.messages):
+        print(f"{row['bindings']:>8} {row['switch']:>8} {row['ns_per_message']:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Measures end-to-end latency, from emit until the bound callback runs,
+across payload sizes.
+
+Messages are emitted one at a time so the latency is not inflated by
+queueing behind earlier messages. Publisher and subscriber run in the same
+process and share a clock.
+
+Usage:
+    python -m benchmarks.bench_latency [--amqp-url URL] [--messages N] [--json PATH]
+"""
+import argparse
+import threading
+import time
+
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+
+from benchmarks.common import (BENCH_EXCHANGE, PAYLOAD_SIZES, Target,
+                               add_target_arguments, make_payload, percentile,
+                               print_rows, start_consuming, stop_consuming,
+                               wait_until_routable, write_results)
+
+EVENT = 'bench.latency'
+QUEUE = 'asyncqx-bench-latency'
+SENT_HEADER = 'x-bench-sent-ns'
+
+
+def run_once(target: Target, messages: int, payload_bytes: int) -> dict:
+    publisher = AQXPublisher('bench', default_exchange=BENCH_EXCHANGE,
+                             **target.clients())
+    subscriber = AQXSubscriber(default_exchange=BENCH_EXCHANGE,
+                               **target.clients())
+
+    samples = []
+    received = threading.Semaphore(0)
+
+    @subscriber.bind(EVENT, queue_name=QUEUE, exclusive=True)
+    def on_event(event, data, props):
+        sent = (props.headers or {}).get(SENT_HEADER)
+        if sent is not None:
+            samples.append((time.perf_counter_ns() - sent) / 1e3)
+            received.release()
+
+    thread = start_consuming(subscriber)
+    try:
+        wait_until_routable(publisher, EVENT)
+
+        payload = make_payload(payload_bytes)
+        for _ in range(messages):
+            publisher.emit(EVENT, payload,
+                           headers={SENT_HEADER: time.perf_counter_ns()})
+            if not received.acquire(timeout=30):
+                raise TimeoutError('message was not delivered')
+    finally:
+        stop_consuming(subscriber, thread)
+        publisher.close()
+
+    return {
+        'payload_bytes': payload_bytes,
+        'messages': messages,
+        'p50_us': percentile(samples, 0.50),
+        'p99_us': percentile(samples, 0.99),
+        'max_us': max(samples),
+    }
+
+
+def run(target: Target, messages: int = 2000, sizes=PAYLOAD_SIZES):
+    return [run_once(target, messages, size) for size in sizes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(PAYLOAD_SIZES))
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    rows = run(target, args.messages, args.sizes)
+    print_rows(rows, ('payload_bytes', 'messages', 'p50_us', 'p99_us', 'max_us'))
+    write_results(args.json_path, target, {'latency': rows})
+
+
+if __name__ == '__main__':
+    main()
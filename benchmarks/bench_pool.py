@@ -0,0 +1,103 @@
+"""Measures emit throughput from many threads, sharing one publisher behind
+a lock or checking publishers out of an AQXPublisherPool.
+
+Modes:
+    locked  every thread emits through one AQXPublisher guarded by a lock
+    pool    every thread emits through an AQXPublisherPool of max_size threads
+
+Usage:
+    python -m benchmarks.bench_pool [--amqp-url URL] [--messages N] [--threads N ...] [--json PATH]
+"""
+import argparse
+import threading
+import time
+
+from asyncqx.publisher import AQXPublisher, AQXPublisherPool
+
+from benchmarks.common import (BENCH_EXCHANGE, Target, add_target_arguments,
+                               make_payload, print_rows, rate, write_results)
+
+EVENT = 'bench.pool'
+QUEUE = 'asyncqx-bench-pool'
+MODES = ('locked', 'pool')
+
+
+def emit_from_threads(emit, threads: int, per_thread: int, payload) -> float:
+    barrier = threading.Barrier(threads + 1)
+
+    def work():
+        barrier.wait()
+        for _ in range(per_thread):
+            emit(EVENT, payload)
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def run(target: Target, messages: int = 10000, thread_counts=(1, 2, 4, 8),
+        payload_bytes: int = 64, modes=MODES):
+    publisher = AQXPublisher('bench', default_exchange=BENCH_EXCHANGE,
+                             **target.clients())
+    lock = threading.Lock()
+
+    def locked_emit(event, payload):
+        with lock:
+            publisher.emit(event, payload)
+
+    rows = []
+    try:
+        channel = publisher.channel
+        channel.exchange_declare(BENCH_EXCHANGE, exchange_type='topic', durable=True)
+        channel.queue_declare(QUEUE, durable=True)
+        channel.queue_bind(QUEUE, BENCH_EXCHANGE, routing_key=EVENT)
+
+        payload = make_payload(payload_bytes)
+        for threads in thread_counts:
+            per_thread = max(1, messages // threads)
+            for mode in modes:
+                pool = AQXPublisherPool('bench', max_size=threads,
+                                        default_exchange=BENCH_EXCHANGE,
+                                        **target.clients())
+                emit = locked_emit if mode == 'locked' else pool.emit
+                try:
+                    # Warm up the connections the threads will use
+                    emit_from_threads(emit, threads, 1, payload)
+                    seconds = emit_from_threads(emit, threads, per_thread, payload)
+                finally:
+                    pool.close()
+                publisher.channel.queue_purge(QUEUE)
+
+                rows.append({
+                    'mode': mode,
+                    'threads': threads,
+                    'messages': per_thread * threads,
+                    'msgs_per_s': rate(per_thread * threads, seconds),
+                })
+    finally:
+        target.delete_queue(QUEUE)
+        publisher.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    rows = run(target, args.messages, args.threads, modes=args.modes)
+    print_rows(rows, ('mode', 'threads', 'messages', 'msgs_per_s'))
+    write_results(args.json_path, target, {'pool': rows})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Compares the per-call cost of AQXPublisher.emit against a prepared
+emitter from AQXPublisher.prepare.
+
+Client overhead is measured with publishing stubbed out, so it shows the
+setup work prepare saves; the broker rows include the round trip to the
+in-memory broker, or RabbitMQ with --amqp-url.
+
+Usage:
+    python -m benchmarks.bench_prepare [--amqp-url URL] [--messages N] [--json PATH]
+"""
+import argparse
+import timeit
+
+from asyncqx.publisher import AQXPublisher
+
+from benchmarks.common import (BENCH_EXCHANGE, Target, add_target_arguments,
+                               make_payload, print_rows, write_results)
+
+EVENT = 'bench.prepare'
+
+
+def measure(publisher: AQXPublisher, payload, messages: int, repeat: int):
+    emitter = publisher.prepare(EVENT)
+
+    def emit():
+        for _ in range(messages):
+            publisher.emit(EVENT, payload)
+
+    def prepared():
+        for _ in range(messages):
+            emitter(payload)
+
+    emit_s = min(timeit.repeat(emit, number=1, repeat=repeat)) / messages
+    prepared_s = min(timeit.repeat(prepared, number=1, repeat=repeat)) / messages
+    return {
+        'emit_us': emit_s * 1e6,
+        'prepared_us': prepared_s * 1e6,
+        'saving_us': (emit_s - prepared_s) * 1e6,
+        'saving_pct': (1 - prepared_s / emit_s) * 100,
+    }
+
+
+def run(target: Target, messages: int = 10000, sizes=(64, 1024), repeat: int = 5):
+    rows = []
+    publisher = AQXPublisher('bench', default_exchange=BENCH_EXCHANGE,
+                             **target.clients())
+    try:
+        for size in sizes:
+            payload = make_payload(size)
+            rows.append(dict(measure(publisher, payload, messages, repeat),
+                             path='broker', target=target.name,
+                             payload_bytes=size))
+
+        # Stub out the publish itself to isolate the client side setup
+        publisher._publish = lambda *args, **kwargs: None
+        for size in sizes:
+            payload = make_payload(size)
+            rows.append(dict(measure(publisher, payload, messages, repeat),
+                             path='client', target='none',
+                             payload_bytes=size))
+    finally:
+        publisher.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 1024])
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    rows = run(target, args.messages, args.sizes)
+    print_rows(rows, ('path', 'target', 'payload_bytes', 'emit_us',
+                      'prepared_us', 'saving_us', 'saving_pct'))
+    write_results(args.json_path, target, {'prepare': rows})
+
+
+if __name__ == '__main__':
+    main()
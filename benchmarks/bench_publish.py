@@ -0,0 +1,124 @@
+"""Measures publish throughput with and without confirms and mandatory
+routing, across payload sizes.
+
+Modes:
+    no-confirm  basic_publish on a channel without publisher confirms
+    emit        AQXPublisher.emit, waiting for each confirm
+    emit_many   AQXPublisher.emit_many, waiting once for a batch of confirms
+
+Usage:
+    python -m benchmarks.bench_publish [--amqp-url URL] [--messages N] [--json PATH]
+"""
+import argparse
+import time
+
+import pika
+
+from asyncqx.publisher import AQXPublisher
+
+from benchmarks.common import (BENCH_EXCHANGE, PAYLOAD_SIZES, Target,
+                               add_target_arguments, make_payload, print_rows,
+                               rate, scaled_count, write_results)
+
+EVENT = 'bench.publish'
+QUEUE = 'asyncqx-bench-publish'
+MODES = ('no-confirm', 'emit', 'emit_many')
+
+
+def publish_no_confirm(publisher: AQXPublisher, payload, count: int,
+                       mandatory: bool) -> float:
+    channel = publisher.connection.channel()
+    body = publisher.default_serializer.encode(payload)
+    props = pika.BasicProperties(app_id=publisher.name, type=EVENT,
+                                 content_type='application/json')
+    try:
+        start = time.perf_counter()
+        for _ in range(count):
+            channel.basic_publish(BENCH_EXCHANGE, EVENT, body, props,
+                                  mandatory=mandatory)
+        # Round trip so every message has reached the broker
+        channel.queue_declare(QUEUE, passive=True)
+        return time.perf_counter() - start
+    finally:
+        channel.close()
+
+
+def publish_emit(publisher: AQXPublisher, payload, count: int,
+                 mandatory: bool) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        publisher.emit(EVENT, payload, mandatory=mandatory)
+    return time.perf_counter() - start
+
+
+def publish_emit_many(publisher: AQXPublisher, payload, count: int,
+                      mandatory: bool, batch_size: int = 1000) -> float:
+    start = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        batch = min(batch_size, count - offset)
+        report = publisher.emit_many(((EVENT, payload) for _ in range(batch)),
+                                     mandatory=mandatory)
+        assert report.ok, 'benchmark messages were not confirmed'
+    return time.perf_counter() - start
+
+
+PUBLISHERS = {
+    'no-confirm': publish_no_confirm,
+    'emit': publish_emit,
+    'emit_many': publish_emit_many,
+}
+
+
+def run(target: Target, messages: int = 10000, sizes=PAYLOAD_SIZES,
+        modes=MODES):
+    publisher = AQXPublisher('bench', default_exchange=BENCH_EXCHANGE,
+                             **target.clients())
+    rows = []
+    try:
+        # A bound queue so mandatory messages are routable
+        channel = publisher.channel
+        channel.exchange_declare(BENCH_EXCHANGE, exchange_type='topic', durable=True)
+        channel.queue_declare(QUEUE, durable=True)
+        channel.queue_bind(QUEUE, BENCH_EXCHANGE, routing_key=EVENT)
+
+        for size in sizes:
+            payload = make_payload(size)
+            count = scaled_count(messages, size)
+            for mode in modes:
+                for mandatory in (False, True):
+                    # Warm up the channel and exchange declaration
+                    PUBLISHERS[mode](publisher, payload, 1, mandatory)
+                    seconds = PUBLISHERS[mode](publisher, payload, count, mandatory)
+                    publisher.channel.queue_purge(QUEUE)
+
+                    rows.append({
+                        'mode': mode,
+                        'mandatory': mandatory,
+                        'payload_bytes': size,
+                        'messages': count,
+                        'msgs_per_s': rate(count, seconds),
+                        'mb_per_s': rate(count * size, seconds) / 1e6,
+                    })
+    finally:
+        target.delete_queue(QUEUE)
+        publisher.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(PAYLOAD_SIZES))
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    rows = run(target, args.messages, args.sizes, args.modes)
+    print_rows(rows, ('mode', 'mandatory', 'payload_bytes', 'messages',
+                      'msgs_per_s', 'mb_per_s'))
+    write_results(args.json_path, target, {'publish': rows})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Measures how long a publisher takes to recover when its connection is
+lost: the first emit after a close pays for a new connection and channel.
+
+Usage:
+    python -m benchmarks.bench_reconnect [--amqp-url URL] [--cycles N] [--json PATH]
+"""
+import argparse
+import time
+
+from asyncqx.publisher import AQXPublisher
+
+from benchmarks.common import (BENCH_EXCHANGE, Target, add_target_arguments,
+                               percentile, print_rows, write_results)
+
+
+def run(target: Target, cycles: int = 100):
+    publisher = AQXPublisher('bench', default_exchange=BENCH_EXCHANGE,
+                             **target.clients())
+    samples = []
+    try:
+        publisher.emit('bench.reconnect', {})
+        for _ in range(cycles):
+            publisher.connection.close()
+
+            start = time.perf_counter()
+            publisher.emit('bench.reconnect', {})
+            samples.append((time.perf_counter() - start) * 1e3)
+    finally:
+        publisher.close()
+
+    return [{
+        'cycles': cycles,
+        'p50_ms': percentile(samples, 0.50),
+        'p99_ms': percentile(samples, 0.99),
+        'max_ms': max(samples),
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--cycles', type=int, default=100)
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    rows = run(target, args.cycles)
+    print_rows(rows, ('cycles', 'p50_ms', 'p99_ms', 'max_ms'))
+    write_results(args.json_path, target, {'reconnect': rows})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Measures request / reply round trips through AQXPublisher.call and a
+handler bound with AQXSubscriber.bind_rpc.
+
+Single calls give the round trip latency; call_many batches show how many
+calls per second one client sustains with requests outstanding together.
+
+Usage:
+    python -m benchmarks.bench_rpc [--amqp-url URL] [--calls N] [--json PATH]
+"""
+import argparse
+import time
+
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+
+from benchmarks.common import (BENCH_EXCHANGE, Target, add_target_arguments,
+                               make_payload, percentile, print_rows, rate,
+                               start_consuming, stop_consuming, wait_until,
+                               write_results)
+
+EVENT = 'bench.rpc'
+QUEUE = 'asyncqx-bench-rpc'
+
+
+def run(target: Target, calls: int = 2000, batch_sizes=(1, 10, 100),
+        payload_bytes: int = 64):
+    publisher = AQXPublisher('bench', default_exchange=BENCH_EXCHANGE,
+                             **target.clients())
+    subscriber = AQXSubscriber(default_exchange=BENCH_EXCHANGE,
+                               **target.clients())
+
+    @subscriber.bind_rpc(EVENT, queue_name=QUEUE, exclusive=True)
+    def echo(event, payload, props):
+        return payload
+
+    rows = []
+    thread = start_consuming(subscriber)
+    try:
+        payload = make_payload(payload_bytes)
+        wait_until(lambda: _answers(publisher, payload))
+
+        for batch_size in batch_sizes:
+            batches = max(1, calls // batch_size)
+            samples = []
+            started = time.perf_counter()
+            for _ in range(batches):
+                sent = time.perf_counter()
+                publisher.call_many([(EVENT, payload)] * batch_size)
+                samples.append((time.perf_counter() - sent) * 1e6)
+            elapsed = time.perf_counter() - started
+
+            rows.append({
+                'batch_size': batch_size,
+                'calls': batches * batch_size,
+                'p50_us': percentile(samples, 0.50),
+                'p99_us': percentile(samples, 0.99),
+                'calls_per_s': rate(batches * batch_size, elapsed),
+            })
+    finally:
+        stop_consuming(subscriber, thread)
+        publisher.close()
+    return rows
+
+
+def _answers(publisher: AQXPublisher, payload) -> bool:
+    try:
+        publisher.call(EVENT, payload, timeout=1)
+        return True
+    except Exception:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_target_arguments(parser)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100])
+    args = parser.parse_args()
+
+    target = Target(args.amqp_url)
+    rows = run(target, args.calls, args.batch_sizes)
+    print_rows(rows, ('batch_size', 'calls', 'p50_us', 'p99_us', 'calls_per_s'))
+    write_results(args.json_path, target, {'rpc': rows})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Measures encode and decode cost of each serializer across payload sizes.
+
+Usage:
+    python -m benchmarks.bench_serializers [--repeat N] [--json PATH]
+"""
+import argparse
+import timeit
+
+from asyncqx.core import (CompressedSerializer, FastJSONSerializer,
+                          JSONSerializer, MarshalSerializer)
+
+from benchmarks.common import (PAYLOAD_SIZES, Target, make_payload, print_rows,
+                               write_results)
+
+SERIALIZERS = {
+    'json': JSONSerializer(),
+    'fast-json': FastJSONSerializer(),
+    'marshal': MarshalSerializer(),
+    'json+zlib': CompressedSerializer(JSONSerializer(), threshold=0),
+}
+
+
+def run(repeat: int = 5, sizes=PAYLOAD_SIZES):
+    rows = []
+    for size in sizes:
+        payload = make_payload(size)
+        number = max(10, 2000000 // size)
+        for name, serializer in SERIALIZERS.items():
+            encoded = serializer.encode(payload)
+            encode = min(timeit.repeat(lambda: serializer.encode(payload),
+                                       number=number, repeat=repeat)) / number
+            decode = min(timeit.repeat(lambda: serializer.decode(encoded),
+                                       number=number, repeat=repeat)) / number
+            rows.append({
+                'serializer': name,
+                'payload_bytes': size,
+                'encoded_bytes': len(encoded),
+                'encode_us': encode * 1e6,
+                'decode_us': decode * 1e6,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(PAYLOAD_SIZES))
+    parser.add_argument('--json', dest='json_path', default=None,
+                        help='write the results as JSON to this path')
+    args = parser.parse_args()
+
+    rows = run(args.repeat, args.sizes)
+    print_rows(rows, ('serializer', 'payload_bytes', 'encoded_bytes',
+                      'encode_us', 'decode_us'))
+    write_results(args.json_path, Target(), {'serializers': rows})
+
+
+if __name__ == '__main__':
+    main()
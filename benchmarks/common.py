@@ -0,0 +1,158 @@
+"""Helpers shared by the broker benchmarks: transport selection, payloads,
+timing statistics and machine-readable results."""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import pika.exceptions
+
+from asyncqx.transport import InMemoryBroker, InMemoryTransport, PikaTransport
+
+BENCH_EXCHANGE = 'asyncqx-bench'
+PAYLOAD_SIZES = (64, 1024, 16 * 1024, 256 * 1024)
+
+
+class Target:
+    """The broker a benchmark runs against: RabbitMQ when an AMQP URL is
+    given, otherwise an in-memory stand-in shared by every client."""
+
+    def __init__(self, amqp_url: str = None):
+        self.amqp_url = amqp_url
+        if amqp_url:
+            self.transport = PikaTransport()
+        else:
+            self.transport = InMemoryTransport(InMemoryBroker())
+
+    @property
+    def name(self) -> str:
+        return 'rabbitmq' if self.amqp_url else 'memory'
+
+    def clients(self) -> dict:
+        """Keyword arguments for creating publishers and subscribers."""
+        return {'amqp_url': self.amqp_url, 'transport': self.transport}
+
+    def delete_queue(self, queue_name: str):
+        connection = self.transport.connect(self.amqp_url)
+        try:
+            connection.channel().queue_delete(queue_name)
+        finally:
+            connection.close()
+
+
+def add_target_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--amqp-url', default=None,
+        help='RabbitMQ URL to benchmark against; defaults to the in-memory broker')
+    parser.add_argument(
+        '--json', dest='json_path', default=None,
+        help='write the results as JSON to this path')
+
+
+def make_payload(size: int) -> dict:
+    """Returns a JSON payload that encodes to roughly size bytes."""
+    return {'id': 1, 'data': 'x' * max(0, size - 20)}
+
+
+def scaled_count(count: int, size: int, budget: int = 64 * 1024 * 1024) -> int:
+    """Caps a message count so a run moves at most budget bytes."""
+    return max(10, min(count, budget // max(size, 1)))
+
+
+def percentile(samples: Sequence[float], fraction: float) -> float:
+    """Returns the nearest-rank percentile of samples."""
+    ordered = sorted(samples)
+    if not ordered:
+        return float('nan')
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def rate(count: int, seconds: float) -> float:
+    return count / seconds if seconds > 0 else float('inf')
+
+
+def wait_until(predicate: Callable[[], bool], timeout: float = 30,
+               interval: float = 0.01):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError('benchmark setup timed out')
+        time.sleep(interval)
+
+
+def wait_until_routable(publisher, event: str, exchange: str = BENCH_EXCHANGE,
+                        timeout: float = 30):
+    """Waits for a subscriber's bindings by emitting mandatory probes until
+    one is routed. The probe is delivered, so consumers must tolerate it."""
+    def routed() -> bool:
+        try:
+            publisher.emit(event, {'probe': True}, mandatory=True,
+                           exchange=exchange)
+            return True
+        except pika.exceptions.UnroutableError:
+            return False
+
+    wait_until(routed, timeout, interval=0.05)
+
+
+def start_consuming(subscriber) -> threading.Thread:
+    thread = threading.Thread(target=subscriber.consume, daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_consuming(subscriber, thread: threading.Thread):
+    subscriber.stop()
+    thread.join(10)
+    subscriber.close()
+
+
+def metadata(target: Target) -> dict:
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=False).stdout.strip() or None
+    except OSError:
+        revision = None
+
+    return {
+        'target': target.name,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'revision': revision,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def write_results(path: Optional[str], target: Target,
+                  results: Dict[str, List[dict]]):
+    """Writes results with run metadata as JSON; '-' writes to stdout."""
+    if path is None:
+        return
+
+    document = {'meta': metadata(target), 'results': results}
+    if path == '-':
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    with open(path, 'w') as fh:
+        json.dump(document, fh, indent=2)
+
+
+def print_rows(rows: List[dict], columns: Sequence[str]):
+    widths = [max(len(column), 10) for column in columns]
+    print(' '.join(f'{column:>{width}}' for column, width in zip(columns, widths)))
+    for row in rows:
+        cells = []
+        for column, width in zip(columns, widths):
+            value = row.get(column)
+            text = f'{value:.1f}' if isinstance(value, float) else str(value)
+            cells.append(f'{text:>{width}}')
+        print(' '.join(cells))
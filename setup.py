@@ -10,7 +10,7 @@ setup(
     author_email="drew.wagner@aquantix.ai",
     description="A publisher-subscriber implementation backed by RabbitMQ",
     url="https://github.com/Aquantix/AsyncQX",
-    packages=find_packages(),
+    packages=find_packages(exclude=("tests", "benchmarks", "benchmarks.*")),
     python_requires=">=3.8",
     install_requires=requirements
 )
@@ -0,0 +1,47 @@
+import threading
+import time
+
+import pytest
+
+from asyncqx.transport import InMemoryBroker, InMemoryTransport
+
+
+@pytest.fixture
+def transport():
+    return InMemoryTransport(InMemoryBroker())
+
+
+@pytest.fixture
+def event_queue(transport):
+    """Declares test_queue, bound to the event.# events of the test_exchange topic exchange."""
+    channel = transport.connect(None).channel()
+    channel.exchange_declare('test_exchange', exchange_type='topic', durable=True)
+    channel.queue_declare('test_queue')
+    channel.queue_bind('test_queue', 'test_exchange', routing_key='event.#')
+    return 'test_queue'
+
+
+@pytest.fixture
+def wait_for_consumer(transport):
+    """Returns a function waiting until every queue it is given has a consumer."""
+    def wait(*queue_names, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while not all(transport.broker.consumer_count(name) for name in queue_names):
+            if time.monotonic() > deadline:
+                raise AssertionError(f'queues {queue_names} were never consumed')
+            time.sleep(0.01)
+
+    return wait
+
+
+@pytest.fixture
+def consume_in_thread(wait_for_consumer):
+    """Returns a function running a subscriber's consume loop on a daemon
+    thread, returning the thread once the given queues are consumed."""
+    def consume(subscriber, *queue_names) -> threading.Thread:
+        thread = threading.Thread(target=subscriber.consume, daemon=True)
+        thread.start()
+        wait_for_consumer(*queue_names)
+        return thread
+
+    return consume
@@ -1,4 +1,4 @@
-from asyncqx.tools import amqp_match
+from asyncqx.tools import TopicRouter, amqp_match
 
 
 def test_idempotency():
@@ -13,4 +13,42 @@ def test_star_wildcard():
 
 def test_hash_wildcard():
     assert amqp_match('some.event', 'some.#')
-    assert amqp_match('some.other.event', 'some.#')
\ No newline at end of file
+    assert amqp_match('some.other.event', 'some.#')
+
+def test_hash_wildcard_matches_zero_words():
+    assert amqp_match('some', 'some.#')
+    assert amqp_match('some.event', '#.event')
+    assert amqp_match('event', '#')
+    assert amqp_match('', '#')
+
+
+def test_hash_wildcard_in_the_middle():
+    assert amqp_match('some.event', 'some.#.event')
+    assert amqp_match('some.deeply.nested.event', 'some.#.event')
+    assert not amqp_match('some.event.other', 'some.#.event')
+
+
+def test_dots_are_not_treated_as_regex():
+    assert not amqp_match('someXevent', 'some.event')
+    assert not amqp_match('some.event', 'some.*.event')
+
+
+def test_router_returns_values_in_insertion_order_once():
+    router = TopicRouter()
+    router.add('some.#', 'a')
+    router.add('some.event', 'b')
+    router.add('*.event', 'a')
+
+    assert router.match('some.event') == ('a', 'b')
+    assert router.match('some.other') == ('a',)
+    assert router.match('other.thing') == ()
+
+
+def test_router_cache_is_bounded():
+    router = TopicRouter(cache_size=2)
+    router.add('#', 'a')
+
+    for key in ('one', 'two', 'three'):
+        assert router.match(key) == ('a',)
+
+    assert list(router._cache) == ['two', 'three']
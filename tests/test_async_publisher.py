@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+from unittest import mock
+
+import pika.exceptions
+import pytest
+from pika import spec
+
+from asyncqx.publisher import AQXAsyncPublisher
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def offline_publisher():
+    publisher = AQXAsyncPublisher('test', default_exchange='test_exchange')
+    publisher._channel = mock.MagicMock()
+    publisher._channel.is_open = True
+    publisher._declared_exchanges['test_exchange'] = asyncio.get_running_loop().create_future()
+    publisher._declared_exchanges['test_exchange'].set_result(None)
+    return publisher
+
+
+def confirm(publisher, method):
+    publisher._on_delivery_confirmation(SimpleNamespace(method=method))
+
+
+def test_emits_are_pipelined_and_resolved_by_multiple_ack():
+    async def scenario():
+        publisher = offline_publisher()
+        emits = [asyncio.ensure_future(publisher.emit('some.event', {'n': n}))
+                 for n in range(3)]
+        await asyncio.sleep(0)
+
+        assert publisher.in_flight == 3
+        assert publisher._channel.basic_publish.call_count == 3
+
+        confirm(publisher, spec.Basic.Ack(delivery_tag=3, multiple=True))
+        await asyncio.gather(*emits)
+        assert publisher.in_flight == 0
+
+    run(scenario())
+
+
+def test_nack_fails_only_the_matching_emit():
+    async def scenario():
+        publisher = offline_publisher()
+        first = asyncio.ensure_future(publisher.emit('some.event', 1))
+        second = asyncio.ensure_future(publisher.emit('some.event', 2))
+        await asyncio.sleep(0)
+
+        confirm(publisher, spec.Basic.Nack(delivery_tag=2))
+        confirm(publisher, spec.Basic.Ack(delivery_tag=1))
+
+        await first
+        with pytest.raises(pika.exceptions.NackError):
+            await second
+
+    run(scenario())
+
+
+def test_returned_mandatory_message_raises_unroutable():
+    async def scenario():
+        publisher = offline_publisher()
+        emit = asyncio.ensure_future(
+            publisher.emit('some.event', 1, mandatory=True))
+        await asyncio.sleep(0)
+
+        props = publisher._channel.basic_publish.call_args.kwargs['properties']
+        assert not props.headers
+
+        publisher._confirms.on_returned(
+            None, spec.Basic.Return(312, 'NO_ROUTE', 'test_exchange', 'some.event'),
+            props, b'1')
+        confirm(publisher, spec.Basic.Ack(delivery_tag=1))
+
+        with pytest.raises(pika.exceptions.UnroutableError):
+            await emit
+
+    run(scenario())
+
+
+def test_channel_close_fails_unconfirmed_emits():
+    async def scenario():
+        publisher = offline_publisher()
+        emit = asyncio.ensure_future(publisher.emit('some.event', 1))
+        await asyncio.sleep(0)
+
+        reason = pika.exceptions.ChannelClosedByBroker(406, 'PRECONDITION_FAILED')
+        publisher._on_channel_closed(publisher._channel, reason)
+
+        with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+            await emit
+
+    run(scenario())
+
+
+def test_async_publisher_can_emit_message(rabbitmq):
+    async def scenario():
+        publisher = AQXAsyncPublisher('test', default_exchange='test_exchange')
+        try:
+            await asyncio.gather(*(publisher.emit('event.test', {'n': n})
+                                   for n in range(10)))
+        finally:
+            await publisher.close()
+
+    run(scenario())
@@ -0,0 +1,118 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from pika.spec import BasicProperties
+
+from asyncqx.subscriber import AQXAsyncSubscriber
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def deliver(subscriber, channel, delivery_tag, event, payload, queue=''):
+    callback = subscriber._late_bindings[('test_exchange', queue)][0].callback
+    method = SimpleNamespace(delivery_tag=delivery_tag)
+    props = BasicProperties(type=event)
+    subscriber._on_message(callback, channel, method, props,
+                           json.dumps(payload).encode())
+
+
+def test_coroutine_listener_is_awaited_before_ack():
+    async def scenario():
+        subscriber = AQXAsyncSubscriber(default_exchange='test_exchange')
+        channel = mock.MagicMock()
+        release = asyncio.Event()
+        received = []
+
+        @subscriber.bind('some.event')
+        async def listener(event, payload, props):
+            await release.wait()
+            received.append(payload)
+
+        deliver(subscriber, channel, 1, 'some.event', {'hello': 'world'})
+        await asyncio.sleep(0)
+        assert subscriber.in_flight == 1
+        channel.basic_ack.assert_not_called()
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert received == [{'hello': 'world'}]
+        channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+    run(scenario())
+
+
+def test_messages_are_handled_concurrently():
+    async def scenario():
+        subscriber = AQXAsyncSubscriber(default_exchange='test_exchange')
+        channel = mock.MagicMock()
+        running = 0
+        peak = 0
+
+        @subscriber.bind('some.event')
+        async def listener(event, payload, props):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        for tag in range(1, 6):
+            deliver(subscriber, channel, tag, 'some.event', tag)
+        await asyncio.gather(*subscriber._tasks)
+
+        assert peak == 5
+        assert channel.basic_ack.call_count == 5
+
+    run(scenario())
+
+
+def test_sync_listener_errors_are_isolated_and_acked():
+    async def scenario():
+        subscriber = AQXAsyncSubscriber(default_exchange='test_exchange')
+        channel = mock.MagicMock()
+        listener = mock.MagicMock(side_effect=Exception('some exception'))
+
+        subscriber.bind('some.event')(listener)
+        deliver(subscriber, channel, 1, 'some.event', {})
+        await asyncio.gather(*subscriber._tasks)
+
+        listener.assert_called_once()
+        channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+    run(scenario())
+
+
+def test_prefetch_is_tied_to_concurrency():
+    async def scenario():
+        subscriber = AQXAsyncSubscriber(default_exchange='test_exchange',
+                                        concurrency=25)
+        subscriber.bind('some.event', queue_name='same_queue')(mock.MagicMock())
+        subscriber.bind('some.other', queue_name='same_queue')(mock.MagicMock())
+
+        channel = mock.MagicMock()
+
+        def complete(*args, callback=None, **kwargs):
+            if callback is not None:
+                callback(SimpleNamespace(method=SimpleNamespace(queue='same_queue')))
+
+        for name in ('basic_qos', 'exchange_declare', 'queue_declare', 'queue_bind'):
+            getattr(channel, name).side_effect = complete
+
+        subscriber._channel = channel
+        await subscriber._apply_late_bindings()
+
+        assert channel.basic_qos.call_args.kwargs['prefetch_count'] == 25
+        assert channel.basic_consume.call_args.kwargs['auto_ack'] is False
+        assert channel.queue_bind.call_count == 2
+
+    run(scenario())
+
+
+def test_concurrency_must_be_positive():
+    with pytest.raises(ValueError):
+        AQXAsyncSubscriber(concurrency=0)
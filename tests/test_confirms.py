@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pika
+import pika.exceptions
+from pika import spec
+
+from asyncqx.publisher import AQXPublisher
+from asyncqx.core.confirms import ConfirmTracker
+
+
+def confirmation(method):
+    return SimpleNamespace(method=method)
+
+
+def track(tracker, value, mandatory=False, properties=None, body=b'{}'):
+    return tracker.track(value, 'exchange', 'some.event',
+                         properties or pika.BasicProperties(), body, mandatory)
+
+
+def test_delivery_tags_follow_publish_order():
+    tracker = ConfirmTracker()
+
+    assert [track(tracker, value) for value in 'abc'] == [1, 2, 3]
+    assert len(tracker) == 3
+
+
+def test_multiple_ack_resolves_all_earlier_messages():
+    tracker = ConfirmTracker()
+    for value in 'abc':
+        track(tracker, value)
+
+    outcomes = tracker.on_confirmation(
+        confirmation(spec.Basic.Ack(delivery_tag=2, multiple=True)))
+
+    assert outcomes == [(1, 'a', None), (2, 'b', None)]
+    assert len(tracker) == 1
+
+
+def test_nack_and_return_are_mapped_to_their_message():
+    tracker = ConfirmTracker()
+    track(tracker, 'a', mandatory=True, properties=pika.BasicProperties(message_id='a'))
+    props = pika.BasicProperties(message_id='b', headers={'tenant': 't'})
+    track(tracker, 'b', mandatory=True, properties=props)
+    track(tracker, 'c')
+
+    tracker.on_returned(None, spec.Basic.Return(312, 'NO_ROUTE', 'exchange', 'some.event'),
+                        pika.BasicProperties(message_id='b'), b'{}')
+
+    acked = tracker.on_confirmation(
+        confirmation(spec.Basic.Ack(delivery_tag=2, multiple=True)))
+    nacked = tracker.on_confirmation(
+        confirmation(spec.Basic.Nack(delivery_tag=3)))
+
+    assert acked[0] == (1, 'a', None)
+    assert isinstance(acked[1][2], pika.exceptions.UnroutableError)
+    assert isinstance(nacked[0][2], pika.exceptions.NackError)
+    assert props.headers == {'tenant': 't'}
+
+
+def test_returns_without_message_ids_match_the_earliest_same_message():
+    tracker = ConfirmTracker()
+    track(tracker, 'a', mandatory=True, body=b'1')
+    track(tracker, 'b', mandatory=True, body=b'2')
+    track(tracker, 'c', mandatory=True, body=b'2')
+
+    for _ in range(2):
+        tracker.on_returned(None, spec.Basic.Return(312, 'NO_ROUTE', 'exchange', 'some.event'),
+                            pika.BasicProperties(), b'2')
+    outcomes = tracker.on_confirmation(
+        confirmation(spec.Basic.Ack(delivery_tag=3, multiple=True)))
+
+    assert [(value, type(error)) for _, value, error in outcomes] == [
+        ('a', type(None)), ('b', pika.exceptions.UnroutableError),
+        ('c', pika.exceptions.UnroutableError)]
+
+
+def test_emit_many_serializes_then_waits_once_for_confirms():
+    publisher = AQXPublisher('test', default_exchange='test_exchange')
+
+    batch_channel = mock.MagicMock()
+    batch_channel.publish.side_effect = range(1, 4)
+    batch_channel.wait_for_confirms.return_value = {
+        1: None,
+        2: pika.exceptions.UnroutableError([]),
+        3: pika.exceptions.NackError([]),
+    }
+
+    with mock.patch.object(publisher, '_ensure_batch_channel',
+                           return_value=batch_channel):
+        report = publisher.emit_many([
+            ('some.event', {'n': 1}),
+            ('some.event', {'n': 2}, {'mandatory': True}),
+            ('other.event', {'n': 3}, {'exchange': 'other_exchange'}),
+        ])
+
+    batch_channel.wait_for_confirms.assert_called_once()
+    assert batch_channel.publish.call_args_list[1].args[4] is True
+    assert batch_channel.publish.call_args_list[2].args[0] == 'other_exchange'
+    assert [result.index for result in report.unroutable] == [1]
+    assert [result.index for result in report.nacked] == [2]
+    assert not report.ok
@@ -0,0 +1,166 @@
+import threading
+import time
+from unittest import mock
+
+import pika
+import pytest
+
+from asyncqx.core.metrics import InMemoryMetrics
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber, FileDedupStore, MemoryDedupStore
+
+
+def test_memory_store_forgets_the_oldest_keys():
+    store = MemoryDedupStore(capacity=2)
+
+    assert store.add('a')
+    assert not store.add('a')
+    assert store.add('b')
+    assert store.add('c')
+    assert len(store) == 2
+    assert store.add('a')
+
+    store.discard('c')
+    assert store.add('c')
+
+
+def test_memory_store_keys_expire():
+    store = MemoryDedupStore(ttl=0.01)
+    assert store.add('a')
+    time.sleep(0.02)
+
+    assert store.add('a')
+
+
+def test_file_store_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'dedup')
+    first = FileDedupStore(path, slots=64)
+    second = FileDedupStore(path, slots=1024)
+    try:
+        assert second.slots == 64
+        assert first.add('a')
+        assert not second.add('a')
+
+        second.discard('a')
+        assert first.add('a')
+    finally:
+        first.close()
+        second.close()
+
+
+def test_full_file_store_replaces_the_oldest_keys(tmp_path):
+    store = FileDedupStore(str(tmp_path / 'dedup'), slots=4)
+    try:
+        for n in range(100):
+            assert store.add(f'key-{n}')
+        assert not store.add('key-99')
+    finally:
+        store.close()
+
+
+def test_file_store_rejects_other_files(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'x' * 128)
+
+    with pytest.raises(ValueError):
+        FileDedupStore(str(path))
+
+
+def test_messages_get_unique_ids(transport):
+    publisher = AQXPublisher('test', default_exchange='test_exchange', transport=transport)
+    ids = []
+
+    def publish(exchange, routing_key, properties, mandatory, data):
+        ids.append(properties.message_id)
+
+    with mock.patch.object(publisher, '_publish', side_effect=publish):
+        publisher.emit('event.test', 1)
+        publisher.emit('event.test', 2)
+        emit = publisher.prepare('event.test')
+        emit(3)
+        emit(4)
+
+    assert all(ids) and len(set(ids)) == 4
+
+
+def test_duplicates_are_handled_once(transport, consume_in_thread):
+    metrics = InMemoryMetrics()
+    subscriber = AQXSubscriber(default_exchange='test_exchange', transport=transport,
+                               dedup=MemoryDedupStore(), metrics=metrics)
+    received = []
+    done = threading.Event()
+
+    @subscriber.bind('event.test', queue_name='events')
+    def on_event(event, data, props):
+        received.append(data)
+        if data == 'last':
+            done.set()
+        elif data == 'fails' and received.count('fails') == 1:
+            raise ValueError('boom')
+
+    thread = consume_in_thread(subscriber, 'events')
+
+    channel = transport.connect(None).channel()
+
+    def publish(body, message_id):
+        channel.basic_publish('test_exchange', 'event.test', body, pika.BasicProperties(
+            type='event.test', message_id=message_id, content_type='application/json'))
+
+    try:
+        publish(b'"once"', 'a')
+        publish(b'"once"', 'a')
+        publish(b'"fails"', 'b')
+        publish(b'"fails"', 'b')
+        publish(b'"anonymous"', None)
+        publish(b'"anonymous"', None)
+        publish(b'"last"', 'c')
+        assert done.wait(5)
+    finally:
+        subscriber.stop()
+        thread.join(5)
+
+    assert received == ['once', 'fails', 'fails', 'anonymous', 'anonymous', 'last']
+    assert metrics.counter('duplicate', {'event': 'event.test', 'queue': 'events'}) == 1
+
+
+def test_dropped_batches_are_handled_when_redelivered():
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False,
+                               dedup=MemoryDedupStore())
+    listener = mock.MagicMock()
+    subscriber.bind('event.test', queue_name='batch_queue', batch_size=2)(listener)
+    batcher = subscriber._late_bindings[('test_exchange', 'batch_queue')][0].callback
+    on_message = subscriber._create_batch_consumer_callback(batcher)
+
+    def deliver(channel, delivery_tag, message_id):
+        on_message(channel, mock.MagicMock(delivery_tag=delivery_tag), pika.BasicProperties(
+            type='event.test', message_id=message_id), b'{}')
+
+    # Dropped when flushed on its closed channel
+    deliver(mock.MagicMock(is_open=False), 1, 'a')
+    batcher.flush()
+    # Dropped when deliveries move to another channel
+    deliver(mock.MagicMock(), 1, 'b')
+    reopened = mock.MagicMock()
+    deliver(reopened, 1, 'a')
+    deliver(reopened, 2, 'b')
+
+    (items,), _ = listener.call_args
+    assert [props.message_id for *_, props in items] == ['a', 'b']
+    reopened.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+
+
+def test_failed_batches_are_handled_when_redelivered():
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False,
+                               dedup=MemoryDedupStore())
+    listener = mock.MagicMock(side_effect=[ValueError('boom'), None])
+    subscriber.bind('event.test', queue_name='batch_queue', batch_size=1)(listener)
+    batcher = subscriber._late_bindings[('test_exchange', 'batch_queue')][0].callback
+    on_message = subscriber._create_batch_consumer_callback(batcher)
+    channel = mock.MagicMock()
+
+    for delivery_tag in (1, 2):
+        on_message(channel, mock.MagicMock(delivery_tag=delivery_tag), pika.BasicProperties(
+            type='event.test', message_id='a'), b'{}')
+
+    assert listener.call_count == 2
+    channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
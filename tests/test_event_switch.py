@@ -1,4 +1,6 @@
 import pika
+from asyncqx.subscriber import AQXSubscriber
+from asyncqx.subscriber.envelope import MessageEnvelope
 from asyncqx.subscriber.subscriber import EventBinding, create_event_switch
 
 from unittest import mock
@@ -48,3 +50,67 @@ def test_with_multiple_bindings():
 
     mock_callback_a.assert_called_once()
     mock_callback_b.assert_called_once()
+
+
+def test_only_matching_bindings_are_called():
+    mock_callback_a = mock.MagicMock()
+    mock_callback_b = mock.MagicMock()
+
+    event_bindings = [
+        EventBinding(
+            events=('some.#',),
+            callback=mock_callback_a,
+            exclusive=False
+        ),
+        EventBinding(
+            events=('other.event',),
+            callback=mock_callback_b,
+            exclusive=False
+        )
+    ]
+
+    switch = create_event_switch(event_bindings)
+
+    mock_properties = mock.MagicMock(spec=pika.BasicProperties)
+    mock_properties.type = 'some.event'
+    switch(None, None, mock_properties, None)
+
+    mock_callback_a.assert_called_once()
+    mock_callback_b.assert_not_called()
+
+
+def test_message_is_decoded_once_for_all_matching_bindings():
+    serializer = mock.MagicMock()
+    serializer.decode.return_value = {'hello': 'world'}
+    listener_a = mock.MagicMock()
+    listener_b = mock.MagicMock()
+
+    subscriber = AQXSubscriber(default_exchange='test_exchange',
+                               default_serializer=serializer)
+    subscriber.bind('some.event', queue_name='same_queue')(listener_a)
+    subscriber.bind('some.#', queue_name='same_queue')(listener_b)
+
+    switch = create_event_switch(
+        subscriber._late_bindings[('test_exchange', 'same_queue')])
+    props = pika.BasicProperties(type='some.event')
+    switch(None, None, props, b'{"hello": "world"}')
+
+    serializer.decode.assert_called_once_with(b'{"hello": "world"}')
+    listener_a.assert_called_once_with('some.event', {'hello': 'world'}, props)
+    listener_b.assert_called_once_with('some.event', {'hello': 'world'}, props)
+
+
+def test_envelope_listeners_receive_a_zero_copy_body():
+    received = []
+    subscriber = AQXSubscriber(default_exchange='test_exchange')
+    subscriber.bind('some.event', envelope=True)(
+        lambda event, message, props: received.append(message))
+
+    callback = subscriber._late_bindings[('test_exchange', '')][0].callback
+    body = bytearray(b'{"hello": "world"}')
+    callback(None, None, pika.BasicProperties(type='some.event'), body)
+
+    message = received[0]
+    assert isinstance(message, MessageEnvelope)
+    assert message.body.obj is body
+    assert message.decode(subscriber.default_serializer) == {'hello': 'world'}
@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+
+import pytest
+
+from asyncqx.core.metrics import InMemoryMetrics
+from asyncqx.publisher import (AQXPublisher, BrokerBlockedError, FlowControl,
+                               RateLimitedError)
+from asyncqx.publisher.flow import TokenBucket
+
+
+pytestmark = pytest.mark.usefixtures('event_queue')
+
+
+def make_publisher(transport, **kwargs):
+    flow = FlowControl(**kwargs)
+    flow.POLL_INTERVAL = 0  # read notifications before every publish
+    return AQXPublisher('test', default_exchange='test_exchange', transport=transport,
+                        flow_control=flow), flow
+
+
+def drain(transport):
+    channel = transport.connect(None).channel()
+    received = []
+    channel.basic_consume('test_queue', lambda ch, method, props, body: received.append(
+        json.loads(body)), auto_ack=True)
+    channel.connection.process_data_events(0)
+    return received
+
+
+def test_token_bucket_allows_bursts_then_spaces_out():
+    bucket = TokenBucket(rate=100, burst=2)
+
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take(max_wait=0) is None
+    assert 0 < bucket.take() <= 0.01
+    assert bucket.tokens < 0
+
+
+def test_refused_publishes_use_no_capacity_of_other_limits():
+    flow = FlowControl(exchange_rates={'test_exchange': (1, 2)},
+                       event_rates={'event.limited': (1, 1)}, max_wait=0)
+
+    flow.throttle('test_exchange', 'event.limited')
+    with pytest.raises(RateLimitedError):
+        flow.throttle('test_exchange', 'event.limited')
+    flow.throttle('test_exchange', 'event.other')
+
+    with pytest.raises(RateLimitedError):
+        flow.throttle('test_exchange', 'event.other')
+
+
+def test_rate_limits_refuse_what_would_wait_too_long(transport):
+    publisher, flow = make_publisher(transport, event_rates={'event.limited': (1, 2)},
+                                     max_wait=0)
+
+    publisher.emit('event.limited', 1)
+    publisher.emit('event.limited', 2)
+    with pytest.raises(RateLimitedError):
+        publisher.emit('event.limited', 3)
+    publisher.emit('event.other', 4)
+
+    assert flow.state.throttled == ('event:event.limited',)
+    assert not flow.state.ok
+    assert drain(transport) == [1, 2, 4]
+    publisher.close()
+
+
+def test_fail_policy_refuses_publishes_while_blocked(transport):
+    metrics = InMemoryMetrics()
+    publisher, flow = make_publisher(transport, on_blocked='fail', metrics=metrics)
+    publisher.emit('event.test', 1)
+
+    transport.broker.block_connections('low on memory')
+    with pytest.raises(BrokerBlockedError):
+        publisher.emit('event.test', 2)
+    with pytest.raises(BrokerBlockedError):
+        publisher.emit_many([('event.test', 3)])
+    state = flow.state
+    assert state.blocked and state.reason == 'low on memory'
+    assert metrics.counter('flow.blocked', {'reason': 'low on memory'}) == 1
+
+    transport.broker.unblock_connections()
+    publisher.emit('event.test', 4)
+
+    assert flow.state.ok
+    assert drain(transport) == [1, 4]
+    publisher.close()
+
+
+def test_block_policy_waits_for_the_broker(transport):
+    publisher, flow = make_publisher(transport, blocked_timeout=5)
+    publisher.emit('event.test', 1)
+    transport.broker.block_connections()
+
+    unblocker = threading.Timer(0.1, transport.broker.unblock_connections)
+    unblocker.start()
+    started = time.monotonic()
+    publisher.emit('event.test', 2)
+
+    assert time.monotonic() - started >= 0.1
+    assert drain(transport) == [1, 2]
+    publisher.close()
+
+
+def test_block_policy_times_out(transport):
+    publisher, flow = make_publisher(transport, blocked_timeout=0.05)
+    publisher.emit('event.test', 1)
+    transport.broker.block_connections()
+
+    with pytest.raises(BrokerBlockedError):
+        publisher.emit('event.test', 2)
+    publisher.close()
+
+
+def test_buffer_policy_publishes_in_order_once_unblocked(transport):
+    publisher, flow = make_publisher(transport, on_blocked='buffer', buffer_size=3)
+    publisher.emit('event.test', 1)
+    transport.broker.block_connections()
+
+    publisher.emit('event.test', 2)
+    report = publisher.emit_many([('event.test', 3), ('event.test', 4)])
+    assert report.ok
+    with pytest.raises(BrokerBlockedError):
+        publisher.emit('event.test', 5)
+    assert flow.state.buffered == 3
+    assert transport.broker.queue_depth('test_queue') == 1
+
+    transport.broker.unblock_connections()
+    publisher.emit('event.test', 6)
+
+    assert flow.buffered == 0
+    assert drain(transport) == [1, 2, 3, 4, 6]
+    publisher.close()
+
+
+def test_buffered_prepared_emits_keep_their_own_properties(transport):
+    publisher, flow = make_publisher(transport, on_blocked='buffer')
+    publisher.emit('event.test', 0)
+    transport.broker.block_connections()
+    emit = publisher.prepare('event.test')
+    for n in range(3):
+        emit(n + 1, correlation_id=f'c{n}')
+
+    buffered = list(flow._buffer)
+    assert len({id(props) for _, _, props, *_ in buffered}) == 3
+    assert [props.correlation_id for _, _, props, *_ in buffered] == ['c0', 'c1', 'c2']
+    assert len({props.message_id for _, _, props, *_ in buffered}) == 3
+
+    transport.broker.unblock_connections()
+    publisher.emit('event.test', 4)
+
+    assert drain(transport) == [0, 1, 2, 3, 4]
+    publisher.close()
+
+
+def test_buffered_messages_are_published_on_close(transport):
+    publisher, flow = make_publisher(transport, on_blocked='buffer')
+    publisher.emit('event.test', 1)
+    transport.broker.block_connections()
+    emit = publisher.prepare('event.test')
+    emit(2)
+
+    transport.broker.unblock_connections()
+    publisher.close()
+
+    assert drain(transport) == [1, 2]
+
+
+def test_buffered_messages_are_published_once_unblocked(transport):
+    publisher, flow = make_publisher(transport, on_blocked='buffer')
+    publisher.emit('event.test', 1)
+    transport.broker.block_connections()
+    publisher.emit('event.test', 2)
+    publisher.emit_many([('event.test', 3)])
+
+    transport.broker.unblock_connections()
+    publisher.connection.process_data_events(0)
+
+    assert flow.buffered == 0
+    assert drain(transport) == [1, 2, 3]
+    publisher.close()
+
+
+def test_flow_control_is_not_applied_to_outboxes(transport, tmp_path):
+    with pytest.raises(ValueError):
+        AQXPublisher('test', transport=transport, outbox=str(tmp_path / 'outbox'),
+                     flow_control=FlowControl())
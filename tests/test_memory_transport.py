@@ -0,0 +1,217 @@
+import threading
+
+import pika.exceptions
+import pytest
+
+from asyncqx import AQXPubSub
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+
+
+@pytest.fixture
+def publisher(transport):
+    pub = AQXPublisher('test', default_exchange='test_exchange',
+                       transport=transport)
+    yield pub
+    pub.close()
+
+
+def test_mandatory_emit_fails_when_no_consumer(publisher):
+    with pytest.raises(pika.exceptions.UnroutableError):
+        publisher.emit('event.test', {'hello': 'world'}, mandatory=True)
+
+
+def test_emit_declares_missing_exchange(publisher, transport):
+    publisher.emit('event.test', {'hello': 'world'})
+
+    assert transport.broker.has_exchange('test_exchange')
+
+
+def test_emitted_events_reach_bound_callbacks(publisher, transport, consume_in_thread):
+    subscriber = AQXSubscriber(default_exchange='test_exchange',
+                               transport=transport)
+    received = []
+    done = threading.Event()
+
+    @subscriber.bind('event.*', queue_name='test_queue')
+    def on_event(event, data, props):
+        received.append((event, data))
+        if len(received) == 3:
+            done.set()
+
+    thread = consume_in_thread(subscriber, 'test_queue')
+
+    for n in range(3):
+        publisher.emit('event.test', {'n': n}, mandatory=True)
+    publisher.emit('other.test', {'n': -1})
+
+    assert done.wait(5)
+    subscriber.stop()
+    thread.join(5)
+    subscriber.close()
+
+    assert not thread.is_alive()
+    assert received == [('event.test', {'n': n}) for n in range(3)]
+
+
+def test_failed_callbacks_are_dead_lettered(publisher, transport, consume_in_thread):
+    subscriber = AQXSubscriber(default_exchange='test_exchange',
+                               transport=transport, auto_ack=False)
+    done = threading.Event()
+
+    @subscriber.bind('event.test', queue_name='test_queue')
+    def on_event(event, data, props):
+        done.set()
+        raise RuntimeError('boom')
+
+    thread = consume_in_thread(subscriber, 'test_queue')
+    publisher.emit('event.test', {})
+
+    assert done.wait(5)
+    subscriber.stop()
+    thread.join(5)
+    subscriber.close()
+
+    assert transport.broker.queue_depth('test_queue') == 0
+
+
+def test_unacked_messages_are_requeued_when_channel_closes(transport):
+    connection = transport.connect(None)
+    channel = connection.channel()
+    channel.queue_declare('work', durable=True)
+    channel.basic_publish('', 'work', b'1')
+    channel.basic_publish('', 'work', b'2')
+
+    deliveries = []
+    channel.basic_qos(prefetch_count=1)
+    channel.basic_consume('work', lambda ch, method, props, body:
+                          deliveries.append((method, body)))
+    connection.process_data_events(0)
+
+    assert [body for _, body in deliveries] == [b'1']
+    assert transport.broker.queue_depth('work') == 1
+
+    channel.close()
+    assert transport.broker.queue_depth('work') == 2
+
+    channel = connection.channel()
+    channel.basic_consume('work', lambda ch, method, props, body:
+                          deliveries.append((method, body)), auto_ack=True)
+    connection.process_data_events(0)
+
+    redelivered = deliveries[1]
+    assert redelivered[0].redelivered
+    assert redelivered[1] == b'1'
+    connection.close()
+
+
+def test_exclusive_queues_are_locked_to_their_connection(transport):
+    owner = transport.connect(None)
+    owner.channel().queue_declare('private', exclusive=True)
+
+    other = transport.connect(None).channel()
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker) as err:
+        other.queue_declare('private')
+
+    assert err.value.reply_code == 405
+    assert other.is_closed
+
+    owner.close()
+    assert not transport.broker.has_queue('private')
+
+
+def test_queues_bound_with_overlapping_keys_get_one_copy(transport):
+    channel = transport.connect(None).channel()
+    channel.exchange_declare('topics', exchange_type='topic')
+    channel.queue_declare('events')
+    # Equal names held in distinct string objects
+    channel.queue_bind(''.join(['ev', 'ents']), 'topics', routing_key='event.*')
+    channel.queue_bind(''.join(['eve', 'nts']), 'topics', routing_key='event.#')
+
+    channel.basic_publish('topics', 'event.test', b'{}')
+
+    assert transport.broker.queue_depth('events') == 1
+
+
+def test_emit_many_reports_unroutable_messages(publisher):
+    report = publisher.emit_many([
+        ('event.test', {'n': 0}),
+        ('event.test', {'n': 1}, {'mandatory': False}),
+    ], mandatory=True)
+
+    assert [result.index for result in report.unroutable] == [0]
+    assert report.results[1].ok
+
+
+def test_emit_many_rejects_unknown_options(publisher, transport):
+    with pytest.raises(ValueError, match='exhange'):
+        publisher.emit_many([
+            ('event.test', {'n': 0}),
+            ('event.test', {'n': 1}, {'exhange': 'other_exchange'}),
+        ])
+
+    assert not transport.broker.has_exchange('test_exchange')
+
+
+def test_subscriber_stops_when_broker_closes_connection(transport, consume_in_thread):
+    subscriber = AQXSubscriber(transport=transport)
+
+    @subscriber.bind('event.test', queue_name='test_queue')
+    def on_event(event, data, props):
+        pass
+
+    thread = consume_in_thread(subscriber, 'test_queue')
+
+    transport.broker.close_connections()
+    thread.join(5)
+
+    assert not thread.is_alive()
+
+
+def test_unavailable_broker_raises_connection_error(transport):
+    transport.broker.available = False
+
+    with pytest.raises(pika.exceptions.AMQPConnectionError):
+        transport.connect(None)
+
+
+def test_pubsub_round_trip(transport, consume_in_thread):
+    pubsub = AQXPubSub('test', transport=transport)
+    done = threading.Event()
+
+    @pubsub.bind('event.test', queue_name='test_queue')
+    def on_event(event, data, props):
+        done.set()
+
+    thread = consume_in_thread(pubsub.subscriber, 'test_queue')
+
+    pubsub.emit('event.test', {'hello': 'world'})
+
+    assert done.wait(5)
+    pubsub.subscriber.stop()
+    thread.join(5)
+
+
+def test_partial_batches_are_handled_after_max_wait(publisher, transport, consume_in_thread):
+    subscriber = AQXSubscriber(default_exchange='test_exchange',
+                               transport=transport, auto_ack=False)
+    batches = []
+    done = threading.Event()
+
+    @subscriber.bind('event.test', queue_name='test_queue', batch_size=3, max_wait=0.05)
+    def on_batch(items):
+        batches.append([data['n'] for _, data, _ in items])
+        if sum(map(len, batches)) == 5:
+            done.set()
+
+    thread = consume_in_thread(subscriber, 'test_queue')
+    for n in range(5):
+        publisher.emit('event.test', {'n': n})
+
+    assert done.wait(5)
+    subscriber.stop()
+    thread.join(5)
+    subscriber.close()
+
+    assert batches == [[0, 1, 2], [3, 4]]
+    assert transport.broker.queue_depth('test_queue') == 0
@@ -0,0 +1,218 @@
+import threading
+import time
+
+import pika.exceptions
+import pytest
+
+from asyncqx.core import PUBLISH_TIME_HEADER, Histogram, InMemoryMetrics
+from asyncqx.core.latency import stamp_publish_time
+from asyncqx.core.metrics import count_retries
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+
+
+def test_histogram_percentiles_are_within_bucket_error():
+    histogram = Histogram()
+    for micros in range(1, 10001):
+        histogram.record(micros / 1e6)
+
+    for fraction in (0.5, 0.9, 0.99):
+        expected = fraction * 10000 / 1e6
+        assert histogram.percentile(fraction) == pytest.approx(
+            expected, rel=1 / Histogram.SUB_BUCKETS)
+
+    summary = histogram.summary()
+    assert summary['count'] == 10000
+    assert summary['min'] == pytest.approx(1e-6)
+    assert summary['max'] == pytest.approx(0.01)
+
+
+def test_histogram_bucket_bounds_cover_every_value():
+    for micros in range(0, 5000):
+        index = Histogram._index(micros)
+        assert Histogram._upper_bound(index) >= micros
+        if index > 0:
+            assert Histogram._upper_bound(index - 1) < micros
+
+
+def test_snapshot_keys_include_sorted_tags():
+    metrics = InMemoryMetrics()
+    metrics.increment('emit', tags={'exchange': 'x', 'event': 'a.b'})
+    metrics.increment('emit', tags={'event': 'a.b', 'exchange': 'x'})
+    metrics.observe('emit.latency', 0.002)
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot['counters'] == {'emit{event=a.b,exchange=x}': 2}
+    assert snapshot['histograms']['emit.latency']['count'] == 1
+
+    metrics.reset()
+    assert metrics.snapshot() == {'counters': {}, 'histograms': {}}
+
+
+def test_count_retries_counts_failed_attempts():
+    class Client:
+        def __init__(self):
+            self.metrics = InMemoryMetrics()
+            self.attempts = 0
+
+        @count_retries('publish', pika.exceptions.AMQPConnectionError)
+        def publish(self):
+            self.attempts += 1
+            if self.attempts < 3:
+                raise pika.exceptions.AMQPConnectionError()
+            return 'ok'
+
+    client = Client()
+    for _ in range(2):
+        with pytest.raises(pika.exceptions.AMQPConnectionError):
+            client.publish()
+    assert client.publish() == 'ok'
+
+    assert client.metrics.counter('retry', tags={
+        'operation': 'publish', 'error': 'AMQPConnectionError'}) == 2
+
+
+def test_publish_and_consume_are_instrumented(transport, consume_in_thread):
+    metrics = InMemoryMetrics()
+    publisher = AQXPublisher('test', transport=transport, metrics=metrics)
+    subscriber = AQXSubscriber(transport=transport, metrics=metrics)
+    done = threading.Event()
+
+    @subscriber.bind('event.ok', 'event.fail', queue_name='test_queue')
+    def on_event(event, data, props):
+        if event == 'event.fail':
+            done.set()
+            raise RuntimeError('boom')
+
+    thread = consume_in_thread(subscriber, 'test_queue')
+
+    publisher.emit('event.ok', {})
+    publisher.emit('event.fail', {})
+    with pytest.raises(pika.exceptions.UnroutableError):
+        publisher.emit('event.none', {}, mandatory=True)
+
+    assert done.wait(5)
+    subscriber.stop()
+    thread.join(5)
+
+    ok = {'event': 'event.ok', 'exchange': 'asyncqx'}
+    assert metrics.counter('emit', tags=ok) == 1
+    assert metrics.histogram('emit.latency', tags=ok).count == 1
+    assert metrics.counter('emit.error', tags={
+        'event': 'event.none', 'exchange': 'asyncqx', 'error': 'UnroutableError'}) == 1
+    assert metrics.histogram('confirm.latency', tags={'exchange': 'asyncqx'}).count == 2
+
+    consumed = {'event': 'event.ok', 'queue': 'test_queue'}
+    assert metrics.counter('consume', tags=consumed) == 1
+    assert metrics.histogram('decode.latency', tags=consumed).count == 1
+    assert metrics.histogram('callback.latency', tags=consumed).count == 1
+    assert metrics.counter('callback.error', tags={
+        'event': 'event.fail', 'queue': 'test_queue', 'error': 'RuntimeError'}) == 1
+
+
+def test_emit_many_counts_each_outcome(transport):
+    metrics = InMemoryMetrics()
+    publisher = AQXPublisher('test', transport=transport,
+                             metrics=metrics)
+
+    publisher.emit_many([('event.a', {}), ('event.b', {}, {'mandatory': True})])
+
+    assert metrics.counter('emit', tags={'event': 'event.a', 'exchange': 'asyncqx'}) == 1
+    assert metrics.counter('emit.error', tags={
+        'event': 'event.b', 'exchange': 'asyncqx', 'error': 'UnroutableError'}) == 1
+    assert metrics.histogram('confirm.latency', tags={'batch': True}).count == 1
+
+
+def test_reconnects_are_counted(transport):
+    metrics = InMemoryMetrics()
+    publisher = AQXPublisher('test', transport=transport,
+                             metrics=metrics)
+    publisher.connect()
+    publisher.connection.close()
+
+    publisher._ensure_connection()
+
+    assert metrics.counter('reconnect', tags={'client': 'AQXPublisher'}) == 1
+
+
+def test_stamped_messages_report_lag_and_stale_messages_are_dropped(transport, consume_in_thread):
+    metrics = InMemoryMetrics()
+    publisher = AQXPublisher('test', transport=transport,
+                             stamp_publish_time=True)
+    subscriber = AQXSubscriber(transport=transport, metrics=metrics,
+                               staleness_budget=60)
+    received = []
+    done = threading.Event()
+
+    @subscriber.bind('event.test', queue_name='test_queue')
+    def on_event(event, data, props):
+        received.append(data)
+        done.set()
+
+    thread = consume_in_thread(subscriber, 'test_queue')
+
+    stale_publisher = AQXPublisher('test', transport=transport)
+    stale_publisher.emit('event.test', {'n': 'stale'}, headers={
+        PUBLISH_TIME_HEADER: time.time_ns() - 120 * 10 ** 9})
+    publisher.emit('event.test', {'n': 'fresh'})
+
+    assert done.wait(5)
+    subscriber.stop()
+    thread.join(5)
+
+    tags = {'event': 'event.test', 'queue': 'test_queue'}
+    assert received == [{'n': 'fresh'}]
+    assert metrics.counter('stale', tags=dict(tags, action='drop')) == 1
+    assert metrics.histogram('receive.lag', tags=tags).count == 2
+    assert metrics.histogram('handled.lag', tags=tags).count == 1
+    assert metrics.histogram('handled.lag', tags=tags).max < 60
+
+
+def test_lag_is_measured_once_per_delivery_to_a_shared_queue(transport, consume_in_thread):
+    metrics = InMemoryMetrics()
+    publisher = AQXPublisher('test', transport=transport,
+                             stamp_publish_time=True)
+    subscriber = AQXSubscriber(transport=transport, metrics=metrics,
+                               staleness_budget=60)
+    received = []
+    done = threading.Event()
+
+    @subscriber.bind('event.test', queue_name='test_queue')
+    def on_event(event, data, props):
+        received.append(('event', data))
+
+    @subscriber.bind('event.*', queue_name='test_queue')
+    def on_any(event, data, props):
+        received.append(('any', data))
+        done.set()
+
+    thread = consume_in_thread(subscriber, 'test_queue')
+
+    stale_publisher = AQXPublisher('test', transport=transport)
+    stale_publisher.emit('event.test', {'n': 'stale'}, headers={
+        PUBLISH_TIME_HEADER: time.time_ns() - 120 * 10 ** 9})
+    publisher.emit('event.test', {'n': 'fresh'})
+
+    assert done.wait(5)
+    subscriber.stop()
+    thread.join(5)
+
+    tags = {'event': 'event.test', 'queue': 'test_queue'}
+    assert sorted(received) == [('any', {'n': 'fresh'}), ('event', {'n': 'fresh'})]
+    assert metrics.counter('stale', tags=dict(tags, action='drop')) == 1
+    assert metrics.histogram('receive.lag', tags=tags).count == 2
+
+
+def test_stamp_publish_time_keeps_given_headers():
+    headers = {'tenant': 'a'}
+    stamped = stamp_publish_time(headers)
+
+    assert stamped['tenant'] == 'a'
+    assert abs(stamped[PUBLISH_TIME_HEADER] - time.time_ns()) < 10 ** 9
+    assert headers == {'tenant': 'a'}
+
+
+def test_unknown_stale_action_is_rejected():
+    with pytest.raises(ValueError):
+        AQXSubscriber(on_stale='ignore')
@@ -0,0 +1,170 @@
+import time
+
+import pika
+import pytest
+
+from asyncqx.core import InMemoryMetrics
+from asyncqx.publisher import AQXPublisher, Outbox, OutboxFullError, OutboxStoppedError
+from asyncqx.publisher.outbox import Journal
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'outbox.journal')
+
+
+def bind_queue(transport, routing_key):
+    connection = transport.connect(None)
+    channel = connection.channel()
+    channel.exchange_declare('asyncqx', exchange_type='topic', durable=True)
+    channel.queue_declare('test_queue', durable=True)
+    channel.queue_bind('test_queue', 'asyncqx', routing_key=routing_key)
+    connection.close()
+
+
+def drain(transport, queue_name):
+    connection = transport.connect(None)
+    channel = connection.channel()
+    messages = []
+    channel.basic_consume(queue_name, lambda ch, method, props, body:
+                          messages.append((method.routing_key, body)), auto_ack=True)
+    connection.process_data_events(0)
+    connection.close()
+    return messages
+
+
+def make_outbox(path, transport, **kwargs) -> Outbox:
+    outbox = Outbox(path, transport=transport, **kwargs)
+    outbox.RETRY_DELAY = 0.01
+    outbox.POLL_INTERVAL = 0.01
+    return outbox
+
+
+def test_journal_keeps_untruncated_records_across_reopens(path):
+    journal = Journal(path, capacity=4096)
+    first = journal.append(b'one')
+    journal.append(b'two')
+    journal.append(b'three')
+    journal.truncate(first)
+    journal.close()
+
+    journal = Journal(path, capacity=4096)
+    assert [payload for _, payload in journal.read(journal.head, 10)] == [b'two', b'three']
+
+
+def test_journal_discards_torn_records(path):
+    journal = Journal(path, capacity=4096)
+    journal.append(b'complete')
+    end = journal.append(b'torn')
+    journal._mmap[end - 1:end] = b'X'
+    journal.close()
+
+    journal = Journal(path, capacity=4096)
+    assert [payload for _, payload in journal.read(journal.head, 10)] == [b'complete']
+    journal.append(b'next')
+    assert [payload for _, payload in journal.read(journal.head, 10)] == [b'complete', b'next']
+
+
+def test_journal_is_bounded_and_reclaims_truncated_space(path):
+    journal = Journal(path, capacity=1024)
+    positions = []
+    with pytest.raises(OutboxFullError):
+        while True:
+            positions.append(journal.append(b'x' * 100))
+    assert journal.capacity == 1024
+
+    journal.truncate(positions[len(positions) // 2])
+    journal.append(b'y' * 100)
+    records = journal.read(journal.head, 100)
+    assert records[-1][1] == b'y' * 100
+    assert len(records) == len(positions) - len(positions) // 2
+
+    journal.truncate(records[-1][0])
+    assert journal.empty
+    journal.append(b'z' * 800)
+
+
+def test_outbox_publishes_once_the_broker_is_back(path, transport):
+    bind_queue(transport, 'event.*')
+    transport.broker.available = False
+    metrics = InMemoryMetrics()
+    publisher = AQXPublisher('test', transport=transport, metrics=metrics,
+                             outbox=make_outbox(path, transport, metrics=metrics))
+
+    for n in range(5):
+        publisher.emit(f'event.{n % 2}', {'n': n})
+    publisher.prepare('event.0')({'n': 5})
+    report = publisher.emit_many([('event.1', {'n': 6})])
+    assert report.ok
+    assert not publisher.outbox.wait_until_drained(0.05)
+
+    transport.broker.available = True
+    assert publisher.outbox.wait_until_drained(5)
+    publisher.close()
+
+    messages = drain(transport, 'test_queue')
+    assert [body for _, body in messages] == [
+        f'{{"n": {n}}}'.encode() for n in range(7)]
+    assert metrics.counter('outbox.published', tags={
+        'event': 'event.0', 'exchange': 'asyncqx'}) == 4
+
+
+def test_outbox_recovers_unpublished_messages_on_restart(path, transport):
+    bind_queue(transport, 'event.test')
+    transport.broker.available = False
+    publisher = AQXPublisher('test', transport=transport,
+                             outbox=make_outbox(path, transport))
+    publisher.emit('event.test', {'n': 1})
+    publisher.emit('event.test', {'n': 2})
+    publisher.close()
+
+    transport.broker.available = True
+    outbox = make_outbox(path, transport)
+    outbox.start()
+    assert outbox.wait_until_drained(5)
+    outbox.close()
+
+    assert [body for _, body in drain(transport, 'test_queue')] == [
+        b'{"n": 1}', b'{"n": 2}']
+
+
+def test_outbox_drops_unroutable_messages(path, transport):
+    outbox = make_outbox(path, transport)
+    publisher = AQXPublisher('test', transport=transport, outbox=outbox)
+    publisher.emit('event.none', {}, mandatory=True)
+
+    assert outbox.wait_until_drained(5)
+    publisher.close()
+
+
+def test_outbox_backs_off_while_the_broker_nacks(path, transport):
+    outbox = make_outbox(path, transport)
+    outbox.NACK_DELAY = 0.02
+    outbox.RETRY_DELAY = 0.08
+    outbox.append('asyncqx', 'event.test', pika.BasicProperties(), False, b'{}')
+    attempts = []
+
+    def nack(entries):
+        attempts.append(time.monotonic())
+        return outbox.journal.head, True
+
+    outbox._publish_batch = nack
+    outbox.start()
+    time.sleep(0.3)
+    outbox.close()
+
+    assert 3 <= len(attempts) <= 8
+    assert attempts[2] - attempts[1] > attempts[1] - attempts[0]
+
+
+def test_outbox_reports_errors_that_stop_the_drainer(path, transport):
+    outbox = make_outbox(path, transport)
+    outbox.journal.append(b'not an entry')
+    outbox.start()
+
+    with pytest.raises(OutboxStoppedError):
+        outbox.wait_until_drained()
+    outbox._thread.join(5)
+    assert not outbox.running
+    assert outbox.error is not None
+    outbox.close()
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+from asyncqx.publisher import AQXPublisherPool
+
+
+pytestmark = pytest.mark.usefixtures('event_queue')
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def make_pool(transport, **kwargs) -> AQXPublisherPool:
+    return AQXPublisherPool('test', default_exchange='test_exchange',
+                            transport=transport, **kwargs)
+
+
+def test_publishers_are_reused(transport):
+    pool = make_pool(transport)
+
+    for n in range(10):
+        pool.emit('event.test', n)
+
+    assert len(pool) == 1
+    assert pool.idle == 1
+    assert transport.broker.queue_depth('test_queue') == 10
+    pool.close()
+
+
+def test_threads_share_at_most_max_size_publishers(transport):
+    pool = make_pool(transport, max_size=3)
+    lent = []
+    lock = threading.Lock()
+
+    def work():
+        for n in range(50):
+            with pool.checkout() as publisher:
+                with lock:
+                    assert publisher not in lent
+                    lent.append(publisher)
+                publisher.emit('event.test', n)
+                with lock:
+                    lent.remove(publisher)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(pool) <= 3
+    assert transport.broker.queue_depth('test_queue') == 400
+    pool.close()
+
+
+def test_checkout_times_out_when_every_publisher_is_lent(transport):
+    pool = make_pool(transport, max_size=1)
+
+    with pool.checkout():
+        with pytest.raises(TimeoutError):
+            with pool.checkout(timeout=0.01):
+                pass
+
+    with pool.checkout():
+        pass
+    pool.close()
+
+
+def test_idle_publishers_are_evicted(transport):
+    pool = make_pool(transport, idle_timeout=0)
+    with pool.checkout() as first:
+        first.emit('event.test', 1)
+
+    with pool.checkout() as second:
+        assert second is not first
+        assert len(pool) == 1
+    wait_for(lambda: first._connection.is_closed)
+    pool.close()
+
+
+def test_idle_publishers_are_evicted_when_the_pool_goes_quiet(transport):
+    pool = make_pool(transport, idle_timeout=0.05)
+    with pool.checkout() as first, pool.checkout() as second:
+        first.emit('event.test', 1)
+        second.emit('event.test', 2)
+    assert pool.idle == 2
+
+    wait_for(lambda: len(pool) == 0)
+    wait_for(lambda: first._connection.is_closed and second._connection.is_closed)
+    assert pool.idle == 0
+    pool.close()
+
+
+def test_evicted_publishers_are_closed_outside_the_lock(transport):
+    pool = make_pool(transport, idle_timeout=0)
+    lock_free = []
+
+    def acquire():
+        acquired = pool._lock.acquire(timeout=1)
+        lock_free.append(acquired)
+        if acquired:
+            pool._lock.release()
+
+    def close():
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+
+    with pool.checkout() as first:
+        first.emit('event.test', 1)
+        first.close = close
+    with pool.checkout():
+        pass
+
+    wait_for(lambda: lock_free)
+    assert lock_free == [True]
+    pool.close()
+
+
+def test_broken_publishers_are_replaced(transport):
+    pool = make_pool(transport, health_check_interval=0)
+    with pool.checkout() as first:
+        first.emit('event.test', 1)
+    first._connection.close()
+
+    with pool.checkout() as second:
+        assert second is not first
+        second.emit('event.test', 2)
+
+    with pool.checkout() as third:
+        assert third is second
+        third.channel.close()
+    assert len(pool) == 0
+    pool.close()
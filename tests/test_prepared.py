@@ -0,0 +1,74 @@
+import pika.exceptions
+import pytest
+
+from asyncqx.core import (PUBLISH_TIME_HEADER, CompressedSerializer,
+                          InMemoryMetrics, JSONSerializer)
+from asyncqx.publisher import AQXPublisher
+
+
+def drain(transport, queue_name):
+    connection = transport.connect(None)
+    channel = connection.channel()
+    messages = []
+    channel.basic_consume(queue_name, lambda ch, method, props, body:
+                          messages.append((method, props, body)), auto_ack=True)
+    connection.process_data_events(0)
+    connection.close()
+    return messages
+
+
+def bind_queue(transport, routing_key):
+    connection = transport.connect(None)
+    channel = connection.channel()
+    channel.exchange_declare('asyncqx', exchange_type='topic', durable=True)
+    channel.queue_declare('test_queue', durable=True)
+    channel.queue_bind('test_queue', 'asyncqx', routing_key=routing_key)
+    connection.close()
+
+
+def test_prepared_emitter_publishes_like_emit(transport):
+    bind_queue(transport, 'event.test')
+    publisher = AQXPublisher('test', transport=transport)
+    emit = publisher.prepare('event.test', headers={'tenant': 'a'})
+
+    emit({'n': 1}, correlation_id=7)
+    publisher.emit('event.test', {'n': 2}, headers={'tenant': 'a'})
+
+    (method, prepared, body), (_, emitted, _) = drain(transport, 'test_queue')
+    assert method.routing_key == 'event.test'
+    assert body == b'{"n": 1}'
+    for name in ('app_id', 'type', 'headers', 'delivery_mode', 'content_type',
+                 'content_encoding'):
+        assert getattr(prepared, name) == getattr(emitted, name)
+    assert prepared.correlation_id == '7'
+    assert emitted.correlation_id is None
+
+
+def test_prepared_emitter_refreshes_per_message_fields(transport):
+    bind_queue(transport, 'event.test')
+    publisher = AQXPublisher('test', transport=transport, stamp_publish_time=True)
+    emit = publisher.prepare(
+        'event.test',
+        serializer=CompressedSerializer(JSONSerializer(), threshold=100))
+
+    emit({'n': 1}, correlation_id='a')
+    emit({'data': 'x' * 1000})
+
+    (_, small, _), (_, large, _) = drain(transport, 'test_queue')
+    assert small.correlation_id == 'a'
+    assert small.content_encoding is None
+    assert large.correlation_id is None
+    assert large.content_encoding == 'zlib'
+    assert large.headers[PUBLISH_TIME_HEADER] >= small.headers[PUBLISH_TIME_HEADER]
+
+
+def test_prepared_emitter_is_mandatory_and_instrumented(transport):
+    metrics = InMemoryMetrics()
+    publisher = AQXPublisher('test', transport=transport, metrics=metrics)
+    emit = publisher.prepare('event.none', mandatory=True)
+
+    with pytest.raises(pika.exceptions.UnroutableError):
+        emit({})
+
+    assert metrics.counter('emit.error', tags={
+        'event': 'event.none', 'exchange': 'asyncqx', 'error': 'UnroutableError'}) == 1
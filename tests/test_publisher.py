@@ -1,6 +1,8 @@
 import pika.exceptions
 import pytest
+from unittest import mock
 
+from asyncqx.core import MarshalSerializer
 from asyncqx.publisher import AQXPublisher
 
 
@@ -44,3 +46,33 @@ def test_mandatory_emit_fails_when_no_consumer(publisher: AQXPublisher):
             },
             mandatory=True
         )
+
+
+def test_pub_can_emit_many_messages(publisher: AQXPublisher):
+    report = publisher.emit_many(
+        ('event.test', {'n': n}) for n in range(100))
+
+    assert len(report) == 100
+    assert report.ok
+
+
+def test_emit_many_reports_unroutable_messages(publisher: AQXPublisher):
+    report = publisher.emit_many([
+        ('event.test', {'n': 1}),
+        ('event.test', {'n': 2}, {'mandatory': True}),
+    ])
+
+    assert [result.index for result in report.unroutable] == [1]
+    assert not report.nacked
+
+
+def test_emit_stamps_serializer_content_type():
+    publisher = AQXPublisher('test', default_exchange='test_exchange',
+                             default_serializer=MarshalSerializer())
+
+    with mock.patch.object(publisher, '_publish') as publish:
+        publisher.emit('event.test', {'hello': 'world'})
+
+    props = publish.call_args.kwargs['properties']
+    assert props.content_type == MarshalSerializer.content_type
+    assert MarshalSerializer().decode(publish.call_args.kwargs['data']) == {'hello': 'world'}
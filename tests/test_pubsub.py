@@ -0,0 +1,100 @@
+import threading
+
+import pika
+import pytest
+
+from asyncqx import AQXPubSub
+from asyncqx.pubsub import ORIGIN_HEADER
+from asyncqx.subscriber.envelope import MessageEnvelope
+
+
+@pytest.fixture
+def pubsub(transport):
+    instance = AQXPubSub('test', default_exchange='test_exchange', transport=transport)
+    yield instance
+    instance.publisher.close()
+
+
+def test_local_bindings_receive_the_payload_object(pubsub, transport):
+    received = []
+
+    @pubsub.bind('order.*', delivery='local')
+    def on_order(event, data, props):
+        received.append((event, data, props.correlation_id))
+
+    payload = {'id': 1}
+    pubsub.emit('order.created', payload, correlation_id='abc', remote=False)
+    pubsub.emit('invoice.created', {'id': 2}, remote=False)
+
+    assert received == [('order.created', payload, 'abc')]
+    assert received[0][1] is payload
+    assert not transport.broker.has_exchange('test_exchange')
+
+
+def test_local_callback_errors_do_not_stop_emit(pubsub):
+    received = []
+
+    @pubsub.bind('order.created', delivery='local')
+    def fail(event, data, props):
+        raise ValueError('boom')
+
+    @pubsub.bind('order.#', delivery='local')
+    def on_order(event, data, props):
+        received.append(data)
+
+    pubsub.emit_many([('order.created', 1), ('order.created', 2)], remote=False)
+
+    assert received == [1, 2]
+
+
+def test_both_skips_broker_copies_of_local_emits(pubsub, transport, consume_in_thread):
+    received = []
+    done = threading.Event()
+
+    @pubsub.bind('order.created', queue_name='orders', delivery='both')
+    def on_order(event, data, props):
+        received.append(data)
+        if len(received) == 2:
+            done.set()
+
+    thread = consume_in_thread(pubsub, 'orders')
+
+    remote = AQXPubSub('remote', default_exchange='test_exchange', transport=transport)
+    try:
+        pubsub.emit('order.created', 'local')
+        remote.emit('order.created', 'remote')
+        assert done.wait(5)
+    finally:
+        pubsub.subscriber.stop()
+        thread.join(5)
+        remote.publisher.close()
+
+    assert received == ['local', 'remote']
+
+
+def test_both_callbacks_can_fail_broker_deliveries(pubsub):
+    callback = pubsub._skip_loopback(lambda event, data, props: data['ok'], None)
+    props = pika.BasicProperties(type='order.created', content_type='application/json')
+
+    assert callback('order.created', MessageEnvelope(None, props, b'{"ok": false}'), props) is False
+    assert callback('order.created', MessageEnvelope(None, props, b'{"ok": true}'), props) is True
+
+
+def test_origin_is_only_stamped_for_loopback_bindings(pubsub):
+    assert pubsub._stamp_origin({'a': 1}) == {'a': 1}
+
+    pubsub.bind('order.created', queue_name='orders', delivery='both')(lambda *args: None)
+
+    assert pubsub._stamp_origin({'a': 1}) == {'a': 1, ORIGIN_HEADER: pubsub.origin}
+
+
+def test_unknown_delivery_policy_is_rejected(pubsub):
+    with pytest.raises(ValueError):
+        pubsub.bind('order.created', delivery='nowhere')
+
+
+def test_local_bindings_reject_queue_options(pubsub):
+    with pytest.raises(ValueError, match='queue_name'):
+        pubsub.bind('order.created', queue_name='orders', delivery='local')
+    with pytest.raises(ValueError, match='shards, claim'):
+        pubsub.bind('order.created', shards=4, claim=[0], delivery='local')
@@ -0,0 +1,175 @@
+import time
+from unittest import mock
+
+import pika
+import pika.exceptions
+import pytest
+
+from asyncqx.core.metrics import InMemoryMetrics
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber, RetryPolicy
+from asyncqx.subscriber.retries import (ATTEMPT_HEADER, ERROR_HEADER, RETRY_BINDING_HEADER,
+                                        attempt_of, redelivery_properties)
+from asyncqx.subscriber.subscriber import create_event_switch
+
+POLICY = RetryPolicy(max_attempts=3, delay=0.01)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_backoff_is_exponential_and_capped():
+    policy = RetryPolicy(max_attempts=6, delay=0.5, multiplier=3, max_delay=10)
+
+    assert [policy.delay_ms(attempt) for attempt in range(1, 6)] == [500, 1500, 4500, 10000, 10000]
+    assert policy.delays_ms() == (500, 1500, 4500, 10000)
+    assert policy.dead_letter_exchange_for('orders') == 'orders.dead'
+    with pytest.raises(ValueError):
+        RetryPolicy(max_attempts=0)
+
+
+def test_redelivery_properties_count_attempts():
+    props = pika.BasicProperties(type='order.created', expiration='100',
+                                 headers={'a': 1, 'x-death': []})
+
+    redelivered = redelivery_properties(props, 2, 'tests.handler', ValueError('boom'))
+
+    assert redelivered.type == 'order.created'
+    assert redelivered.expiration is None
+    assert redelivered.headers == {'a': 1, ATTEMPT_HEADER: 2,
+                                   RETRY_BINDING_HEADER: 'tests.handler',
+                                   ERROR_HEADER: 'ValueError: boom'}
+    assert attempt_of(props) == 1
+    assert attempt_of(redelivered) == 2
+
+
+@pytest.mark.parametrize('options', [{}, {'auto_ack': False, 'callback_threads': 2}])
+def test_failed_messages_are_retried_then_dead_lettered(transport, options, consume_in_thread):
+    metrics = InMemoryMetrics()
+    subscriber = AQXSubscriber(default_exchange='test_exchange', transport=transport,
+                               metrics=metrics, **options)
+    attempts = []
+
+    @subscriber.bind('order.created', queue_name='orders', retry_policy=POLICY)
+    def on_order(event, data, props):
+        attempts.append(attempt_of(props))
+        raise ValueError('boom')
+
+    thread = consume_in_thread(subscriber, 'orders')
+    publisher = AQXPublisher('test', default_exchange='test_exchange', transport=transport)
+    try:
+        publisher.emit('order.created', {'id': 1})
+        wait_for(lambda: transport.broker.queue_depth('orders.dead') == 1)
+    finally:
+        subscriber.stop()
+        thread.join(5)
+        publisher.close()
+
+    assert attempts == [1, 2, 3]
+    assert metrics.counter('redelivery', {'event': 'order.created', 'queue': 'orders'}) == 2
+    assert metrics.counter('dead_letter', {'event': 'order.created', 'queue': 'orders'}) == 1
+
+
+def test_only_the_failing_binding_retries(transport, consume_in_thread):
+    subscriber = AQXSubscriber(default_exchange='test_exchange', transport=transport)
+    received = []
+
+    @subscriber.bind('order.created', queue_name='orders', retry_policy=POLICY)
+    def flaky(event, data, props):
+        received.append(('flaky', attempt_of(props)))
+        if attempt_of(props) == 1:
+            raise ValueError('boom')
+
+    @subscriber.bind('order.*', queue_name='orders')
+    def steady(event, data, props):
+        received.append(('steady', attempt_of(props)))
+
+    thread = consume_in_thread(subscriber, 'orders')
+    publisher = AQXPublisher('test', default_exchange='test_exchange', transport=transport)
+    try:
+        publisher.emit('order.created', {'id': 1})
+        wait_for(lambda: len(received) == 3)
+        time.sleep(0.05)
+    finally:
+        subscriber.stop()
+        thread.join(5)
+        publisher.close()
+
+    assert sorted(received) == [('flaky', 1), ('flaky', 2), ('steady', 1)]
+    assert transport.broker.queue_depth('orders.dead') == 0
+
+
+def test_bindings_of_callbacks_with_the_same_name_retry_separately(transport, consume_in_thread):
+    subscriber = AQXSubscriber(default_exchange='test_exchange', transport=transport)
+    received = []
+
+    def bind(label, fails):
+        @subscriber.bind('order.created', queue_name='orders', retry_policy=POLICY)
+        def handler(event, data, props):
+            received.append((label, attempt_of(props)))
+            if fails and attempt_of(props) == 1:
+                raise ValueError('boom')
+
+    bind('flaky', fails=True)
+    bind('steady', fails=False)
+    names = [binding.name for binding in subscriber._late_bindings[('test_exchange', 'orders')]]
+    assert len(set(names)) == 2
+
+    thread = consume_in_thread(subscriber, 'orders')
+    publisher = AQXPublisher('test', default_exchange='test_exchange', transport=transport)
+    try:
+        publisher.emit('order.created', {'id': 1})
+        wait_for(lambda: len(received) == 3)
+        time.sleep(0.05)
+    finally:
+        subscriber.stop()
+        thread.join(5)
+        publisher.close()
+
+    assert sorted(received) == [('flaky', 1), ('flaky', 2), ('steady', 1)]
+
+
+def test_retries_need_a_named_unbatched_queue():
+    subscriber = AQXSubscriber(default_exchange='test_exchange')
+
+    with pytest.raises(ValueError):
+        subscriber.bind('order.created', retry_policy=POLICY)
+    with pytest.raises(ValueError):
+        subscriber.bind('order.created', queue_name='orders', batch_size=10,
+                        retry_policy=POLICY)
+
+
+@pytest.mark.parametrize('callback_threads', [0, 2])
+@pytest.mark.parametrize('shared', [False, True])
+def test_messages_are_requeued_when_their_retry_is_not_sent(callback_threads, shared):
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False,
+                               callback_threads=callback_threads)
+
+    @subscriber.bind('order.created', queue_name='orders', retry_policy=POLICY)
+    def on_order(event, data, props):
+        raise ValueError('boom')
+
+    if shared:
+        subscriber.bind('order.*', queue_name='orders', retry_policy=POLICY)(mock.MagicMock())
+
+    connection = mock.MagicMock()
+    connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+    subscriber._connection = connection
+    subscriber._retry_channel = mock.MagicMock(is_open=True)
+    subscriber._retry_channel.basic_publish.side_effect = pika.exceptions.UnroutableError([])
+
+    event_bindings = subscriber._late_bindings[('test_exchange', 'orders')]
+    message_callback = (create_event_switch(event_bindings) if shared
+                        else event_bindings[0].callback)
+    on_message = subscriber._create_consumer_callback(message_callback, 'orders')
+    channel = mock.MagicMock(connection=connection)
+    on_message(channel, mock.MagicMock(delivery_tag=1),
+               pika.BasicProperties(type='order.created'), b'{}')
+    subscriber._shutdown_executor()
+
+    channel.basic_nack.assert_called_once_with(delivery_tag=1, requeue=True)
+    channel.basic_ack.assert_not_called()
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from unittest import mock
+
+import pika
+import pika.exceptions
+import pytest
+from pika import spec
+
+from asyncqx.core import RpcError
+from asyncqx.core.rpc import DIRECT_REPLY_TO, RPC_ERROR_HEADER
+from asyncqx.publisher import AQXAsyncPublisher, AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+
+
+@pytest.fixture
+def server(transport, consume_in_thread):
+    subscriber = AQXSubscriber(default_exchange='test_exchange', transport=transport)
+
+    @subscriber.bind_rpc('math.add', queue_name='rpc_queue')
+    def add(event, payload, props):
+        return payload['a'] + payload['b']
+
+    @subscriber.bind_rpc('math.fail', queue_name='rpc_queue')
+    def fail(event, payload, props):
+        raise ValueError('bad input')
+
+    @subscriber.bind_rpc('math.slow', queue_name='rpc_queue')
+    def slow(event, payload, props):
+        time.sleep(0.2)
+
+    thread = consume_in_thread(subscriber, 'rpc_queue')
+
+    yield subscriber
+    subscriber.stop()
+    thread.join(5)
+    subscriber.close()
+
+
+@pytest.fixture
+def client(transport):
+    publisher = AQXPublisher('test', default_exchange='test_exchange', transport=transport)
+    yield publisher
+    publisher.close()
+
+
+def test_call_returns_the_handler_result(server, client):
+    assert client.call('math.add', {'a': 1, 'b': 2}) == 3
+
+
+def test_call_many_waits_for_every_reply(server, client):
+    results = client.call_many([('math.add', {'a': n, 'b': n}) for n in range(50)])
+
+    assert results == [2 * n for n in range(50)]
+
+
+def test_call_raises_handler_errors(server, client):
+    with pytest.raises(RpcError, match='bad input'):
+        client.call('math.fail', {})
+
+    results = client.call_many([('math.fail', {}), ('math.add', {'a': 1, 'b': 1})],
+                               return_exceptions=True)
+    assert isinstance(results[0], RpcError)
+    assert results[1] == 2
+
+
+def test_call_times_out(server, client):
+    with pytest.raises(TimeoutError):
+        client.call('math.slow', {}, timeout=0.05)
+
+    assert len(client._replies) == 0
+
+
+def test_call_many_forgets_unanswered_calls_when_raising(server, client):
+    with pytest.raises(RpcError):
+        client.call_many([('math.fail', {}), ('math.slow', {})], timeout=0.1)
+
+    assert len(client._replies) == 0
+
+
+def test_call_without_handler_is_unroutable(server, client):
+    with pytest.raises(pika.exceptions.UnroutableError):
+        client.call('math.none', {})
+
+
+def test_direct_reply_to_requires_a_reply_consumer(transport):
+    channel = transport.connect(None).channel()
+    channel.exchange_declare('test_exchange', exchange_type='topic')
+
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        channel.basic_publish('test_exchange', 'math.add', b'{}',
+                              pika.BasicProperties(reply_to=DIRECT_REPLY_TO))
+
+
+def test_async_calls_are_resolved_by_correlation_id():
+    async def scenario():
+        publisher = AQXAsyncPublisher('test', default_exchange='test_exchange')
+        publisher._channel = mock.MagicMock()
+        publisher._channel.is_open = True
+        ready = asyncio.get_running_loop().create_future()
+        ready.set_result(None)
+        publisher._declared_exchanges['test_exchange'] = ready
+        publisher._reply_consumer = ready
+
+        calls = [asyncio.ensure_future(publisher.call('math.add', n)) for n in range(2)]
+        while publisher._channel.basic_publish.call_count < 2:
+            await asyncio.sleep(0)
+        publisher._on_delivery_confirmation(mock.MagicMock(
+            method=spec.Basic.Ack(delivery_tag=2, multiple=True)))
+
+        requests = [kwargs['properties'] for _, kwargs
+                    in publisher._channel.basic_publish.call_args_list]
+        assert all(props.reply_to == DIRECT_REPLY_TO for props in requests)
+
+        publisher._replies.on_reply(None, None, pika.BasicProperties(
+            correlation_id=requests[1].correlation_id,
+            headers={RPC_ERROR_HEADER: 'ValueError: bad input'}), b'')
+        publisher._replies.on_reply(None, None, pika.BasicProperties(
+            correlation_id=requests[0].correlation_id), b'"zero"')
+
+        assert await calls[0] == 'zero'
+        with pytest.raises(RpcError):
+            await calls[1]
+
+    asyncio.run(scenario())
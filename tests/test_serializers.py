@@ -0,0 +1,147 @@
+import json
+from dataclasses import dataclass
+from typing import List
+
+import pytest
+from pika.spec import BasicProperties
+
+from asyncqx.core import (DEFAULT_REGISTRY, CompressedSerializer,
+                          FastJSONSerializer, JSONSerializer,
+                          MarshalSerializer, SerializerRegistry)
+from asyncqx.core.serializers import encode_message
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+@dataclass
+class Shape:
+    name: str
+    points: List[Point]
+
+
+def test_fast_json_encodes_nested_dataclasses():
+    serializer = FastJSONSerializer()
+    shape = Shape('line', [Point(0, 0), Point(1, 2)])
+
+    data = serializer.encode(shape)
+
+    assert json.loads(data) == {
+        'name': 'line',
+        'points': [{'x': 0, 'y': 0}, {'x': 1, 'y': 2}]}
+    assert serializer.decode(data) == json.loads(data)
+
+
+def test_fast_json_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        FastJSONSerializer().encode(object())
+
+
+def test_marshal_round_trip():
+    serializer = MarshalSerializer()
+    payload = {'ids': [1, 2, 3], 'name': 'event', 'blob': b'\x00\x01', 'ok': True}
+
+    assert serializer.decode(serializer.encode(payload)) == payload
+
+
+def test_encode_message_stamps_content_type():
+    encoded = encode_message(MarshalSerializer(), [1])
+
+    assert encoded.content_type == 'application/x-python-marshal'
+    assert encoded.content_encoding is None
+
+
+def test_registry_resolves_serializer_from_message_properties():
+    registry = SerializerRegistry()
+    registry.register(JSONSerializer())
+    registry.register(MarshalSerializer())
+    fallback = JSONSerializer()
+
+    marshalled = BasicProperties(content_type='application/x-python-marshal')
+    untyped = BasicProperties()
+    unknown = BasicProperties(content_type='application/x-unknown')
+
+    assert isinstance(registry.resolve(marshalled, fallback), MarshalSerializer)
+    assert registry.resolve(untyped, fallback) is fallback
+    assert registry.resolve(unknown, fallback) is fallback
+
+
+def test_marshal_is_not_decoded_by_default():
+    marshalled = BasicProperties(content_type='application/x-python-marshal')
+
+    assert DEFAULT_REGISTRY.get('application/x-python-marshal') is None
+    assert isinstance(DEFAULT_REGISTRY.resolve(marshalled, JSONSerializer()), JSONSerializer)
+
+
+def test_registry_prefers_bound_serializer_for_its_own_content_type():
+    registry = SerializerRegistry()
+    registry.register(JSONSerializer())
+    bound = FastJSONSerializer()
+
+    props = BasicProperties(content_type='application/json')
+
+    assert registry.resolve(props, bound) is bound
+
+
+def test_registry_prefers_bound_serializer_without_a_content_type():
+    class Upper:
+        def encode(self, data): return data.upper().encode()
+        def decode(self, data): return data.decode().upper()
+
+    bound = Upper()
+    props = BasicProperties(content_type='application/json')
+
+    assert DEFAULT_REGISTRY.resolve(props, bound) is bound
+
+
+def test_registry_requires_a_content_type():
+    class Anonymous:
+        def encode(self, data): return b''
+        def decode(self, data): return None
+
+    with pytest.raises(ValueError):
+        SerializerRegistry().register(Anonymous())
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'bz2', 'lzma'])
+def test_compression_applies_above_threshold_only(codec):
+    serializer = CompressedSerializer(JSONSerializer(), codec=codec, threshold=100)
+
+    small = encode_message(serializer, {'n': 1})
+    large_payload = {'values': list(range(200))}
+    large = encode_message(serializer, large_payload)
+
+    assert small.content_encoding is None
+    assert json.loads(small.body) == {'n': 1}
+    assert large.content_type == 'application/json'
+    assert large.content_encoding == codec
+    assert serializer.decode(large.body) == large_payload
+
+
+def test_registry_decompresses_from_content_encoding():
+    large_payload = {'values': list(range(200))}
+    encoded = encode_message(
+        CompressedSerializer(JSONSerializer(), codec='lzma', threshold=0),
+        large_payload)
+    props = BasicProperties(content_type=encoded.content_type,
+                            content_encoding=encoded.content_encoding)
+
+    serializer = DEFAULT_REGISTRY.resolve(props, JSONSerializer())
+
+    assert serializer.decode(encoded.body) == large_payload
+
+
+def test_compressed_fallback_handles_uncompressed_messages():
+    registry = SerializerRegistry()
+    bound = CompressedSerializer(FastJSONSerializer())
+    props = BasicProperties(content_type='application/json')
+
+    assert registry.resolve(props, bound) is bound.serializer
+
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        CompressedSerializer(JSONSerializer(), codec='snappy')
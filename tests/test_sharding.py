@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from asyncqx.core.sharding import jump_hash, resolve_claim, shard_for
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+
+
+def test_jump_hash_only_moves_keys_to_new_buckets():
+    for key in range(2000):
+        before = jump_hash(key, 7)
+        after = jump_hash(key, 8)
+        assert 0 <= before < 7
+        assert after in (before, 7)
+
+
+def test_shards_are_evenly_loaded():
+    counts = [0] * 4
+    for key in range(4000):
+        counts[shard_for(f'customer-{key}', 4)] += 1
+
+    assert min(counts) > 800
+
+
+def test_claim_must_be_in_range():
+    assert resolve_claim(4, None) == (0, 1, 2, 3)
+    assert resolve_claim(4, [3, 1, 1]) == (1, 3)
+    with pytest.raises(ValueError):
+        resolve_claim(4, [4])
+    with pytest.raises(ValueError):
+        resolve_claim(0, None)
+
+
+def test_sharded_events_keep_each_key_on_one_shard(transport, consume_in_thread):
+    subscriber = AQXSubscriber(default_exchange='test_exchange', transport=transport)
+    received = []
+    done = threading.Event()
+
+    @subscriber.bind('order.created', queue_name='orders', shards=4)
+    def on_order(event, data, props):
+        received.append((event, data))
+        if len(received) == 40:
+            done.set()
+
+    thread = consume_in_thread(subscriber, *(f'orders.{shard}' for shard in range(4)))
+
+    publisher = AQXPublisher('test', default_exchange='test_exchange', transport=transport,
+                             shards={'order.created': 4}, partition_key='customer')
+    try:
+        for n in range(40):
+            customer = f'customer-{n % 8}'
+            publisher.emit('order.created', {'customer': customer, 'n': n},
+                           headers={'customer': customer}, mandatory=True)
+        assert done.wait(5)
+    finally:
+        subscriber.stop()
+        thread.join(5)
+        publisher.close()
+
+    assert {event for event, _ in received} == {'order.created'}
+    for customer in {data['customer'] for _, data in received}:
+        orders = [data['n'] for _, data in received if data['customer'] == customer]
+        assert orders == sorted(orders)
+
+
+def test_claimed_shards_are_the_only_queues_bound(transport):
+    subscriber = AQXSubscriber(default_exchange='test_exchange', transport=transport)
+    subscriber.bind('order.created', queue_name='orders', shards=4, claim=[1, 3])(
+        lambda *args: None)
+
+    assert list(subscriber._late_bindings) == [
+        ('test_exchange', 'orders.1'), ('test_exchange', 'orders.3')]
+    bindings = [eb.bound_keys for ebs in subscriber._late_bindings.values() for eb in ebs]
+    assert bindings == [('order.created.1',), ('order.created.3',)]
+
+    with pytest.raises(ValueError):
+        subscriber.bind('order.created', queue_name='', shards=4)
+
+
+def test_emit_many_reports_the_unsharded_event(transport):
+    publisher = AQXPublisher('test', default_exchange='test_exchange', transport=transport,
+                             shards={'order.created': 2})
+    try:
+        report = publisher.emit_many([('order.created', n) for n in range(4)])
+    finally:
+        publisher.close()
+
+    assert [result.event for result in report.results] == ['order.created'] * 4
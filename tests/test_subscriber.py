@@ -1,10 +1,12 @@
 from pika.spec import BasicProperties
 import pytest
 
-from asyncqx.subscriber import AQXSubscriber
+from asyncqx.core import MarshalSerializer, SerializerRegistry
+from asyncqx.subscriber import AQXSubscriber, LaneExecutor, RetryPolicy
 from unittest import mock
 
 import json
+import threading
 
 @pytest.fixture
 def subscriber(rabbitmq):
@@ -76,3 +78,190 @@ def test_functions_are_bound_to_queues_with_no_errors(subscriber):
     subscriber._ensure_channel()
     subscriber._apply_late_bindings()
     subscriber.close()
+
+
+def consumer_callback_for(subscriber, queue=''):
+    bound_fn = subscriber._late_bindings[('test_exchange', queue)][0].callback
+    return subscriber._create_consumer_callback(bound_fn)
+
+
+def test_manual_ack_after_successful_callback():
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False)
+    subscriber.bind('some.event')(mock.MagicMock())
+
+    channel = mock.MagicMock()
+    method = mock.MagicMock(delivery_tag=7)
+    consumer_callback_for(subscriber)(
+        channel, method, BasicProperties(type='some.event'), json.dumps({}))
+
+    channel.basic_ack.assert_called_once_with(delivery_tag=7)
+    channel.basic_nack.assert_not_called()
+
+
+def test_manual_ack_rejects_failed_callback():
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False)
+    subscriber.bind('some.event')(mock.MagicMock(side_effect=Exception('boom')))
+
+    channel = mock.MagicMock()
+    method = mock.MagicMock(delivery_tag=7)
+    consumer_callback_for(subscriber)(
+        channel, method, BasicProperties(type='some.event'), json.dumps({}))
+
+    channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=False)
+    channel.basic_ack.assert_not_called()
+
+
+def test_callback_threads_ack_through_connection_thread():
+    subscriber = AQXSubscriber(default_exchange='test_exchange',
+                               auto_ack=False, callback_threads=2)
+    listener = mock.MagicMock()
+    subscriber.bind('some.event')(listener)
+
+    assert subscriber.prefetch_count == 2
+
+    channel = mock.MagicMock()
+    channel.connection.add_callback_threadsafe.side_effect = lambda fn: fn()
+    method = mock.MagicMock(delivery_tag=3)
+    consumer_callback_for(subscriber)(
+        channel, method, BasicProperties(type='some.event'), json.dumps({}))
+    subscriber._shutdown_executor()
+
+    listener.assert_called_once()
+    channel.connection.add_callback_threadsafe.assert_called_once()
+    channel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+
+def test_prefetch_is_applied_before_consuming():
+    subscriber = AQXSubscriber(default_exchange='test_exchange',
+                               auto_ack=False, prefetch_count=50)
+    subscriber.bind('some.event', queue_name='some_queue')(mock.MagicMock())
+
+    with mock.patch.object(subscriber, '_channel') as channel:
+        subscriber._apply_late_bindings()
+
+    channel.basic_qos.assert_called_once_with(prefetch_count=50)
+    assert channel.basic_consume.call_args.kwargs['auto_ack'] is False
+
+
+def test_decoder_is_chosen_from_message_content_type():
+    listener = mock.MagicMock()
+    serializers = SerializerRegistry()
+    serializers.register(MarshalSerializer())
+    subscriber = AQXSubscriber(default_exchange='test_exchange', serializers=serializers)
+    subscriber.bind('some.event')(listener)
+
+    bound_fn = subscriber._late_bindings[('test_exchange', '')][0].callback
+    props = BasicProperties(type='some.event',
+                            content_type=MarshalSerializer.content_type)
+    bound_fn(None, None, props, MarshalSerializer().encode({'hello': 'world'}))
+
+    listener.assert_called_once_with('some.event', {'hello': 'world'}, props)
+
+
+def batch_consumer_callback_for(subscriber, queue='batch_queue'):
+    batcher = subscriber._late_bindings[('test_exchange', queue)][0].callback
+    return subscriber._create_batch_consumer_callback(batcher)
+
+
+def deliver(callback, channel, delivery_tag, payload):
+    callback(channel, mock.MagicMock(delivery_tag=delivery_tag),
+             BasicProperties(type='some.event'), json.dumps(payload))
+
+
+def test_batched_bindings_get_lists_and_ack_once():
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False)
+    listener = mock.MagicMock()
+    subscriber.bind('some.event', queue_name='batch_queue', batch_size=3)(listener)
+
+    channel = mock.MagicMock()
+    on_message = batch_consumer_callback_for(subscriber)
+    for n in range(1, 4):
+        deliver(on_message, channel, n, {'n': n})
+
+    (items,), _ = listener.call_args
+    assert [(event, data) for event, data, _ in items] == [
+        ('some.event', {'n': n}) for n in range(1, 4)]
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+
+def test_batches_behind_unsettled_deliveries_are_acked_one_by_one():
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False)
+    subscriber.bind('some.event', queue_name='batch_queue', batch_size=2)(
+        mock.MagicMock(return_value=False))
+
+    channel = mock.MagicMock()
+    subscriber._track_delivery(channel, 1)
+    on_message = batch_consumer_callback_for(subscriber)
+    deliver(on_message, channel, 2, {})
+    deliver(on_message, channel, 3, {})
+
+    assert channel.basic_nack.call_args_list == [
+        mock.call(delivery_tag=2, requeue=False),
+        mock.call(delivery_tag=3, requeue=False)]
+
+
+def test_batched_bindings_need_their_own_queue():
+    subscriber = AQXSubscriber(default_exchange='test_exchange')
+    subscriber.bind('some.event', queue_name='batch_queue', batch_size=10)(mock.MagicMock())
+    subscriber.bind('some.other', queue_name='batch_queue')(mock.MagicMock())
+
+    with mock.patch.object(subscriber, '_channel'):
+        with pytest.raises(ValueError):
+            subscriber._apply_late_bindings()
+
+
+def test_batch_options_are_validated_rather_than_ignored():
+    subscriber = AQXSubscriber(default_exchange='test_exchange')
+
+    with pytest.raises(ValueError):
+        subscriber.bind('some.event', queue_name='batch_queue', batch_size=0)(mock.MagicMock())
+    with pytest.raises(ValueError):
+        subscriber.bind('some.event', queue_name='batch_queue', batch_size=0,
+                        retry_policy=RetryPolicy())
+
+    subscriber.bind('some.event', queue_name='batch_queue', batch_size=2, max_wait=0)(
+        mock.MagicMock())
+    batcher = subscriber._late_bindings[('test_exchange', 'batch_queue')][0].callback
+    assert batcher.max_wait == 0
+
+
+def test_lanes_keep_order_per_key():
+    lanes = LaneExecutor(4, depth=8)
+    handled = {}
+
+    def handle(key, n):
+        handled.setdefault(key, []).append((n, threading.current_thread().name))
+
+    futures = [lanes.submit(handle, n % 5, n, key=n % 5) for n in range(100)]
+    for future in futures:
+        future.result(5)
+    lanes.shutdown()
+
+    for key, runs in handled.items():
+        assert [n for n, _ in runs] == list(range(key, 100, 5))
+        assert len({thread for _, thread in runs}) == 1
+
+
+def test_lanes_bound_prefetch_and_exclude_callback_threads():
+    subscriber = AQXSubscriber(auto_ack=False, lanes=4)
+    assert subscriber.prefetch_count == 4 * AQXSubscriber.LANE_DEPTH
+
+    with pytest.raises(ValueError):
+        AQXSubscriber(lanes=4, callback_threads=4)
+
+
+def test_lanes_dispatch_by_partition_key_and_ack_through_connection_thread():
+    subscriber = AQXSubscriber(default_exchange='test_exchange', auto_ack=False,
+                               lanes=2, partition_key='tenant')
+    listener = mock.MagicMock()
+    subscriber.bind('some.event')(listener)
+
+    channel = mock.MagicMock()
+    channel.connection.add_callback_threadsafe.side_effect = lambda fn: fn()
+    consumer_callback_for(subscriber)(
+        channel, mock.MagicMock(delivery_tag=5),
+        BasicProperties(type='some.event', headers={'tenant': 'a'}), json.dumps({}))
+    subscriber._shutdown_executor()
+
+    listener.assert_called_once()
+    channel.basic_ack.assert_called_once_with(delivery_tag=5)
@@ -0,0 +1,74 @@
+import os
+import signal
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from asyncqx.subscriber import AQXSubscriber
+from asyncqx.subscriber.supervisor import WorkerSupervisor
+
+
+class IdleSubscriber:
+    """Stands in for a subscriber whose consume loop blocks until stopped."""
+
+    _connection = None
+    _channel = None
+
+    def _consume(self):
+        while True:
+            time.sleep(0.05)
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_supervisor_restarts_dead_workers_and_stops_cleanly():
+    supervisor = WorkerSupervisor(IdleSubscriber(), workers=2)
+    supervisor.RESTART_DELAY = 0
+    runner = threading.Thread(target=supervisor.run)
+    runner.start()
+
+    try:
+        assert wait_for(lambda: len(supervisor.pids) == 2)
+        victim = supervisor.pids[0]
+        os.kill(victim, signal.SIGKILL)
+
+        assert wait_for(lambda: len(supervisor.pids) == 2
+                        and victim not in supervisor.pids)
+    finally:
+        supervisor.stop()
+        runner.join(10)
+
+    assert not runner.is_alive()
+    assert supervisor.pids == []
+
+
+def test_workers_require_shareable_queues():
+    subscriber = AQXSubscriber(default_exchange='test_exchange')
+    subscriber.bind('some.event', queue_name='private', exclusive=True)(mock.MagicMock())
+
+    with pytest.raises(ValueError):
+        subscriber.consume(workers=2)
+
+
+def test_single_worker_consumes_in_process():
+    subscriber = AQXSubscriber(default_exchange='test_exchange')
+
+    with mock.patch.object(subscriber, '_consume') as consume:
+        subscriber.consume()
+
+    consume.assert_called_once()
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from pika.adapters.blocking_connection import BlockingChannel
+
+from asyncqx.core import Topology
+from asyncqx.publisher import AQXPublisher
+from asyncqx.subscriber import AQXSubscriber
+from asyncqx.transport import InMemoryBroker, InMemoryTransport
+
+
+def blocking_channel():
+    channel = mock.MagicMock(spec=BlockingChannel)
+    channel._impl = mock.MagicMock()
+    channel.queue_declare.return_value = SimpleNamespace(
+        method=SimpleNamespace(queue='amq.gen-1'))
+    return channel
+
+
+def test_declarations_are_pipelined_with_a_final_barrier():
+    topology = Topology()
+    queue = topology.declare_queue('orders')
+    topology.declare_exchange('events')
+    for n in range(3):
+        topology.bind(queue, 'events', f'order.{n}')
+
+    channel = blocking_channel()
+    topology.apply(channel)
+
+    assert channel._impl.queue_declare.call_count == 1
+    assert channel._impl.exchange_declare.call_count == 1
+    assert channel._impl.queue_bind.call_count == 2
+    channel.queue_bind.assert_called_once_with('orders', 'events', routing_key='order.2')
+
+
+def test_server_named_queues_wait_for_their_name():
+    topology = Topology()
+    queue = topology.declare_queue('', exclusive=True, alias='events')
+    topology.bind(queue, 'events', 'order.*')
+    topology.bind(queue, 'events', 'order.#')
+
+    channel = blocking_channel()
+    topology.apply(channel)
+
+    channel.queue_declare.assert_called_once()
+    channel._impl.queue_bind.assert_called_once_with(
+        'amq.gen-1', 'events', routing_key='order.*')
+    assert topology.queue_name(queue) == 'amq.gen-1'
+
+
+def test_declarations_are_sent_once_per_connection():
+    topology = Topology()
+    topology.declare_exchange('events')
+
+    channel = blocking_channel()
+    topology.apply(channel)
+    topology.apply(channel)
+    topology.ensure_exchange(channel, 'events')
+    assert channel.exchange_declare.call_count == 1
+
+    reconnected = blocking_channel()
+    topology.apply(reconnected)
+    assert reconnected.exchange_declare.call_count == 1
+
+
+def test_forgotten_exchanges_are_declared_again():
+    topology = Topology()
+    channel = blocking_channel()
+    topology.ensure_exchange(channel, 'events')
+    topology.forget_exchange('events')
+    topology.ensure_exchange(channel, 'events')
+
+    assert channel.exchange_declare.call_count == 2
+
+
+def test_publishing_to_new_exchanges_keeps_the_channel_open():
+    transport = InMemoryTransport(InMemoryBroker())
+    publisher = AQXPublisher('test', transport=transport)
+
+    publisher.emit('event.test', {})
+    channel = publisher.channel
+    publisher.emit('event.test', {}, exchange='other')
+    publisher.emit_many([('event.test', {}, {'exchange': 'third'})])
+
+    assert publisher.channel is channel
+    assert transport.broker.has_exchange('other')
+    assert transport.broker.has_exchange('third')
+
+
+def test_subscriber_topology_is_replayed_after_reconnect():
+    transport = InMemoryTransport(InMemoryBroker())
+    subscriber = AQXSubscriber(transport=transport)
+    for n in range(200):
+        subscriber.bind(f'event.{n}', queue_name='test_queue')(mock.MagicMock())
+    subscriber.bind('event.any')(mock.MagicMock())
+
+    subscriber._ensure_channel()
+    subscriber._apply_late_bindings()
+
+    assert len(transport.broker.bindings('asyncqx')) == 201
+    first_anonymous = [queue for _, queue in transport.broker.bindings('asyncqx')
+                       if queue != 'test_queue']
+
+    transport.broker.close_connections()
+    assert not transport.broker.has_queue(first_anonymous[0])
+
+    subscriber._ensure_channel()
+    anonymous = [queue for _, queue in transport.broker.bindings('asyncqx')
+                 if queue != 'test_queue']
+    assert len(anonymous) == 1
+    assert anonymous != first_anonymous